@@ -0,0 +1,69 @@
+'''
+Compares two results files written by run.py and exits with status 1 if
+any throughput dropped, or any p50/p99 latency, start-up time or idle
+memory grew, by more than the threshold:
+
+    python3 compare.py baseline.json current.json --threshold 10
+'''
+import argparse
+import json
+import sys
+
+# Written by the startup scenario for every service, lower is better.
+STARTUP_METRICS = ('import_ms', 'first_call_ms', 'ready_ms', 'rss_mb')
+
+
+def metrics(results, prefix=''):
+    '''Flattens the results into {"scenario/benchmark/metric": (value, higher_is_better)}.'''
+    found = {}
+    for name, value in results.items():
+        path = '{}/{}'.format(prefix, name) if prefix else name
+        if isinstance(value, dict):
+            found.update(metrics(value, path))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            if name.endswith('per_second'):
+                found[path] = (value, True)
+            elif 'latency_ms' in path and name in ('p50', 'p99'):
+                found[path] = (value, False)
+            elif name in STARTUP_METRICS:
+                found[path] = (value, False)
+    return found
+
+
+def compare(baseline, current, threshold):
+    regressions = []
+    rows = []
+    old = metrics(baseline['results'])
+    new = metrics(current['results'])
+    for path in sorted(set(old) & set(new)):
+        (before, higher_is_better), (after, _) = old[path], new[path]
+        change = (after - before) / before * 100 if before else 0.0
+        regressed = change < -threshold if higher_is_better else change > threshold
+        rows.append((path, before, after, change, regressed))
+        if regressed:
+            regressions.append(path)
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two benchmark results.')
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--threshold', type=float, default=10, help='allowed change in percent')
+    options = parser.parse_args()
+    with open(options.baseline) as f:
+        baseline = json.load(f)
+    with open(options.current) as f:
+        current = json.load(f)
+
+    rows, regressions = compare(baseline, current, options.threshold)
+    for path, before, after, change, regressed in rows:
+        print('{:<70} {:>12} {:>12} {:>+8.1f}%{}'.format(path, before, after, change,
+                                                        '  REGRESSION' if regressed else ''))
+    if regressions:
+        print('{} regression(s) above {}%.'.format(len(regressions), options.threshold))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+'''
+Load generation and latency statistics shared by the benchmark scenarios.
+'''
+import http.client
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+from werkzeug.serving import WSGIRequestHandler, make_server
+from common.stats import percentiles
+
+
+def run_load(call, requests=1000, concurrency=10, rate=None, duration=None):
+    '''
+    Calls `call()` from `concurrency` threads until `requests` calls were
+    made or `duration` seconds passed, and reports throughput and latency.
+
+    Without `rate` every thread calls again as soon as its last call
+    returned (closed loop). With `rate` calls are started on a fixed
+    schedule of `rate` per second (open loop), and latency is measured
+    from the scheduled start, so a slow server is not hidden by the load
+    generator backing off.
+    '''
+    lock = threading.Lock()
+    latencies = []
+    errors = []
+    issued = [0]
+    started = time.monotonic()
+    deadline = started + duration if duration else None
+
+    def next_start():
+        with lock:
+            index = issued[0]
+            if requests is not None and index >= requests:
+                return None
+            issued[0] += 1
+        scheduled = started + index / rate if rate else time.monotonic()
+        if deadline is not None and scheduled >= deadline:
+            return None
+        return scheduled
+
+    def worker():
+        while True:
+            scheduled = next_start()
+            if scheduled is None:
+                return
+            delay = scheduled - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                call()
+            except Exception as e:
+                with lock:
+                    errors.append(type(e).__name__)
+            else:
+                with lock:
+                    latencies.append(time.monotonic() - scheduled)
+
+    threads = [threading.Thread(target=worker, name='load-{}'.format(i), daemon=True)
+               for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    result = {
+        'requests': len(latencies) + len(errors),
+        'errors': len(errors),
+        'seconds': round(elapsed, 3),
+        'requests_per_second': round(len(latencies) / elapsed, 2) if elapsed else None,
+        'latency_ms': percentiles(latencies),
+    }
+    if errors:
+        result['error_types'] = sorted(set(errors))
+    return result
+
+
+class HTTPStatusError(Exception):
+    pass
+
+
+def http_call(base_url, path='/', method='GET', body=None, headers=None):
+    '''
+    Returns a function that sends one request and reads the response, on a
+    keep-alive connection per load generator thread. `body` may be a
+    callable, which is called for the body of every request.
+    '''
+    url = urlsplit(base_url)
+    local = threading.local()
+
+    def call():
+        if getattr(local, 'conn', None) is None:
+            local.conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=10)
+        try:
+            local.conn.request(method, path, body=body() if callable(body) else body,
+                               headers=headers or {})
+            response = local.conn.getresponse()
+            response.read()
+        except Exception:
+            local.conn.close()
+            local.conn = None
+            raise
+        if response.status >= 400:
+            raise HTTPStatusError(response.status)
+
+    return call
+
+
+class _KeepAliveHandler(WSGIRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+
+@contextmanager
+def serve(app):
+    '''Serves a WSGI app on a free local port for the duration of the block.'''
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=_KeepAliveHandler)
+    thread = threading.Thread(target=server.serve_forever, name='wsgi-server', daemon=True)
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:{}'.format(server.server_port)
+    finally:
+        server.shutdown()
+        thread.join()
@@ -0,0 +1,289 @@
+'''
+In-memory stand-ins for the AWS APIs the services call. They take the same
+arguments and return the same shapes as the boto3 clients, for the calls
+the services make, so the real service code runs against them unchanged.
+
+Every call sleeps for `latency` seconds first, to model the network round
+trip to AWS, and is counted in `calls`, so a benchmark can report how many
+API requests a pattern needs. The Step Functions stand-in lives with the
+saga workers, in saga_worker/local.py.
+'''
+import hashlib
+import json
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict, defaultdict
+from botocore.exceptions import ClientError
+
+
+class LocalService:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def _call(self, operation):
+        with self._lock:
+            self.calls[operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class _Queue:
+    def __init__(self, visibility_timeout):
+        self.visibility_timeout = visibility_timeout
+        self.visible = OrderedDict()
+        self.in_flight = {}
+        self.ready = threading.Condition()
+
+
+class LocalSQS(LocalService):
+    '''SQS queues with long polling, visibility timeouts and batch deletes.'''
+
+    def __init__(self, latency=0.0, visibility_timeout=30):
+        super().__init__(latency)
+        self.visibility_timeout = visibility_timeout
+        self._queues = {}
+
+    def create_queue(self, QueueName, Attributes=None):
+        self._call('CreateQueue')
+        url = 'https://sqs.local/000000000000/{}'.format(QueueName)
+        visibility_timeout = int((Attributes or {}).get('VisibilityTimeout', self.visibility_timeout))
+        with self._lock:
+            self._queues.setdefault(url, _Queue(visibility_timeout))
+        return {'QueueUrl': url}
+
+    def send_message(self, QueueUrl, MessageBody, MessageAttributes=None):
+        self._call('SendMessage')
+        return {'MessageId': self.deliver(QueueUrl, MessageBody, MessageAttributes)}
+
+    def deliver(self, queue_url, body, attributes=None):
+        '''Enqueues a message without counting an API call, as SNS does.'''
+        q = self._queue(queue_url)
+        message_id = str(uuid.uuid4())
+        message = {
+            'MessageId': message_id,
+            'Body': body,
+            'MD5OfBody': hashlib.md5(body.encode('utf-8')).hexdigest(),
+            'Attributes': {'SentTimestamp': str(int(time.time() * 1000)), 'ApproximateReceiveCount': '0'},
+        }
+        if attributes:
+            message['MessageAttributes'] = attributes
+        with q.ready:
+            q.visible[message_id] = message
+            q.ready.notify()
+        return message_id
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0,
+                        VisibilityTimeout=None, AttributeNames=None, MessageAttributeNames=None):
+        self._call('ReceiveMessage')
+        q = self._queue(QueueUrl)
+        visibility_timeout = q.visibility_timeout if VisibilityTimeout is None else VisibilityTimeout
+        deadline = time.monotonic() + WaitTimeSeconds
+        with q.ready:
+            while True:
+                self._requeue_expired(q)
+                if q.visible or time.monotonic() >= deadline:
+                    break
+                # Wake up regularly to notice expired visibility timeouts.
+                q.ready.wait(min(0.1, max(0, deadline - time.monotonic())))
+            messages = []
+            while q.visible and len(messages) < MaxNumberOfMessages:
+                _, message = q.visible.popitem(last=False)
+                message = dict(message, Attributes=dict(message['Attributes']))
+                message['Attributes']['ApproximateReceiveCount'] = str(
+                    int(message['Attributes']['ApproximateReceiveCount']) + 1)
+                message['ReceiptHandle'] = uuid.uuid4().hex
+                q.in_flight[message['ReceiptHandle']] = (message, time.monotonic() + visibility_timeout)
+                messages.append(message)
+        return {'Messages': messages} if messages else {}
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        self._call('DeleteMessage')
+        q = self._queue(QueueUrl)
+        with q.ready:
+            q.in_flight.pop(ReceiptHandle, None)
+        return {}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self._call('DeleteMessageBatch')
+        q = self._queue(QueueUrl)
+        with q.ready:
+            for entry in Entries:
+                q.in_flight.pop(entry['ReceiptHandle'], None)
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+    def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout):
+        self._call('ChangeMessageVisibility')
+        if not self._change_visibility(self._queue(QueueUrl), ReceiptHandle, VisibilityTimeout):
+            raise ClientError({'Error': {'Code': 'ReceiptHandleIsInvalid', 'Message': ReceiptHandle}},
+                              'ChangeMessageVisibility')
+        return {}
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        self._call('ChangeMessageVisibilityBatch')
+        q = self._queue(QueueUrl)
+        successful, failed = [], []
+        for entry in Entries:
+            if self._change_visibility(q, entry['ReceiptHandle'], entry['VisibilityTimeout']):
+                successful.append({'Id': entry['Id']})
+            else:
+                failed.append({'Id': entry['Id'], 'Code': 'ReceiptHandleIsInvalid', 'SenderFault': True})
+        return {'Successful': successful, 'Failed': failed}
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames=None):
+        self._call('GetQueueAttributes')
+        q = self._queue(QueueUrl)
+        with q.ready:
+            self._requeue_expired(q)
+            now_ms = time.time() * 1000
+            oldest = min((int(m['Attributes']['SentTimestamp']) for m in q.visible.values()), default=now_ms)
+            return {'Attributes': {
+                'ApproximateNumberOfMessages': str(len(q.visible)),
+                'ApproximateNumberOfMessagesNotVisible': str(len(q.in_flight)),
+                'ApproximateAgeOfOldestMessage': str(int((now_ms - oldest) / 1000)),
+            }}
+
+    def _queue(self, queue_url):
+        with self._lock:
+            if queue_url not in self._queues:
+                raise ClientError({'Error': {'Code': 'AWS.SimpleQueueService.NonExistentQueue',
+                                             'Message': queue_url}}, 'ReceiveMessage')
+            return self._queues[queue_url]
+
+    def _change_visibility(self, q, receipt_handle, visibility_timeout):
+        with q.ready:
+            if receipt_handle not in q.in_flight:
+                return False
+            message, _ = q.in_flight[receipt_handle]
+            q.in_flight[receipt_handle] = (message, time.monotonic() + visibility_timeout)
+            if visibility_timeout == 0:
+                self._requeue_expired(q)
+                q.ready.notify_all()
+            return True
+
+    def _requeue_expired(self, q):
+        now = time.monotonic()
+        for receipt_handle, (message, visible_at) in list(q.in_flight.items()):
+            if visible_at <= now:
+                del q.in_flight[receipt_handle]
+                q.visible[message['MessageId']] = message
+
+
+class LocalSNS(LocalService):
+    '''SNS topics that fan out to LocalSQS queues, with the SNS JSON envelope.'''
+
+    def __init__(self, sqs, latency=0.0):
+        super().__init__(latency)
+        self.sqs = sqs
+        self._subscriptions = defaultdict(list)
+
+    def create_topic(self, Name):
+        self._call('CreateTopic')
+        return {'TopicArn': 'arn:aws:sns:local:000000000000:{}'.format(Name)}
+
+    def subscribe(self, TopicArn, Protocol, Endpoint):
+        # Endpoint is the queue URL here, not the queue ARN.
+        self._call('Subscribe')
+        with self._lock:
+            self._subscriptions[TopicArn].append(Endpoint)
+        return {'SubscriptionArn': '{}:{}'.format(TopicArn, uuid.uuid4())}
+
+    def publish(self, TopicArn, Message, MessageAttributes=None, Subject=None):
+        self._call('Publish')
+        return {'MessageId': self._fan_out(TopicArn, Message, MessageAttributes)}
+
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        self._call('PublishBatch')
+        successful = []
+        for entry in PublishBatchRequestEntries:
+            message_id = self._fan_out(TopicArn, entry['Message'], entry.get('MessageAttributes'))
+            successful.append({'Id': entry['Id'], 'MessageId': message_id})
+        return {'Successful': successful, 'Failed': []}
+
+    def _fan_out(self, topic_arn, message, attributes):
+        message_id = str(uuid.uuid4())
+        envelope = {
+            'Type': 'Notification',
+            'MessageId': message_id,
+            'TopicArn': topic_arn,
+            'Message': message,
+            'Timestamp': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()),
+        }
+        if attributes:
+            envelope['MessageAttributes'] = {name: {'Type': value['DataType'], 'Value': value['StringValue']}
+                                             for name, value in attributes.items()}
+        body = json.dumps(envelope)
+        with self._lock:
+            queue_urls = list(self._subscriptions[topic_arn])
+        for queue_url in queue_urls:
+            self.sqs.deliver(queue_url, body)
+        return message_id
+
+
+class LocalSSM(LocalService):
+    '''SSM Parameter Store, get_parameter and put_parameter only.'''
+
+    def __init__(self, latency=0.0):
+        super().__init__(latency)
+        self._parameters = {}
+
+    def put_parameter(self, Name, Value, Type='String', Overwrite=False):
+        self._call('PutParameter')
+        with self._lock:
+            if Name in self._parameters and not Overwrite:
+                raise ClientError({'Error': {'Code': 'ParameterAlreadyExists', 'Message': Name}},
+                                  'PutParameter')
+            self._parameters[Name] = Value
+        return {'Version': 1}
+
+    def get_parameter(self, Name, WithDecryption=False):
+        self._call('GetParameter')
+        with self._lock:
+            if Name not in self._parameters:
+                raise ClientError({'Error': {'Code': 'ParameterNotFound', 'Message': Name}},
+                                  'GetParameter')
+            return {'Parameter': {'Name': Name, 'Type': 'String', 'Value': self._parameters[Name]}}
+
+
+class LocalDynamoDB(LocalService):
+    '''
+    DynamoDB tables with plain Python values, like the client of a boto3
+    resource. `key_names` maps table names to their key attributes, tables
+    that are not listed use "ID".
+    '''
+
+    def __init__(self, latency=0.0, key_names=None):
+        super().__init__(latency)
+        self.key_names = key_names or {}
+        self.tables = defaultdict(dict)
+
+    def put_item(self, TableName, Item):
+        self._call('PutItem')
+        self._put(TableName, Item)
+        return {}
+
+    def batch_write_item(self, RequestItems):
+        self._call('BatchWriteItem')
+        for table_name, requests in RequestItems.items():
+            for request in requests:
+                if 'PutRequest' in request:
+                    self._put(table_name, request['PutRequest']['Item'])
+                else:
+                    with self._lock:
+                        self.tables[table_name].pop(self._key(table_name, request['DeleteRequest']['Key']), None)
+        return {'UnprocessedItems': {}}
+
+    def get_item(self, TableName, Key):
+        self._call('GetItem')
+        with self._lock:
+            item = self.tables[TableName].get(self._key(TableName, Key))
+        return {'Item': item} if item is not None else {}
+
+    def _key(self, table_name, item):
+        return tuple(item[name] for name in self.key_names.get(table_name, ('ID',)))
+
+    def _put(self, table_name, item):
+        with self._lock:
+            self.tables[table_name][self._key(table_name, item)] = dict(item)
@@ -0,0 +1,99 @@
+'''
+Benchmarks every pattern locally, with in-memory stand-ins for SNS, SQS,
+Step Functions, SSM and DynamoDB, and writes the results as JSON:
+
+    cd codes/benchmarks
+    pip install -r requirements.txt
+    python3 run.py --output baseline.json
+    python3 run.py pubsub saga --requests 5000 --concurrency 32 --output current.json
+    python3 compare.py baseline.json current.json
+
+The Flask apps are served in-process by the werkzeug development server,
+so the HTTP numbers are for comparing builds, not for sizing tasks. Use
+--url to load an app running elsewhere, e.g. under gunicorn. The startup
+scenario starts every service in new processes instead.
+'''
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+
+# EMF lines on stdout would end up in the JSON results.
+os.environ.setdefault('METRICS_EMF_INTERVAL', '0')
+# The services log every request and message at INFO.
+logging.basicConfig(level=logging.WARNING,
+                    format='%(asctime)s: %(levelname)s: %(message)s')
+logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+from scenarios import SCENARIOS
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the copilot.rocks patterns locally.')
+    parser.add_argument('scenarios', nargs='*',
+                        help='scenarios to run, all by default: {}'.format(', '.join(SCENARIOS)))
+    parser.add_argument('--requests', type=int, default=2000, help='requests per benchmark')
+    parser.add_argument('--duration', type=float, help='stop every benchmark after this many seconds')
+    parser.add_argument('--concurrency', type=int, default=16, help='load generator threads')
+    parser.add_argument('--rate', type=float,
+                        help='requests per second (open loop), as fast as possible when not set')
+    parser.add_argument('--aws-latency-ms', type=float, default=0,
+                        help='added to every call to the AWS stand-ins')
+    parser.add_argument('--replicas', type=int, default=2, help='app2 servers for the discovery scenario')
+    parser.add_argument('--slots', type=int, default=4, help='pollers per saga activity, as WORKER_SLOTS')
+    parser.add_argument('--saga-mode', choices=('sequential', 'parallel'), default='sequential',
+                        help='topology of the saga state machine')
+    parser.add_argument('--saga-dispatch', choices=('activity', 'sqs'), default='activity',
+                        help='how the saga steps reach the workers: activity polling or SQS with task tokens')
+    parser.add_argument('--payload-kb', type=int, default=0, help='KB of order items in every saga execution')
+    parser.add_argument('--claim-check', help='claim check store for large saga payloads, e.g. "memory"')
+    parser.add_argument('--codec', default='json',
+                        help='MESSAGE_CODEC of the pubsub scenario, e.g. "msgpack+zstd"')
+    parser.add_argument('--startup-runs', type=int, default=3,
+                        help='fresh processes per service in the startup scenario, the median is reported')
+    parser.add_argument('--url', help='base URL of a running app for the http scenario')
+    parser.add_argument('--path', default='/', help='path requested with --url')
+    parser.add_argument('--output', help='write the results to this file instead of stdout')
+    options = parser.parse_args()
+    options.aws_latency = options.aws_latency_ms / 1000
+    for name in options.scenarios:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario {}'.format(name))
+
+    report = {
+        'meta': {
+            'git_revision': git_revision(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'options': {name: value for name, value in vars(options).items() if name != 'aws_latency'},
+        },
+        'results': {},
+    }
+    for name in options.scenarios or list(SCENARIOS):
+        print('Running {}...'.format(name), file=sys.stderr)
+        report['results'][name] = SCENARIOS[name](options)
+
+    output = json.dumps(report, indent=2)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,341 @@
+'''
+One function per pattern. Each loads the real service modules, points them
+at the local AWS stand-ins and returns a dict of results.
+'''
+import importlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+CODES = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The services import the shared modules of codes/common, which their containers copy next to them.
+if CODES not in sys.path:
+    sys.path.insert(0, CODES)
+
+from local_aws import LocalDynamoDB, LocalSNS, LocalSQS, LocalSSM
+from loadgen import http_call, percentiles, run_load, serve
+
+WORKSHOP = os.path.join(os.path.dirname(CODES), 'workshops', 'hello-copilot')
+STARTUP_PROBE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'startup_probe.py')
+
+
+@contextmanager
+def patched_env(**values):
+    saved = {name: os.environ.get(name) for name in values}
+    os.environ.update(values)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def load_service(directory):
+    '''
+    Imports the app.py of a service. Every service has its own app.py and
+    some share module names, so the modules of one service are taken out
+    of sys.modules again once it is loaded. So are the modules of
+    codes/common: each service gets its own, as in its own container.
+    '''
+    def owned(name):
+        return name.split('.')[0] in local_names or name == 'common' or name.startswith('common.')
+
+    local_names = [name[:-3] for name in os.listdir(directory) if name.endswith('.py')]
+    saved = {name: module for name, module in sys.modules.items() if owned(name)}
+    for name in saved:
+        del sys.modules[name]
+    sys.path.insert(0, directory)
+    try:
+        return importlib.import_module('app')
+    finally:
+        sys.path.remove(directory)
+        for name in [name for name in sys.modules if owned(name)]:
+            del sys.modules[name]
+        sys.modules.update(saved)
+
+
+def _load(options):
+    return dict(requests=options.requests, concurrency=options.concurrency,
+                rate=options.rate, duration=options.duration)
+
+
+def _markdown_bodies(count=100):
+    # A fixed set of documents, so the render cache is exercised as in production.
+    documents = [json.dumps({'text': '# Document {}\n\nSome *markdown* with a [link](#{}).'.format(i, i)})
+                 for i in range(count)]
+    lock = threading.Lock()
+    index = [0]
+
+    def next_body():
+        with lock:
+            index[0] += 1
+            return documents[index[0] % count]
+    return next_body
+
+
+def http(options):
+    '''HTTP load against the Flask apps, or against --url if it is set.'''
+    if options.url:
+        return {'GET {}'.format(options.url): run_load(http_call(options.url, options.path), **_load(options))}
+    results = {}
+    hello = load_service(os.path.join(CODES, 'hello-copilot'))
+    with serve(hello.app) as url:
+        for path in ('/', '/host'):
+            results['hello-copilot GET {}'.format(path)] = run_load(http_call(url, path), **_load(options))
+
+    svc_hello = load_service(os.path.join(WORKSHOP, 'svc-hello'))
+    with serve(svc_hello.app) as url:
+        for path in ('/web', '/web/host'):
+            results['svc-hello GET {}'.format(path)] = run_load(http_call(url, path), **_load(options))
+
+    dynamodb = LocalDynamoDB(latency=options.aws_latency)
+    svc_api = load_service(os.path.join(WORKSHOP, 'svc-api'))
+    svc_api.store = svc_api.WriteBehindStore('markdown', client_factory=lambda: dynamodb)
+    with serve(svc_api.app) as url:
+        for path in ('/api/markdown', '/api/markdown?durable=true'):
+            call = http_call(url, path, method='POST', body=_markdown_bodies(),
+                             headers={'Content-Type': 'application/json'})
+            results['svc-api POST {}'.format(path)] = run_load(call, **_load(options))
+    svc_api.store.flush()
+    results['svc-api dynamodb_calls'] = dict(dynamodb.calls)
+    return results
+
+
+def pubsub(options):
+    '''Publish -> consume latency through the pub-sub publisher and subscriber.'''
+    sqs = LocalSQS(latency=options.aws_latency)
+    sns = LocalSNS(sqs, latency=options.aws_latency)
+    queue_url = sqs.create_queue(QueueName='ping')['QueueUrl']
+    topic_arn = sns.create_topic(Name='ping')['TopicArn']
+    sns.subscribe(TopicArn=topic_arn, Protocol='sqs', Endpoint=queue_url)
+    with patched_env(COPILOT_SNS_TOPIC_ARNS=json.dumps({'ping': topic_arn}), MESSAGE_CODEC=options.codec):
+        pub = load_service(os.path.join(CODES, 'pub-sub', 'pub'))
+        sub = load_service(os.path.join(CODES, 'pub-sub', 'sub'))
+    publisher = pub.publisher
+    publisher.client_factory = lambda: sns
+
+    lock = threading.Lock()
+    latencies = []
+    last_delivery = [None]
+
+    def handler(msg):
+        sent = sub.decode_body(msg)['sent']
+        sub.handle_message(msg)
+        with lock:
+            latencies.append(time.monotonic() - sent)
+            last_delivery[0] = time.monotonic()
+
+    consumer = sub.BatchConsumer(sqs, queue_url, handler, concurrency=sub.CONSUMER_CONCURRENCY,
+                                 prefetch=sub.CONSUMER_PREFETCH, wait_time=1,
+                                 max_pollers=sub.CONSUMER_MAX_POLLERS)
+    consumer.start()
+    started = time.monotonic()
+    publish = run_load(lambda: publisher.publish({'sent': time.monotonic()}), **_load(options))
+    publisher.flush()
+    published = publish['requests'] - publish['errors']
+    deadline = time.monotonic() + 30
+    while len(latencies) < published and time.monotonic() < deadline:
+        time.sleep(0.05)
+    consumer.stop()
+    delivered = len(latencies)
+    elapsed = (last_delivery[0] or time.monotonic()) - started
+    return {
+        'publish': publish,
+        'delivered': delivered,
+        'lost': published - delivered,
+        'messages_per_second': round(delivered / elapsed, 2) if elapsed else None,
+        'end_to_end_latency_ms': percentiles(latencies),
+        'api_calls': {'sns': dict(sns.calls), 'sqs': dict(sqs.calls)},
+    }
+
+
+def discovery(options):
+    '''app1 -> app2 latency, for the pooled client alone and through app1.'''
+    results = {}
+    app2 = load_service(os.path.join(CODES, 'service-discovery', 'app2'))
+    with ExitStack() as stack:
+        urls = [stack.enter_context(serve(app2.app)) for _ in range(options.replicas)]
+        endpoints = ','.join(url[len('http://'):] for url in urls)
+        with patched_env(APP2_URL='app2:9090', APP2_ENDPOINTS=endpoints):
+            app1 = load_service(os.path.join(CODES, 'service-discovery', 'app1'))
+        results['app1 -> app2 hop'] = run_load(lambda: app1.app2_client.get_json('/'), **_load(options))
+        with serve(app1.app) as url:
+            results['app1 GET /'] = run_load(http_call(url, '/'), **_load(options))
+    results['app2 replicas'] = options.replicas
+    return results
+
+
+def saga(options):
+    '''Saga executions through the real workers on local Step Functions, SSM and, with SQS dispatch, SQS.'''
+    saga_app = os.path.join(CODES, 'saga-pattern', 'app')
+    if saga_app not in sys.path:
+        sys.path.insert(0, saga_app)
+    import local_saga
+    from saga_worker.config import ACTIVITY_ARNS_PARAMETER, ActivityArns
+    from saga_worker.definition import local_resource
+
+    ssm = LocalSSM(latency=options.aws_latency)
+    ssm.put_parameter(Name=ACTIVITY_ARNS_PARAMETER, Value=json.dumps(
+        {activity_name: local_resource(activity_name) for activity_name in local_saga.saga.handlers}))
+    arns = ActivityArns(ttl=0, client_factory=lambda: ssm)
+    sqs = LocalSQS(latency=options.aws_latency)
+    result = local_saga.run(options.requests or 1000, options.concurrency, options.slots, arns=arns,
+                            mode=options.saga_mode, task_latency=options.aws_latency,
+                            payload_kb=options.payload_kb, claim_check=options.claim_check,
+                            dispatch=options.saga_dispatch, sqs=sqs)
+    result['api_calls'] = {'ssm': dict(ssm.calls), 'sqs': dict(sqs.calls)}
+    return result
+
+
+def _calls_per_second(call, iterations, budget=1.0):
+    started = time.perf_counter()
+    count = 0
+    while count < iterations and time.perf_counter() - started < budget:
+        call()
+        count += 1
+    return round(count / (time.perf_counter() - started), 2)
+
+
+def codec(options):
+    '''Size, encode and decode speed of every available codec on the messages the services send.'''
+    saga_app = os.path.join(CODES, 'saga-pattern', 'app')
+    if saga_app not in sys.path:
+        sys.path.insert(0, saga_app)
+    import local_saga
+    from common.codec import COMPRESSIONS, FORMATS, Codec, available, decode
+
+    def saga_task(payload_kb):
+        payload = local_saga.order(1, payload_kb)
+        payload.update({'saga': {'execution_id': 'arn:aws:states:ap-southeast-1:123456789012:execution:saga:1'},
+                        'inventory_state': 'done', 'inventory_result': True,
+                        'payment_state': 'done', 'payment_result': True})
+        return payload
+
+    payloads = {
+        'pubsub message': {'message': 'Hello! Message sent: tuzjc'},
+        'saga task 1 KB': saga_task(1),
+        'saga task 100 KB': saga_task(100),
+    }
+    names = [format_name + ('+' + compression if compression else '')
+             for format_name in FORMATS if available(format_name)
+             for compression in (None,) + tuple(COMPRESSIONS) if compression is None or available(compression)]
+    iterations = options.requests or 2000
+    results = {}
+    for shape, payload in payloads.items():
+        # What the services used before the codec module, as the baseline.
+        text = json.dumps(payload)
+        results[shape] = {'json (stdlib)': {
+            'bytes': len(text.encode('utf-8')),
+            'encodes_per_second': _calls_per_second(lambda: json.dumps(payload), iterations),
+            'decodes_per_second': _calls_per_second(lambda: json.loads(text), iterations),
+        }}
+        for name in names:
+            # Compress even the small messages, to show what it costs them.
+            codec = Codec(name, compress_threshold=0)
+            data, encoding = codec.encode(payload)
+            results[shape][name] = {
+                'bytes': len(data),
+                'encodes_per_second': _calls_per_second(lambda: codec.encode(payload), iterations),
+                'decodes_per_second': _calls_per_second(lambda: decode(data, codec.content_type, encoding),
+                                                        iterations),
+            }
+    missing = [name for name in ('orjson', 'msgpack', 'zstandard') if not _installed(name)]
+    if missing:
+        results['not installed'] = missing
+    return results
+
+
+def _startup_services():
+    # Directory, module and first call of every service, as its container runs it, plus the
+    # environment it needs to import. Nothing is sent to AWS or to app2.
+    saga_app = os.path.join(CODES, 'saga-pattern', 'app')
+    return {
+        'hello-copilot': (os.path.join(CODES, 'hello-copilot'), 'app', ['--http', '/'], {}),
+        'svc-hello': (os.path.join(WORKSHOP, 'svc-hello'), 'app', ['--http', '/ping'], {}),
+        'svc-api': (os.path.join(WORKSHOP, 'svc-api'), 'app', ['--http', '/ping'], {}),
+        'pub': (os.path.join(CODES, 'pub-sub', 'pub'), 'app', ['--http', '/ping'],
+                {'COPILOT_SNS_TOPIC_ARNS': json.dumps({'ping': 'arn:aws:sns:ap-southeast-1:123456789012:ping'})}),
+        'sub': (os.path.join(CODES, 'pub-sub', 'sub'), 'app', ['--sqs-message'],
+                {'COPILOT_QUEUE_URI': 'https://sqs.ap-southeast-1.amazonaws.com/123456789012/ping'}),
+        'app1': (os.path.join(CODES, 'service-discovery', 'app1'), 'app', ['--http', '/ping'],
+                 {'APP2_URL': 'app2:9090', 'APP2_ENDPOINTS': '127.0.0.1:9090'}),
+        'app2': (os.path.join(CODES, 'service-discovery', 'app2'), 'app', ['--http', '/ping'], {}),
+        'worker-inventory': (saga_app, 'worker_inventory.app', ['--saga-task'], {}),
+        'worker-combined': (saga_app, 'worker_combined.app', ['--saga-task'], {}),
+    }
+
+
+def _probe(directory, module, first_call, env, importtime=False):
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + [STARTUP_PROBE, module] + first_call
+    env = dict(os.environ, METRICS_EMF_INTERVAL='0', PYTHONPATH=CODES, **env)
+    started = time.time()
+    process = subprocess.run(command, cwd=directory, env=env, capture_output=True, text=True, timeout=120)
+    if process.returncode != 0:
+        raise RuntimeError('{} failed to start:\n{}'.format(module, process.stderr[-2000:]))
+    result = json.loads(process.stdout.splitlines()[-1])
+    # From starting the interpreter to the end of the first call, what a health check waits for.
+    result['ready_ms'] = round((result.pop('ready_at') - started) * 1000, 1)
+    return result, process.stderr
+
+
+def _heaviest_imports(importtime, module, count=5):
+    '''The imports of `module` that took longest, in ms, from the output of python -X importtime.'''
+    # "import time:  self [us] | cumulative | name", two more spaces before the name per level.
+    # A module is listed after everything it imported.
+    children = {}
+    for line in importtime.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imported = children.pop(depth + 1, [])
+        if name.strip() == module:
+            imported.sort(key=lambda child: -child[1])
+            return {child: round(us / 1000, 1) for child, us in imported[:count]}
+        if not module.startswith(name.strip() + '.'):
+            children.setdefault(depth, []).append((name.strip(), int(cumulative)))
+    return {}
+
+
+def startup(options):
+    '''
+    Import time, first request, message or task, and idle memory of every
+    service, each started in a fresh interpreter like a new task. The
+    median of --startup-runs runs, and the heaviest imports of one more
+    run under python -X importtime, which slows it down a little.
+    '''
+    results = {}
+    for service, (directory, module, first_call, env) in _startup_services().items():
+        runs = [_probe(directory, module, first_call, env)[0] for _ in range(options.startup_runs)]
+        result = {name: round(statistics.median(run[name] for run in runs), 1) for name in runs[0]}
+        result['first_call'] = ' '.join(first_call)
+        _, importtime = _probe(directory, module, first_call, env, importtime=True)
+        result['heaviest_imports_ms'] = _heaviest_imports(importtime, module)
+        results[service] = result
+    return results
+
+
+def _installed(module):
+    try:
+        importlib.import_module(module)
+    except ImportError:
+        return False
+    return True
+
+
+SCENARIOS = {
+    'http': http,
+    'pubsub': pubsub,
+    'discovery': discovery,
+    'saga': saga,
+    'codec': codec,
+    'startup': startup,
+}
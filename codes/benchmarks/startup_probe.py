@@ -0,0 +1,96 @@
+'''
+Starts one service the way its container does and reports how long it
+took to be useful. Run by the startup scenario in a fresh interpreter,
+from the directory of the service, with codes/ on the path for the shared
+modules:
+
+    cd codes/hello-copilot
+    PYTHONPATH=.. python3 ../benchmarks/startup_probe.py app --http /
+
+Prints one JSON line: the time to import the module, the time of the
+first request, message or task, and the resident memory once idle.
+'''
+import argparse
+import json
+import os
+import resource
+import sys
+import time
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # Linux reports the peak in KB, macOS in bytes.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def first_request(module, path):
+    # The health check of the load balancer, through the whole Flask stack.
+    response = module.app.test_client().get(path)
+    if response.status_code >= 500:
+        raise RuntimeError('GET {} returned {}'.format(path, response.status_code))
+
+
+def first_message(module):
+    # The consumer builds its SQS client before the first receive.
+    module.sqs_client()
+    module.handle_message({'MessageId': 'startup-probe', 'ReceiptHandle': 'startup-probe', 'Body': 'Hello!'})
+
+
+def first_task(module):
+    from saga_worker import saga
+    from saga_worker.local import LocalStepFunctions
+    from saga_worker.runtime import AWS_REGION, WorkerRuntime
+
+    # Every poller builds its Step Functions client before the first poll.
+    WorkerRuntime(AWS_REGION)._boto3_client()
+    sfn = LocalStepFunctions()
+    activity_name = next(iter(saga.handlers))
+    saga.handle_task(activity_name, sfn, {'taskToken': sfn.create_task().token, 'input': '{"order_id": 1}'})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the start-up of one service.')
+    parser.add_argument('module', help='module that the container runs, e.g. "app" or "worker_inventory.app"')
+    first = parser.add_mutually_exclusive_group(required=True)
+    first.add_argument('--http', metavar='PATH', help='send GET PATH to the Flask app of the module')
+    first.add_argument('--sqs-message', action='store_true', help='handle one message like the subscriber')
+    first.add_argument('--saga-task', action='store_true', help='handle one task like a saga worker')
+    parser.add_argument('--idle', type=float, default=0.5,
+                        help='seconds to wait after the first call before reading the memory')
+    options = parser.parse_args()
+
+    sys.path.insert(0, os.getcwd())
+    started = time.perf_counter()
+    # __import__ rather than importlib.import_module, whose top module python -X importtime leaves out.
+    __import__(options.module)
+    module = sys.modules[options.module]
+    imported = time.perf_counter()
+    if options.http:
+        first_request(module, options.http)
+    elif options.sqs_message:
+        first_message(module)
+    else:
+        first_task(module)
+    ready = time.perf_counter()
+    ready_at = time.time()
+    # Lets the threads started on first use settle, as between two health checks.
+    time.sleep(options.idle)
+    print(json.dumps({
+        'import_ms': round((imported - started) * 1000, 1),
+        'first_call_ms': round((ready - imported) * 1000, 1),
+        # Wall clock, for the caller to work out the time since it started the process.
+        'ready_at': ready_at,
+        'rss_mb': round(rss_mb(), 1),
+    }))
+
+
+if __name__ == '__main__':
+    main()
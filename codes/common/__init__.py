@@ -0,0 +1,4 @@
+'''
+Modules shared by the services. Every Dockerfile is built with the root of
+the repository as its build context and copies this package next to the app.
+'''
@@ -0,0 +1,269 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from common.codec import FORMATS, decode
+
+# Payloads whose JSON is larger than this many bytes are stored and sent as a reference.
+# Step Functions and SNS both cap a payload at 256 KB.
+CLAIM_CHECK_THRESHOLD = int(os.getenv("CLAIM_CHECK_THRESHOLD", "65536"))
+# Bytes of stored payloads kept in memory, so a payload is fetched once per process.
+CLAIM_CHECK_CACHE_BYTES = int(os.getenv("CLAIM_CHECK_CACHE_BYTES", "67108864"))
+
+# Field of a message that holds the reference instead of the payload.
+REFERENCE_FIELD = 'claim_check'
+# Message attribute that marks an SNS or SQS message body as a reference.
+CLAIM_CHECK_ATTRIBUTE = 'claim-check'
+
+_JSON = FORMATS['json']
+
+
+class MemoryBackend:
+    '''Objects in a dict, for runs where every service is in one process.'''
+
+    def __init__(self):
+        self._objects = {}
+
+    def put(self, key, data):
+        self._objects[key] = data
+
+    def get(self, key):
+        return self._objects[key]
+
+
+class FileBackend:
+    '''Objects as files in a directory, a stand-in for S3 on one host or a shared volume.'''
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def put(self, key, data):
+        # Write and rename, so a reader never sees half an object.
+        fd, path = tempfile.mkstemp(dir=self.root)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(path, os.path.join(self.root, key))
+
+    def get(self, key):
+        with open(os.path.join(self.root, key), 'rb') as f:
+            return f.read()
+
+
+class S3Backend:
+    '''
+    Objects in an S3 bucket under `prefix`. Keys are content hashes, so an
+    object never changes; add a lifecycle rule to expire old ones.
+    '''
+
+    def __init__(self, bucket, prefix='', region=None, client_factory=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.region = region
+        self.client_factory = client_factory or self._boto3_client
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def put(self, key, data):
+        self._get_client().put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data)
+
+    def get(self, key):
+        return self._get_client().get_object(Bucket=self.bucket, Key=self.prefix + key)['Body'].read()
+
+    def _boto3_client(self):
+        # Imported here, so a process that never stores a payload does not load boto3.
+        import boto3
+
+        return boto3.client('s3', region_name=self.region)
+
+    def _get_client(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._client = self.client_factory()
+                    self._pid = os.getpid()
+        return self._client
+
+
+class ClaimCheckPayload(MutableMapping):
+    '''
+    A payload received as a reference, used like the dict it stands for.
+    The fields that travelled with the reference are read and written
+    without fetching anything; the stored fields are fetched the first
+    time one of them is needed.
+    '''
+
+    def __init__(self, store, reference, inline):
+        self.store = store
+        self.reference = reference
+        self.inline = inline
+        self._data = None
+
+    @property
+    def loaded(self):
+        return self._data is not None
+
+    def load(self):
+        if self._data is None:
+            data = decode(self.store.get(self.reference), self.reference.get('content_type'),
+                          self.reference.get('content_encoding'))
+            data.update(self.inline)
+            self._data = data
+        return self._data
+
+    def __getitem__(self, name):
+        if self._data is None and name in self.inline:
+            return self.inline[name]
+        return self.load()[name]
+
+    def __setitem__(self, name, value):
+        # Fields set before the payload is loaded travel with the reference and override the stored ones.
+        if self._data is None:
+            self.inline[name] = value
+        else:
+            self._data[name] = value
+
+    def __delitem__(self, name):
+        del self.load()[name]
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        return len(self.load())
+
+    def __repr__(self):
+        # Logging a payload must not fetch it.
+        if self._data is None:
+            return 'ClaimCheckPayload({}, {!r})'.format(self.reference['sha256'], self.inline)
+        return repr(self._data)
+
+
+class ClaimCheckStore:
+    '''
+    Claim check for large payloads. A payload whose JSON is larger than
+    `threshold` bytes is stored once in `backend` (MemoryBackend,
+    FileBackend or S3Backend) under its SHA-256, and only a reference is
+    sent through Step Functions, SNS and SQS:
+
+        {"claim_check": {"sha256": "9f86d0...", "size": 180000},
+         "saga": {"execution_id": "..."}, "inventory_result": true}
+
+    The fields named in `inline`, and every top-level boolean, number and
+    null, are sent next to the reference, so Choice states, ResultSelectors
+    and idempotency keys can still read them.
+
+    Stored payloads are kept in an LRU of up to `cache_bytes` bytes keyed by
+    their hash, so a payload that comes through the same process again is
+    neither fetched nor stored again. They are stored as JSON, or encoded
+    with `codec`, e.g. get_codec("msgpack+zstd"), which the reference names.
+    '''
+
+    def __init__(self, backend, threshold=CLAIM_CHECK_THRESHOLD, inline=(), cache_bytes=CLAIM_CHECK_CACHE_BYTES,
+                 codec=None):
+        self.backend = backend
+        self.threshold = threshold
+        self.inline = tuple(inline)
+        self.cache_bytes = cache_bytes
+        self.codec = codec
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+
+    def put(self, data):
+        '''Stores `data` (bytes) unless it is already stored, and returns its reference.'''
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            stored = digest in self._cache
+            if stored:
+                self._cache.move_to_end(digest)
+        if not stored:
+            self.backend.put(digest, data)
+            self._remember(digest, data)
+        return {'sha256': digest, 'size': len(data)}
+
+    def get(self, reference):
+        '''Returns the bytes that `reference` stands for.'''
+        digest = reference['sha256']
+        with self._lock:
+            data = self._cache.get(digest)
+            if data is not None:
+                self._cache.move_to_end(digest)
+                return data
+        data = self.backend.get(digest)
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError('Stored payload {} does not match its hash'.format(digest))
+        self._remember(digest, data)
+        return data
+
+    def check_in(self, payload):
+        '''Returns what to send for the dict `payload`: the payload itself or a reference to it.'''
+        if isinstance(payload, ClaimCheckPayload) and not payload.loaded:
+            # The stored fields were not touched, so they are neither serialized nor stored again.
+            message = dict(payload.inline)
+            message[REFERENCE_FIELD] = payload.reference
+            if len(_JSON.dumps(message)) <= self.threshold:
+                return message
+        if isinstance(payload, ClaimCheckPayload):
+            payload = payload.load()
+        message = {}
+        stored = {}
+        for name, value in payload.items():
+            if name in self.inline or value is None or isinstance(value, (bool, int, float)):
+                message[name] = value
+            else:
+                stored[name] = value
+        # Each part is serialized once; their sum is within a few bytes of the whole payload.
+        data = _JSON.dumps(stored)
+        if len(data) + len(_JSON.dumps(message)) <= self.threshold:
+            return payload
+        if self.codec is None or self.codec.name == 'json':
+            message[REFERENCE_FIELD] = self.put(data)
+            return message
+        data, encoding = self.codec.encode(stored)
+        reference = self.put(data)
+        reference['content_type'] = self.codec.content_type
+        if encoding is not None:
+            reference['content_encoding'] = encoding
+        message[REFERENCE_FIELD] = reference
+        return message
+
+    def check_out(self, message):
+        '''Returns the payload for a received `message`, a ClaimCheckPayload if it is a reference.'''
+        if not isinstance(message, dict) or REFERENCE_FIELD not in message:
+            return message
+        inline = dict(message)
+        reference = inline.pop(REFERENCE_FIELD)
+        return ClaimCheckPayload(self, reference, inline)
+
+    def _remember(self, digest, data):
+        if len(data) > self.cache_bytes:
+            return
+        with self._lock:
+            if digest in self._cache:
+                return
+            self._cache[digest] = data
+            self._cached_bytes += len(data)
+            while self._cached_bytes > self.cache_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._cached_bytes -= len(evicted)
+
+
+def claim_check_store_from_url(url, region=None, **kwargs):
+    '''
+    "s3://bucket/prefix/", "file:///path/to/dir", "memory" for a store
+    inside this process, or "" / "none" to always send payloads inline.
+    '''
+    if not url or url == 'none':
+        return None
+    if url == 'memory':
+        return ClaimCheckStore(MemoryBackend(), **kwargs)
+    if url.startswith('file://'):
+        return ClaimCheckStore(FileBackend(url[len('file://'):]), **kwargs)
+    if url.startswith('s3://'):
+        bucket, _, prefix = url[len('s3://'):].partition('/')
+        return ClaimCheckStore(S3Backend(bucket, prefix, region=region), **kwargs)
+    raise ValueError('Unsupported claim check store: {}'.format(url))
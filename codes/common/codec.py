@@ -0,0 +1,277 @@
+import base64
+import gzip
+import json
+import os
+import threading
+from functools import lru_cache
+
+# The faster libraries are used when they are installed.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Format of the messages this service sends, with an optional compression:
+# "json", "msgpack", "json+gzip", "msgpack+zstd", ... Receivers read the
+# format from every message, so update them before the senders.
+MESSAGE_CODEC = os.getenv("MESSAGE_CODEC", "json")
+# Payloads smaller than this many bytes are sent uncompressed, whatever the codec says.
+CODEC_COMPRESS_THRESHOLD = int(os.getenv("CODEC_COMPRESS_THRESHOLD", "1024"))
+
+# Sent as the "v" parameter of the content type. Bump it when a format changes incompatibly.
+CODEC_VERSION = 1
+CONTENT_TYPE_ATTRIBUTE = 'content-type'
+CONTENT_ENCODING_ATTRIBUTE = 'content-encoding'
+
+
+class _Json:
+    name = 'json'
+    content_type = 'application/json'
+    binary = False
+
+    def dumps(self, obj):
+        if orjson is not None:
+            try:
+                return orjson.dumps(obj)
+            except TypeError:
+                # e.g. keys that are not strings, which the json module converts.
+                pass
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, data):
+        return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+class _MessagePack:
+    name = 'msgpack'
+    content_type = 'application/msgpack'
+    binary = True
+
+    def dumps(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+class _Gzip:
+    name = 'gzip'
+
+    def compress(self, data):
+        # Level 6 is about as small as 9, in half the time.
+        return gzip.compress(data, compresslevel=6)
+
+    def decompress(self, data):
+        return gzip.decompress(data)
+
+
+class _Zstd:
+    name = 'zstd'
+
+    def __init__(self):
+        # Compressor objects must not be shared between threads.
+        self._local = threading.local()
+
+    def compress(self, data):
+        if not hasattr(self._local, 'compressor'):
+            self._local.compressor = zstandard.ZstdCompressor(level=3)
+        return self._local.compressor.compress(data)
+
+    def decompress(self, data):
+        if not hasattr(self._local, 'decompressor'):
+            self._local.decompressor = zstandard.ZstdDecompressor()
+        return self._local.decompressor.decompress(data)
+
+
+FORMATS = {'json': _Json(), 'msgpack': _MessagePack()}
+COMPRESSIONS = {'gzip': _Gzip(), 'zstd': _Zstd()}
+_LIBRARIES = {'msgpack': lambda: msgpack, 'zstd': lambda: zstandard}
+
+
+def available(name):
+    '''Whether the format or compression `name` can be used in this process.'''
+    return name in ('json', 'gzip') or (name in _LIBRARIES and _LIBRARIES[name]() is not None)
+
+
+def _require(name, table):
+    if name not in table:
+        raise ValueError('Unsupported codec: {}'.format(name))
+    if not available(name):
+        raise ValueError('The {} codec needs the {} package'.format(
+            name, 'zstandard' if name == 'zstd' else name))
+    return table[name]
+
+
+class Codec:
+    '''
+    A wire format and an optional compression, named like "msgpack+zstd".
+
+    `encode()` returns the bytes and the content encoding it applied, None
+    for payloads under `compress_threshold` bytes, which are not worth
+    compressing. `content_type` carries CODEC_VERSION, so a receiver can
+    tell a format it does not know yet.
+    '''
+
+    def __init__(self, name, compress_threshold=CODEC_COMPRESS_THRESHOLD):
+        format_name, _, compression = name.partition('+')
+        self.name = name
+        self.format = _require(format_name, FORMATS)
+        self.compression = _require(compression, COMPRESSIONS) if compression else None
+        self.compress_threshold = compress_threshold
+
+    @property
+    def content_type(self):
+        return '{}; v={}'.format(self.format.content_type, CODEC_VERSION)
+
+    def encode(self, obj):
+        data = self.format.dumps(obj)
+        if self.compression is None or len(data) < self.compress_threshold:
+            return data, None
+        return self.compression.compress(data), self.compression.name
+
+    def encode_text(self, obj):
+        '''
+        Encodes `obj` for a transport that only carries text, like SNS, SQS
+        and Step Functions. Returns the text and the message attributes that
+        describe it. Binary payloads are base64 encoded.
+        '''
+        data, encoding = self.encode(obj)
+        attributes = {CONTENT_TYPE_ATTRIBUTE: self.content_type}
+        if encoding is None and not self.format.binary:
+            return data.decode('utf-8'), attributes
+        attributes[CONTENT_ENCODING_ATTRIBUTE] = encoding + '+base64' if encoding else 'base64'
+        return base64.b64encode(data).decode('ascii'), attributes
+
+
+_codecs = {}
+
+
+def get_codec(name=MESSAGE_CODEC):
+    codec = _codecs.get(name)
+    if codec is None:
+        codec = _codecs[name] = Codec(name)
+    return codec
+
+
+# Every message carries its content type, parse each one once.
+@lru_cache(maxsize=64)
+def _format_for(content_type):
+    media_type, _, params = (content_type or 'application/json').partition(';')
+    media_type = media_type.strip().lower()
+    names = [name for name, format in FORMATS.items() if format.content_type == media_type]
+    if not names:
+        raise ValueError('Unsupported content type: {}'.format(content_type))
+    for param in params.split(';'):
+        name, _, value = param.partition('=')
+        if name.strip() == 'v' and int(value) > CODEC_VERSION:
+            raise ValueError('{} is newer than version {} of this codec'.format(content_type, CODEC_VERSION))
+    return _require(names[0], FORMATS)
+
+
+def _unwrap(data, content_encoding):
+    # "zstd+base64" was compressed, then base64 encoded, so undo the last step first.
+    for encoding in reversed((content_encoding or '').split('+')):
+        if encoding == 'base64':
+            data = base64.b64decode(data)
+        elif encoding and encoding != 'identity':
+            data = _require(encoding, COMPRESSIONS).decompress(data)
+    return data
+
+
+def decode(data, content_type=None, content_encoding=None):
+    '''Decodes bytes with the format and compression named by their content type and encoding.'''
+    return _format_for(content_type).loads(_unwrap(data, content_encoding))
+
+
+def decode_text(text, attributes):
+    '''
+    The reverse of Codec.encode_text(). A message without a content type
+    is text from a sender that does not use a codec; it is returned as a
+    string, decompressed if its content encoding says so.
+    '''
+    content_encoding = attributes.get(CONTENT_ENCODING_ATTRIBUTE)
+    if CONTENT_TYPE_ATTRIBUTE not in attributes:
+        # e.g. text that the publisher gzipped because of PUBLISH_COMPRESS_THRESHOLD.
+        return _unwrap(text.encode('utf-8'), content_encoding).decode('utf-8') if content_encoding else text
+    return decode(text.encode('utf-8'), attributes[CONTENT_TYPE_ATTRIBUTE], content_encoding)
+
+
+def json_dumps(obj):
+    '''JSON text, for APIs that only take JSON such as Step Functions.'''
+    return FORMATS['json'].dumps(obj).decode('utf-8')
+
+
+def json_loads(data):
+    return FORMATS['json'].loads(data)
+
+
+def _parse_accept(header):
+    # "application/msgpack, application/json;q=0.9" -> ['application/msgpack', 'application/json']
+    choices = []
+    for position, item in enumerate((header or '').split(',')):
+        value, _, params = item.partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, number = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(number)
+                except ValueError:
+                    quality = 0.0
+        if value.strip() and quality > 0:
+            choices.append((-quality, position, value.strip().lower()))
+    return [value for _, _, value in sorted(choices)]
+
+
+def negotiate(accept=None, accept_encoding=None, formats=('msgpack', 'json'), compressions=('zstd', 'gzip')):
+    '''
+    Picks the codec for an HTTP response from the Accept and Accept-Encoding
+    headers of the request, among the `formats` and `compressions` the
+    server offers, in its order of preference. JSON is the fallback.
+    '''
+    offered = [name for name in formats if available(name)]
+    format_name = 'json'
+    for media_type in _parse_accept(accept):
+        if media_type in ('*/*', 'application/*'):
+            break
+        matches = [name for name in offered if FORMATS[name].content_type == media_type]
+        if matches:
+            format_name = matches[0]
+            break
+    accepted = _parse_accept(accept_encoding)
+    for compression in compressions:
+        if compression in accepted and available(compression):
+            return get_codec('{}+{}'.format(format_name, compression))
+    return get_codec(format_name)
+
+
+def accept_headers(name=MESSAGE_CODEC):
+    '''Accept and Accept-Encoding request headers that ask for the codec `name`, with JSON as the fallback.'''
+    codec = get_codec(name)
+    accept = codec.format.content_type
+    if codec.format.name != 'json':
+        accept += ', application/json;q=0.5'
+    headers = {'Accept': accept}
+    if codec.compression is not None:
+        headers['Accept-Encoding'] = codec.compression.name
+    return headers
+
+
+def flask_response(app, obj, status=200):
+    '''A response with `obj` in the codec the request asks for, JSON by default.'''
+    from flask import request
+
+    codec = negotiate(request.headers.get('Accept'), request.headers.get('Accept-Encoding'))
+    data, encoding = codec.encode(obj)
+    headers = {'Vary': 'Accept, Accept-Encoding'}
+    if encoding is not None:
+        headers['Content-Encoding'] = encoding
+    return app.response_class(response=data, status=status, content_type=codec.content_type, headers=headers)
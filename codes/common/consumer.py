@@ -0,0 +1,418 @@
+import logging
+import queue
+import signal
+import threading
+import time
+from common.idempotency import InProgress
+from common.logsetup import SAMPLED
+from common.metrics import registry
+
+logger = logging.getLogger()
+
+# SQS caps both receive_message and delete_message_batch at 10 entries.
+SQS_MAX_BATCH = 10
+
+receive_seconds = registry.histogram('sqs_receive_seconds',
+                                     'Time spent in receive_message, including the long poll wait')
+receives_total = registry.counter('sqs_receives_total', 'receive_message calls by result', ('result',))
+message_age_seconds = registry.histogram('sqs_message_age_seconds',
+                                         'Time between sending a message and receiving it',
+                                         buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600))
+process_seconds = registry.histogram('sqs_process_seconds', 'Time to process one message')
+messages_total = registry.counter('sqs_messages_total', 'Processed messages by outcome', ('outcome',))
+delete_seconds = registry.histogram('sqs_delete_seconds', 'Time spent in delete_message_batch')
+messages_in_flight = registry.gauge('sqs_messages_in_flight', 'Messages received and not yet processed')
+pollers_gauge = registry.gauge('sqs_pollers', 'Threads calling receive_message')
+queue_visible = registry.gauge('sqs_queue_messages_visible', 'Messages waiting in the queue', ('queue',))
+queue_not_visible = registry.gauge('sqs_queue_messages_not_visible',
+                                   'Messages received by a consumer and not yet deleted', ('queue',))
+visibility_changes_total = registry.counter('sqs_visibility_changes_total',
+                                            'Messages whose visibility timeout was changed, by action',
+                                            ('action',))
+queue_oldest_age = registry.gauge('sqs_queue_oldest_message_age_seconds',
+                                  'Age of the oldest message received since the last check', ('queue',))
+
+
+class VisibilityLeases:
+    '''
+    Keeps the messages a consumer holds invisible to other consumers, so a
+    slow message is not delivered and processed a second time.
+
+    Every `visibility_timeout / 6` seconds, the messages that would become
+    visible within half the `visibility_timeout` get another
+    `visibility_timeout` seconds, 10 per change_message_visibility_batch
+    call. A message stops being extended after `max_lease` seconds, so a
+    stuck handler cannot hold it forever.
+    '''
+
+    def __init__(self, sqs_client, queue_url, visibility_timeout=30, max_lease=3600):
+        self.sqs_client = sqs_client
+        self.queue_url = queue_url
+        self.visibility_timeout = visibility_timeout
+        self.max_lease = max_lease
+        # Receipt handle -> [message, visible until, received at], in time.monotonic().
+        self._leases = {}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def start(self):
+        self._stopping.clear()
+        threading.Thread(target=self._extend_loop, name='sqs-leases', daemon=True).start()
+
+    def stop(self):
+        self._stopping.set()
+
+    def add(self, msg):
+        now = time.monotonic()
+        with self._lock:
+            self._leases[msg['ReceiptHandle']] = [msg, now + self.visibility_timeout, now]
+
+    def remove(self, msg):
+        with self._lock:
+            self._leases.pop(msg['ReceiptHandle'], None)
+
+    def held(self):
+        with self._lock:
+            return [lease[0] for lease in self._leases.values()]
+
+    def release(self, messages):
+        '''Makes `messages` visible again right away, for another consumer to take.'''
+        for msg in messages:
+            self.remove(msg)
+        self._change_visibility(messages, 0)
+        visibility_changes_total.inc(len(messages), action='released')
+
+    def extend_due(self):
+        now = time.monotonic()
+        with self._lock:
+            due = [lease[0] for lease in self._leases.values()
+                   if lease[1] - now < self.visibility_timeout / 2 and now - lease[2] < self.max_lease]
+        extended = self._change_visibility(due, self.visibility_timeout)
+        with self._lock:
+            for msg in extended:
+                lease = self._leases.get(msg['ReceiptHandle'])
+                if lease is not None:
+                    lease[1] = now + self.visibility_timeout
+        visibility_changes_total.inc(len(extended), action='extended')
+
+    def _extend_loop(self):
+        while not self._stopping.wait(max(1, self.visibility_timeout / 6)):
+            try:
+                self.extend_due()
+            except Exception:
+                logger.exception('Could not extend the visibility timeout of messages from %s.', self.queue_url)
+
+    def _change_visibility(self, messages, visibility_timeout):
+        changed = []
+        for start in range(0, len(messages), SQS_MAX_BATCH):
+            batch = messages[start:start + SQS_MAX_BATCH]
+            entries = [{'Id': str(i), 'ReceiptHandle': msg['ReceiptHandle'], 'VisibilityTimeout': visibility_timeout}
+                       for i, msg in enumerate(batch)]
+            try:
+                response = self.sqs_client.change_message_visibility_batch(QueueUrl=self.queue_url,
+                                                                           Entries=entries)
+            except Exception:
+                logger.exception('Could not change the visibility of %d message(s) from %s.',
+                                 len(batch), self.queue_url)
+                visibility_changes_total.inc(len(batch), action='failed')
+                continue
+            for success in response.get('Successful', []):
+                changed.append(batch[int(success['Id'])])
+            for failed in response.get('Failed', []):
+                # Usually the message was deleted in the meantime.
+                msg = batch[int(failed['Id'])]
+                logger.warning('Could not change the visibility of message %s - %s.',
+                               msg.get('MessageId'), failed.get('Code'))
+                self.remove(msg)
+                visibility_changes_total.inc(action='failed')
+        return changed
+
+
+class BatchConsumer:
+    '''
+    Receives up to 10 messages per poll, processes them on a bounded pool of
+    worker threads and acknowledges them in groups with delete_message_batch.
+
+    Back-pressure: at most `concurrency + prefetch` messages are held by the
+    consumer at any time. The receivers only ask SQS for as many messages as
+    there are free slots, so a slow handler stops the polling instead of
+    piling messages up in memory.
+
+    Adaptive polling: one receiver long-polls for `wait_time` seconds, so an
+    idle queue costs about three calls a minute. After `scale_up_after`
+    receives in a row come back full, another receiver is started, up to
+    `max_pollers`. An extra receiver stops again as soon as it gets an
+    empty response.
+
+    Every `monitor_interval` seconds the consumer also records the depth of
+    the queue and the age of the oldest message it received since the last
+    check, as signals to scale the number of consumers on.
+
+    Messages are received with a `visibility_timeout` that VisibilityLeases
+    keeps extending until they are deleted. `run_forever` stops on SIGTERM:
+    the consumer stops receiving, returns the messages it has not started on
+    to the queue, and gives the ones in progress up to `shutdown_timeout`
+    seconds to finish before releasing them too.
+
+    A handler that raises InProgress, because another delivery of the
+    message is being processed, leaves it on the queue without acknowledging
+    it; that is counted as outcome "in_progress", not as a failure.
+    '''
+
+    def __init__(self, sqs_client, queue_url, handler, concurrency=4,
+                 prefetch=10, wait_time=20, ack_interval=1.0, max_pollers=4,
+                 scale_up_after=3, monitor_interval=60, visibility_timeout=30,
+                 shutdown_timeout=25):
+        self.sqs_client = sqs_client
+        self.queue_url = queue_url
+        self.handler = handler
+        self.concurrency = concurrency
+        self.wait_time = wait_time
+        self.ack_interval = ack_interval
+        self.max_pollers = max_pollers
+        self.scale_up_after = scale_up_after
+        self.monitor_interval = monitor_interval
+        self.visibility_timeout = visibility_timeout
+        self.shutdown_timeout = shutdown_timeout
+        self.leases = VisibilityLeases(sqs_client, queue_url, visibility_timeout)
+        # The queue name keeps the label short, e.g. "copilot-pubsub-test-sub-ping".
+        self.queue_name = queue_url.rstrip('/').rsplit('/', 1)[-1]
+
+        self._slots = threading.BoundedSemaphore(concurrency + prefetch)
+        self._messages = queue.Queue()
+        self._acks = queue.Queue()
+        self._stopping = threading.Event()
+        self._shutdown = threading.Event()
+        self._threads = []
+        self._pollers = []
+        self._pollers_lock = threading.Lock()
+        self._oldest_age = 0
+        self._oldest_age_lock = threading.Lock()
+
+    def start(self):
+        self.leases.start()
+        self._add_poller()
+        self._threads = []
+        for i in range(self.concurrency):
+            self._threads.append(threading.Thread(target=self._worker_loop,
+                                                  name='sqs-worker-{}'.format(i), daemon=True))
+        self._ack_thread = threading.Thread(target=self._ack_loop,
+                                            name='sqs-acker', daemon=True)
+        for thread in self._threads:
+            thread.start()
+        self._ack_thread.start()
+        if self.monitor_interval > 0:
+            threading.Thread(target=self._monitor_loop, name='sqs-monitor', daemon=True).start()
+
+    def stop(self, timeout=None):
+        '''
+        Stop polling, put the messages that no worker has started on back on
+        the queue, let the workers finish the others and flush the remaining
+        acknowledgements. With a `timeout`, the messages that are still being
+        processed after that many seconds are put back on the queue as well.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self._stopping.set()
+        # A receiver in a long poll releases what it gets once the poll returns.
+        unstarted = []
+        while True:
+            try:
+                msg = self._messages.get_nowait()
+            except queue.Empty:
+                break
+            unstarted.append(msg)
+            messages_in_flight.dec()
+            self._slots.release()
+        if unstarted:
+            logger.info('Returning %d unstarted message(s) to the queue.', len(unstarted))
+            self.leases.release(unstarted)
+        for _ in range(self.concurrency):
+            self._messages.put(None)
+        for thread in self._threads:
+            thread.join(self._remaining(deadline))
+        self._acks.put(None)
+        self._ack_thread.join(self._remaining(deadline))
+        unfinished = self.leases.held()
+        if unfinished:
+            logger.warning('Returning %d unfinished message(s) to the queue.', len(unfinished))
+            self.leases.release(unfinished)
+        self.leases.stop()
+
+    def run_forever(self):
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+        self.start()
+        self._shutdown.wait()
+        self.stop(self.shutdown_timeout)
+        logger.info('Consumer stopped.')
+
+    def _on_signal(self, signum, frame):
+        logger.info('Received signal %s, shutting down.', signum)
+        self._shutdown.set()
+
+    def _remaining(self, deadline):
+        return None if deadline is None else max(0, deadline - time.monotonic())
+
+    def _acquire_slots(self):
+        # Block for the first slot, then take whatever else is free right now.
+        while not self._slots.acquire(timeout=1):
+            if self._stopping.is_set():
+                return 0
+        taken = 1
+        while taken < SQS_MAX_BATCH and self._slots.acquire(blocking=False):
+            taken += 1
+        return taken
+
+    def _release_slots(self, count):
+        for _ in range(count):
+            self._slots.release()
+
+    def _add_poller(self):
+        with self._pollers_lock:
+            if self._stopping.is_set() or len(self._pollers) >= self.max_pollers:
+                return
+            thread = threading.Thread(target=self._receive_loop, args=(not self._pollers,),
+                                      name='sqs-receiver-{}'.format(len(self._pollers)), daemon=True)
+            self._pollers.append(thread)
+            pollers_gauge.set(len(self._pollers))
+        thread.start()
+
+    def _remove_poller(self):
+        with self._pollers_lock:
+            self._pollers.remove(threading.current_thread())
+            pollers_gauge.set(len(self._pollers))
+
+    def _receive_loop(self, primary):
+        full_receives = 0
+        while not self._stopping.is_set():
+            slots = self._acquire_slots()
+            if not slots:
+                break
+            started = time.monotonic()
+            try:
+                response = self.sqs_client.receive_message(QueueUrl=self.queue_url,
+                                                           WaitTimeSeconds=self.wait_time,
+                                                           MaxNumberOfMessages=slots,
+                                                           VisibilityTimeout=self.visibility_timeout,
+                                                           AttributeNames=['SentTimestamp'])
+            except Exception:
+                logger.exception('Could not receive the message from the - %s.', self.queue_url)
+                receives_total.inc(result='error')
+                self._release_slots(slots)
+                time.sleep(1)
+                continue
+            receive_seconds.observe(time.monotonic() - started)
+            messages = response.get('Messages', [])
+            receives_total.inc(result='messages' if messages else 'empty')
+            if self._stopping.is_set():
+                self._release_slots(slots)
+                if messages:
+                    self.leases.release(messages)
+                break
+            self._release_slots(slots - len(messages))
+            now_ms = time.time() * 1000
+            for msg in messages:
+                sent_timestamp = msg.get('Attributes', {}).get('SentTimestamp')
+                if sent_timestamp:
+                    age = max(0, now_ms - int(sent_timestamp)) / 1000
+                    message_age_seconds.observe(age)
+                    with self._oldest_age_lock:
+                        self._oldest_age = max(self._oldest_age, age)
+                self.leases.add(msg)
+                messages_in_flight.inc()
+                self._messages.put(msg)
+            if not messages and not primary:
+                # The burst is over, leave the polling to the primary receiver.
+                self._remove_poller()
+                return
+            # A full batch means more messages are waiting than one receiver fetches.
+            full_receives = full_receives + 1 if len(messages) == SQS_MAX_BATCH else 0
+            if full_receives >= self.scale_up_after:
+                full_receives = 0
+                self._add_poller()
+
+    def _monitor_loop(self):
+        while not self._stopping.wait(self.monitor_interval):
+            try:
+                attributes = self.sqs_client.get_queue_attributes(
+                    QueueUrl=self.queue_url,
+                    AttributeNames=['ApproximateNumberOfMessages', 'ApproximateNumberOfMessagesNotVisible']
+                )['Attributes']
+            except Exception:
+                logger.exception('Could not get the attributes of %s.', self.queue_url)
+                continue
+            queue_visible.set(int(attributes['ApproximateNumberOfMessages']), queue=self.queue_name)
+            queue_not_visible.set(int(attributes['ApproximateNumberOfMessagesNotVisible']),
+                                  queue=self.queue_name)
+            # SQS only reports the oldest age as a CloudWatch metric, so use what was received.
+            with self._oldest_age_lock:
+                oldest_age, self._oldest_age = self._oldest_age, 0
+            queue_oldest_age.set(oldest_age, queue=self.queue_name)
+
+    def _worker_loop(self):
+        while True:
+            msg = self._messages.get()
+            if msg is None:
+                return
+            started = time.monotonic()
+            try:
+                self.handler(msg)
+            except InProgress:
+                # Another delivery of the message holds its idempotency claim. Leave this copy on the
+                # queue: it comes back after the visibility timeout if the other one fails.
+                logger.info('Message %s is already being processed, leaving it on the queue.',
+                            msg.get('MessageId'), extra=SAMPLED)
+                self.leases.remove(msg)
+                messages_total.inc(outcome='in_progress')
+            except Exception:
+                # Leave the message on the queue, it comes back after the visibility timeout.
+                logger.exception('Failed to process message %s.', msg.get('MessageId'))
+                self.leases.remove(msg)
+                messages_total.inc(outcome='failure')
+            else:
+                messages_total.inc(outcome='success')
+                self._acks.put(msg)
+            finally:
+                process_seconds.observe(time.monotonic() - started)
+                messages_in_flight.dec()
+                self._slots.release()
+
+    def _ack_loop(self):
+        pending = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                msg = self._acks.get(timeout=timeout)
+            except queue.Empty:
+                msg = False
+            if msg:
+                pending.append(msg)
+                if deadline is None:
+                    deadline = time.monotonic() + self.ack_interval
+            if pending and (msg is None or msg is False or len(pending) >= SQS_MAX_BATCH):
+                self._delete_batch(pending)
+                pending = []
+                deadline = None
+            if msg is None:
+                return
+
+    def _delete_batch(self, messages):
+        entries = [{'Id': str(i), 'ReceiptHandle': msg['ReceiptHandle']}
+                   for i, msg in enumerate(messages)]
+        try:
+            with delete_seconds.time():
+                response = self.sqs_client.delete_message_batch(QueueUrl=self.queue_url,
+                                                                Entries=entries)
+        except Exception:
+            logger.exception('Could not delete the messages from the - %s.', self.queue_url)
+            return
+        finally:
+            # Deleted, or processed and left to come back: either way no longer held.
+            for msg in messages:
+                self.leases.remove(msg)
+        for failed in response.get('Failed', []):
+            logger.error('Could not delete message %s - %s.',
+                         messages[int(failed['Id'])].get('MessageId'), failed.get('Message'))
+        logger.info('Deleted %d message(s) from %s.', len(response.get('Successful', [])), self.queue_url,
+                    extra=SAMPLED)
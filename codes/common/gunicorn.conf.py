@@ -0,0 +1,61 @@
+# Gunicorn settings of every Flask service, passed with --config by the Dockerfiles.
+# The number of workers follows the CPU and memory of the task, which are the
+# `cpu` and `memory` fields of the Copilot manifest.
+import importlib.util
+import json
+import logging
+import math
+import os
+import urllib.request
+
+# Worker classes that need a package which not every service installs.
+WORKER_CLASS_PACKAGES = {"gevent": "gevent", "eventlet": "eventlet"}
+
+
+def task_limits():
+    # The ECS task metadata endpoint reports the task limits, CPU in vCPU and memory in MiB.
+    metadata_uri = os.getenv("ECS_CONTAINER_METADATA_URI_V4")
+    if metadata_uri:
+        try:
+            with urllib.request.urlopen("{}/task".format(metadata_uri), timeout=1) as response:
+                limits = json.loads(response.read()).get("Limits", {})
+            return float(limits.get("CPU") or 0), float(limits.get("Memory") or 0)
+        except Exception:
+            pass
+    return float(os.cpu_count() or 1), 0.0
+
+
+def worker_count():
+    if os.getenv("WEB_CONCURRENCY"):
+        return int(os.getenv("WEB_CONCURRENCY"))
+    cpu, memory = task_limits()
+    # 2 workers per vCPU plus one, but a fraction of a vCPU only gets one.
+    workers = 2 * math.floor(cpu) + 1 if cpu >= 1 else 1
+    if memory:
+        workers = min(workers, int(memory // int(os.getenv("WEB_WORKER_MEMORY_MB", "128"))))
+    return max(1, workers)
+
+
+def worker_class_name():
+    name = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+    package = WORKER_CLASS_PACKAGES.get(name)
+    if package and importlib.util.find_spec(package) is None:
+        # Only some services have gevent in their requirements, the others keep serving with threads.
+        logging.getLogger().warning("GUNICORN_WORKER_CLASS=%s needs the %s package, using gthread.", name, package)
+        return "gthread"
+    return name
+
+
+bind = "0.0.0.0:9090"
+workers = worker_count()
+# "gthread" runs a thread pool in every worker. "gevent" is the async variant:
+# handlers waiting on the network yield to other requests instead of holding a thread.
+worker_class = worker_class_name()
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "100"))
+# Longer than the 60 second idle timeout of the load balancer.
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "75"))
+# "true" imports the app once in the master and forks the workers from it, so
+# they start serving without importing anything and share the imported modules'
+# memory. The apps start their threads and clients in each worker on first use.
+preload_app = os.getenv("GUNICORN_PRELOAD", "false").lower() == "true"
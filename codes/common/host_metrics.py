@@ -0,0 +1,60 @@
+import hashlib
+import json
+import os
+import platform
+import socket
+import threading
+import time
+import psutil
+
+# Seconds the first CPU sample of a process is measured over. cpu_percent(interval=None)
+# compares with the previous call, so it has nothing to compare with the first time.
+FIRST_SAMPLE_SECONDS = 0.1
+
+
+class HostMetrics:
+    '''
+    Host facts for the hello page. Hostname and platform never change, so
+    they are read once. CPU and memory usage are sampled by a background
+    thread every `interval` seconds, and requests only read the latest
+    snapshot, however many dashboards poll the task.
+    '''
+
+    def __init__(self, interval=5):
+        self.interval = interval
+        self.static = {
+            'hostname': socket.gethostname(),
+            'machine': platform.machine(),
+            'system': platform.system(),
+        }
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def snapshot(self):
+        '''Returns the latest sample and its ETag.'''
+        self._ensure_started()
+        return self._snapshot
+
+    def _ensure_started(self):
+        # Each gunicorn worker is a forked process and needs its own collector.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._collect(psutil.cpu_percent(interval=FIRST_SAMPLE_SECONDS))
+                threading.Thread(target=self._collect_loop, name='host-metrics', daemon=True).start()
+                self._pid = os.getpid()
+
+    def _collect_loop(self):
+        while True:
+            time.sleep(self.interval)
+            self._collect()
+
+    def _collect(self, cpu_usage=None):
+        data = dict(self.static)
+        # Since the previous sample.
+        data['cpu_usage'] = psutil.cpu_percent(interval=None) if cpu_usage is None else cpu_usage
+        data['virtual_memory'] = psutil.virtual_memory().percent
+        etag = hashlib.md5(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+        self._snapshot = (data, etag)
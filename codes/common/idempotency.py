@@ -0,0 +1,291 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from botocore.exceptions import ClientError
+
+PENDING = 'pending'
+DONE = 'done'
+
+logger = logging.getLogger()
+
+# `acquired` is True for the caller that has to do the work. Otherwise `status`
+# tells whether the key is done, with its `result`, or still in progress elsewhere.
+Claim = namedtuple('Claim', 'acquired status result')
+
+
+class InProgress(Exception):
+    '''Another consumer is processing the same key right now.'''
+
+
+class SQLiteBackend:
+    '''
+    Persistent tier in a SQLite file. Every process on the host that opens
+    the same file shares the records, and it stands in for DynamoDB locally.
+    '''
+
+    def __init__(self, path, cleanup_every=1000):
+        self.path = path
+        self.cleanup_every = cleanup_every
+        self._local = threading.local()
+        self._claims = 0
+        self._connect().execute('CREATE TABLE IF NOT EXISTS idempotency ('
+                                'key TEXT PRIMARY KEY, status TEXT NOT NULL, result TEXT, '
+                                'lease_until REAL, expires_at REAL)')
+
+    def claim(self, key, lease_until, expires_at):
+        conn = self._connect()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT status, result, lease_until, expires_at FROM idempotency WHERE key = ?',
+                               (key,)).fetchone()
+            if row is not None and row[3] >= now and (row[0] == DONE or row[2] >= now):
+                conn.execute('COMMIT')
+                return False, {'status': row[0], 'result': json.loads(row[1]) if row[1] is not None else None}
+            conn.execute('INSERT OR REPLACE INTO idempotency VALUES (?, ?, NULL, ?, ?)',
+                         (key, PENDING, lease_until, expires_at))
+            self._claims += 1
+            if self._claims % self.cleanup_every == 0:
+                conn.execute('DELETE FROM idempotency WHERE expires_at < ?', (now,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return True, None
+
+    def complete(self, key, result, expires_at):
+        self._connect().execute('INSERT OR REPLACE INTO idempotency VALUES (?, ?, ?, NULL, ?)',
+                                (key, DONE, json.dumps(result), expires_at))
+
+    def renew(self, key, lease_until):
+        self._connect().execute('UPDATE idempotency SET lease_until = ? WHERE key = ? AND status = ?',
+                                (lease_until, key, PENDING))
+
+    def release(self, key):
+        self._connect().execute('DELETE FROM idempotency WHERE key = ? AND status = ?', (key, PENDING))
+
+    def _connect(self):
+        # sqlite3 connections must stay in the thread, and the process, that opened them.
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self._local.conn.execute('PRAGMA journal_mode=WAL')
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+
+class DynamoDBBackend:
+    '''
+    Persistent tier in a DynamoDB table with a string partition key "key".
+    Claims are conditional writes, so exactly one consumer wins a key even
+    across tasks. Turn on TTL on the "expires_at" attribute to expire the
+    records.
+    '''
+
+    def __init__(self, table_name, region=None, client_factory=None):
+        self.table_name = table_name
+        self.region = region
+        self.client_factory = client_factory or self._boto3_client
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def claim(self, key, lease_until, expires_at):
+        client = self._get_client()
+        try:
+            client.put_item(
+                TableName=self.table_name,
+                Item={'key': key, 'status': PENDING, 'lease_until': int(lease_until),
+                      'expires_at': int(expires_at)},
+                # New key, expired record, or a claim whose owner has not finished in time.
+                ConditionExpression='attribute_not_exists(#key) OR expires_at < :now '
+                                    'OR (#status = :pending AND lease_until < :now)',
+                ExpressionAttributeNames={'#key': 'key', '#status': 'status'},
+                ExpressionAttributeValues={':now': int(time.time()), ':pending': PENDING})
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            item = client.get_item(TableName=self.table_name, Key={'key': key},
+                                   ConsistentRead=True).get('Item')
+            if item is None:
+                # Released in the meantime, the next delivery claims it.
+                return False, {'status': PENDING, 'result': None}
+            result = json.loads(item['result']) if 'result' in item else None
+            return False, {'status': item['status'], 'result': result}
+        return True, None
+
+    def complete(self, key, result, expires_at):
+        self._get_client().put_item(
+            TableName=self.table_name,
+            Item={'key': key, 'status': DONE, 'result': json.dumps(result), 'expires_at': int(expires_at)})
+
+    def renew(self, key, lease_until):
+        try:
+            self._get_client().update_item(
+                TableName=self.table_name, Key={'key': key},
+                UpdateExpression='SET lease_until = :lease_until',
+                ConditionExpression='#status = :pending',
+                ExpressionAttributeNames={'#status': 'status'},
+                ExpressionAttributeValues={':lease_until': int(lease_until), ':pending': PENDING})
+        except ClientError as e:
+            # Completed, released or expired in the meantime, there is no lease left to extend.
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+
+    def release(self, key):
+        try:
+            self._get_client().delete_item(
+                TableName=self.table_name, Key={'key': key},
+                ConditionExpression='#status = :pending',
+                ExpressionAttributeNames={'#status': 'status'},
+                ExpressionAttributeValues={':pending': PENDING})
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+
+    def _boto3_client(self):
+        # Imported here, so a process that only uses the memory or SQLite store does not load boto3.
+        import boto3
+
+        # The resource's client accepts plain Python values instead of typed attributes.
+        return boto3.resource('dynamodb', region_name=self.region).meta.client
+
+    def _get_client(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._client = self.client_factory()
+                    self._pid = os.getpid()
+        return self._client
+
+
+class IdempotencyStore:
+    '''
+    Remembers which messages or steps have been processed, so a redelivery
+    is answered from the first result instead of doing the work again.
+
+    Completed keys are kept in an in-process LRU of `max_entries` in front
+    of an optional persistent `backend` (SQLiteBackend or DynamoDBBackend).
+    Without a backend only redeliveries to the same process are caught.
+
+    A claim is a lease: if its owner neither completes nor releases the key
+    within `lease` seconds, e.g. because the task was killed, the next
+    delivery takes it over. Work that can take longer calls renew() while
+    it runs, e.g. with every heartbeat. Records are forgotten after `ttl`
+    seconds.
+    '''
+
+    def __init__(self, backend=None, max_entries=10000, ttl=86400, lease=60, poll_interval=1.0):
+        self.backend = backend
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def run(self, key, func, wait=False):
+        '''
+        Calls `func()` unless `key` was already processed, and returns the
+        result and whether it was a duplicate. The result must be JSON
+        serializable. If `func()` raises, the key is released so the next
+        delivery retries it. A key that is in progress elsewhere raises
+        InProgress, or with `wait` is polled until it is done or its lease
+        runs out.
+        '''
+        while True:
+            try:
+                claim = self.claim(key)
+            except Exception:
+                # The store only saves work, an unavailable backend must not stop processing.
+                logger.exception('Could not claim {}, processing it anyway.'.format(key))
+                return func(), False
+            if claim.acquired:
+                break
+            if claim.status == DONE:
+                return claim.result, True
+            if not wait:
+                raise InProgress(key)
+            time.sleep(self.poll_interval)
+        try:
+            result = func()
+        except BaseException:
+            self._release(key)
+            raise
+        self._complete(key, result)
+        return result, False
+
+    def claim(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if entry[0] == DONE:
+                    return Claim(False, DONE, entry[1])
+            if self.backend is None:
+                if entry is not None and entry[2] > now:
+                    return Claim(False, PENDING, None)
+                self._remember(key, PENDING, None, now + self.lease)
+                return Claim(True, PENDING, None)
+        acquired, record = self.backend.claim(key, now + self.lease, now + self.ttl)
+        if acquired:
+            return Claim(True, PENDING, None)
+        if record['status'] == DONE:
+            with self._lock:
+                self._remember(key, DONE, record['result'], None)
+        return Claim(False, record['status'], record['result'])
+
+    def renew(self, key):
+        '''Extends the lease on a claimed `key` to `lease` seconds from now.'''
+        lease_until = time.time() + self.lease
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == PENDING:
+                self._entries[key] = (PENDING, None, lease_until)
+        if self.backend is not None:
+            self.backend.renew(key, lease_until)
+
+    def _complete(self, key, result):
+        with self._lock:
+            self._remember(key, DONE, result, None)
+        if self.backend is not None:
+            try:
+                self.backend.complete(key, result, time.time() + self.ttl)
+            except Exception:
+                logger.exception('Could not record {} as done.'.format(key))
+
+    def _release(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+        if self.backend is not None:
+            try:
+                self.backend.release(key)
+            except Exception:
+                # The lease runs out and the key is claimed again anyway.
+                logger.exception('Could not release {}.'.format(key))
+
+    def _remember(self, key, status, result, lease_until):
+        self._entries[key] = (status, result, lease_until)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+def idempotency_store_from_url(url, region=None, **kwargs):
+    '''
+    "memory" for the in-process LRU only, "sqlite:///path/to/file.db",
+    "dynamodb://table-name", or "" / "none" to turn deduplication off.
+    '''
+    if not url or url == 'none':
+        return None
+    if url == 'memory':
+        return IdempotencyStore(**kwargs)
+    if url.startswith('sqlite://'):
+        return IdempotencyStore(SQLiteBackend(url[len('sqlite://'):]), **kwargs)
+    if url.startswith('dynamodb://'):
+        return IdempotencyStore(DynamoDBBackend(url[len('dynamodb://'):], region=region), **kwargs)
+    raise ValueError('Unsupported idempotency store: {}'.format(url))
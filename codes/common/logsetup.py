@@ -0,0 +1,175 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+# DEBUG, INFO, WARNING or ERROR.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# "json" for one JSON object per line, which CloudWatch Logs Insights can query, or "text".
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+# Share of the per-message logs that are written, e.g. 0.01 for one in a hundred.
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1"))
+# Most records per second for each level below ERROR, 0 for no limit. Errors are never limited.
+LOG_RATE_LIMIT = float(os.getenv("LOG_RATE_LIMIT", "100"))
+# Records waiting for the writer thread. When it is full, records below ERROR are dropped.
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+TEXT_FORMAT = '%(asctime)s: %(levelname)s: %(message)s'
+
+# Pass as `extra` to the logs written for every message or task, so that LOG_SAMPLE_RATE applies:
+#     logger.info('The message body: %s', body, extra=SAMPLED)
+SAMPLED = {'sampled': True}
+
+# Everything else on a record came from `extra` and is written as a field of its own.
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'sampled'}
+
+
+class JsonFormatter(logging.Formatter):
+    '''One JSON object per record, with the fields passed in `extra` next to the message.'''
+
+    def format(self, record):
+        entry = {
+            'timestamp': '{}.{:03d}Z'.format(time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)),
+                                             int(record.msecs)),
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        if record.name != 'root':
+            entry['logger'] = record.name
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRIBUTES:
+                entry[name] = value
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    '''
+    Keeps `sample_rate` of the records logged with `extra=SAMPLED`, and at
+    most `rate_limit` records per second for each level below ERROR. The
+    next record of a level that gets through has the number of records the
+    limit dropped in its "suppressed" field.
+    '''
+
+    def __init__(self, sample_rate=LOG_SAMPLE_RATE, rate_limit=LOG_RATE_LIMIT):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.rate_limit = rate_limit
+        # Token bucket per level: (tokens, last refill).
+        self._buckets = {}
+        self._suppressed = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+        if getattr(record, 'sampled', False) and self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return False
+        if self.rate_limit <= 0:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            tokens, refilled = self._buckets.get(record.levelno, (self.rate_limit, now))
+            tokens = min(self.rate_limit, tokens + (now - refilled) * self.rate_limit)
+            if tokens < 1:
+                self._buckets[record.levelno] = (tokens, now)
+                self._suppressed[record.levelno] = self._suppressed.get(record.levelno, 0) + 1
+                return False
+            self._buckets[record.levelno] = (tokens - 1, now)
+            suppressed = self._suppressed.pop(record.levelno, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class AsyncHandler(QueueHandler):
+    '''
+    Puts records on a bounded queue for a writer thread that formats and
+    writes them with `target`, so the thread that logs never waits for I/O.
+    The writer thread is started on first use in every process, because a
+    forked gunicorn worker does not inherit it.
+    '''
+
+    def __init__(self, target, queue_size=LOG_QUEUE_SIZE):
+        super().__init__(queue.Queue(queue_size))
+        self.target = target
+        self._dropped = 0
+        self._listener = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def prepare(self, record):
+        # The arguments can change once the caller moves on, so merge them now.
+        # Only records that passed the filters get this far.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self.target.formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        self._ensure_listener()
+        with self._lock:
+            dropped, self._dropped = self._dropped, 0
+        if dropped:
+            record.dropped = dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if record.levelno >= logging.ERROR:
+                try:
+                    self.queue.put(record, timeout=1)
+                    return
+                except queue.Full:
+                    pass
+            with self._lock:
+                self._dropped += dropped + 1
+
+    def stop(self):
+        if self._listener is not None and self._pid == os.getpid():
+            self._listener.stop()
+            self._listener = None
+            self._pid = None
+
+    def _ensure_listener(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                # Records queued by the parent before the fork are written by the parent.
+                self.queue = queue.Queue(self.queue.maxsize)
+                self._listener = QueueListener(self.queue, self.target)
+                self._listener.start()
+                self._pid = os.getpid()
+                atexit.register(self.stop)
+
+
+def setup_logging(level=LOG_LEVEL, fmt=LOG_FORMAT, stream=None, force=False):
+    '''
+    Configures the root logger: records go through a SamplingFilter to an
+    AsyncHandler that writes them to `stream` (stderr by default) as JSON
+    or text. Like logging.basicConfig, does nothing if the root logger
+    already has handlers, unless `force` is set.
+    '''
+    root = logging.getLogger()
+    if root.handlers and not force:
+        return None
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    target = logging.StreamHandler(stream)
+    target.setFormatter(JsonFormatter() if fmt == 'json' else logging.Formatter(TEXT_FORMAT))
+    handler = AsyncHandler(target)
+    handler.addFilter(SamplingFilter())
+    root.addHandler(handler)
+    root.setLevel(level)
+    return handler
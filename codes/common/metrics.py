@@ -0,0 +1,352 @@
+import atexit
+import bisect
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# CloudWatch namespace of the EMF metrics.
+METRICS_NAMESPACE = os.getenv("METRICS_NAMESPACE", "copilot-rocks")
+# Seconds between Embedded Metric Format lines on stdout, 0 turns them off.
+METRICS_EMF_INTERVAL = float(os.getenv("METRICS_EMF_INTERVAL", "60"))
+# Copilot sets this in every service; it becomes the "Service" dimension.
+SERVICE_NAME = os.getenv("COPILOT_SERVICE_NAME", "local")
+# "true" also answers GET /metrics of the Flask apps through the load balancer, i.e. on the internet.
+METRICS_PUBLIC = os.getenv("METRICS_PUBLIC", "false").lower() == "true"
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# EMF accepts at most 100 values per metric in one line.
+EMF_MAX_VALUES = 100
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+
+class _Metric:
+    type = None
+    unit = 'None'
+
+    def __init__(self, registry, name, help, labels):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError('{} takes the labels {}'.format(self.name, self.label_names))
+        return tuple((name, labels[name]) for name in self.label_names)
+
+    def _prometheus(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.type)]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append('{}{} {}'.format(self.name, _format_labels(key), value))
+        return lines
+
+
+class Counter(_Metric):
+    type = 'counter'
+    unit = 'Count'
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self._reported = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.registry._ensure_reporter()
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _emf(self):
+        # CloudWatch sums data points, so send what was added since the last line.
+        with self._lock:
+            deltas = {key: value - self._reported.get(key, 0) for key, value in self._values.items()}
+            self._reported = dict(self._values)
+        return {key: delta for key, delta in deltas.items() if delta}
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        self.registry._ensure_reporter()
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.registry._ensure_reporter()
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def _emf(self):
+        with self._lock:
+            return dict(self._values)
+
+
+class _HistogramValues:
+    def __init__(self, buckets):
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        # Sample of the values since the last EMF line.
+        self.recent = []
+        self.recent_seen = 0
+
+
+class Histogram(_Metric):
+    '''
+    Cumulative buckets for Prometheus, plus a sample of up to 100 values
+    since the last EMF line, from which CloudWatch computes percentiles.
+    '''
+    type = 'histogram'
+    unit = 'Seconds'
+
+    def __init__(self, registry, name, help, labels, buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        self.registry._ensure_reporter()
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = _HistogramValues(self.buckets)
+            values.counts[bisect.bisect_left(self.buckets, value)] += 1
+            values.sum += value
+            values.count += 1
+            values.recent_seen += 1
+            if len(values.recent) < EMF_MAX_VALUES:
+                values.recent.append(value)
+            else:
+                # Reservoir sampling keeps the sample representative of the whole interval.
+                index = random.randrange(values.recent_seen)
+                if index < EMF_MAX_VALUES:
+                    values.recent[index] = value
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def _prometheus(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            for key, values in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), values.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(float(bound))
+                    lines.append('{}_bucket{} {}'.format(self.name, _format_labels(key, [('le', le)]), cumulative))
+                lines.append('{}_sum{} {}'.format(self.name, _format_labels(key), values.sum))
+                lines.append('{}_count{} {}'.format(self.name, _format_labels(key), values.count))
+        return lines
+
+    def _emf(self):
+        with self._lock:
+            samples = {}
+            for key, values in self._values.items():
+                if values.recent:
+                    samples[key] = values.recent
+                values.recent = []
+                values.recent_seen = 0
+        return samples
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.histogram.observe(time.monotonic() - self.started, **self.labels)
+        return False
+
+
+class MetricsRegistry:
+    '''
+    Counters, gauges and histograms for one process, exposed two ways:
+
+    - `prometheus_text()` renders them in the Prometheus text format, for a
+      /metrics endpoint.
+    - Every `emf_interval` seconds a background thread prints them to stdout
+      as CloudWatch Embedded Metric Format lines. Copilot sends stdout to
+      CloudWatch Logs, which turns those lines into metrics without an agent.
+
+    Metrics are per process: under gunicorn every worker reports its own.
+    '''
+
+    def __init__(self, namespace=METRICS_NAMESPACE, service=SERVICE_NAME,
+                 emf_interval=METRICS_EMF_INTERVAL, stream=None):
+        self.namespace = namespace
+        self.service = service
+        self.emf_interval = emf_interval
+        self.stream = stream
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=()):
+        return self._register(Gauge, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, help, labels, buckets)
+
+    def prometheus_text(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric._prometheus())
+        return '\n'.join(lines) + '\n'
+
+    def emf_lines(self):
+        '''One EMF document per set of label values, with every metric that has data for it.'''
+        with self._lock:
+            metrics = list(self._metrics.values())
+        documents = {}
+        for metric in metrics:
+            for key, value in metric._emf().items():
+                document = documents.get(key)
+                if document is None:
+                    document = documents[key] = {'metrics': [], 'values': {}}
+                document['metrics'].append({'Name': metric.name, 'Unit': metric.unit})
+                document['values'][metric.name] = value
+        timestamp = int(time.time() * 1000)
+        lines = []
+        for key, document in documents.items():
+            line = {
+                '_aws': {
+                    'Timestamp': timestamp,
+                    'CloudWatchMetrics': [{
+                        'Namespace': self.namespace,
+                        'Dimensions': [['Service'] + [name for name, _ in key]],
+                        'Metrics': document['metrics'],
+                    }],
+                },
+                'Service': self.service,
+            }
+            line.update((name, str(value)) for name, value in key)
+            line.update(document['values'])
+            lines.append(json.dumps(line))
+        return lines
+
+    def flush(self):
+        stream = self.stream or sys.stdout
+        lines = self.emf_lines()
+        if lines:
+            stream.write('\n'.join(lines) + '\n')
+            stream.flush()
+
+    def _register(self, cls, name, help, labels, *args):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(self, name, help, labels, *args)
+            return self._metrics[name]
+
+    def _ensure_reporter(self):
+        # Each gunicorn worker is a forked process and needs its own reporter.
+        if self._pid == os.getpid() or self.emf_interval <= 0:
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._report_loop, name='metrics-emf', daemon=True).start()
+                atexit.register(self.flush)
+
+    def _report_loop(self):
+        while True:
+            time.sleep(self.emf_interval)
+            try:
+                self.flush()
+            except Exception:
+                # Never let reporting take the service down, try again next interval.
+                pass
+
+
+def serve_metrics(port, registry):
+    '''Serves `registry` in the Prometheus text format on `port`, for processes without a web server.'''
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.prometheus_text().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('0.0.0.0', port), Handler)
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
+
+
+def instrument_flask(app, registry, public=METRICS_PUBLIC):
+    '''
+    Records the latency and in-flight count of every request, and adds GET
+    /metrics. Unless `public` is set, /metrics answers 404 to requests that
+    came through the load balancer, which adds X-Forwarded-For, so only a
+    scraper that reaches the task directly inside the VPC can read it.
+    '''
+    from flask import Response, g, request
+
+    request_seconds = registry.histogram('http_request_seconds', 'Time to handle a request',
+                                         ('method', 'route', 'status'))
+    in_flight = registry.gauge('http_requests_in_flight', 'Requests being handled')
+
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.monotonic()
+        in_flight.inc()
+
+    @app.after_request
+    def record_request(response):
+        # The route template, not the path, keeps the number of label values small.
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        request_seconds.observe(time.monotonic() - g.metrics_started, method=request.method,
+                                route=route, status=str(response.status_code))
+        return response
+
+    @app.teardown_request
+    def end_request(exc):
+        if 'metrics_started' in g:
+            in_flight.dec()
+
+    def metrics_endpoint():
+        if not public and 'X-Forwarded-For' in request.headers:
+            return Response('Not Found', status=404, mimetype='text/plain')
+        return Response(registry.prometheus_text(), mimetype='text/plain; version=0.0.4')
+
+    app.add_url_rule('/metrics', 'metrics', metrics_endpoint)
+
+
+# Shared by everything in this process.
+registry = MetricsRegistry()
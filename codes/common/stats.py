@@ -0,0 +1,10 @@
+def percentiles(values, points=(50, 90, 99)):
+    '''Nearest-rank percentiles of `values` in seconds, reported in milliseconds with the max and mean.'''
+    values = sorted(values)
+    if not values:
+        return {}
+    summary = {'p{}'.format(p): round(values[min(len(values) - 1, int(len(values) * p / 100))] * 1000, 3)
+               for p in points}
+    summary['max'] = round(values[-1] * 1000, 3)
+    summary['mean'] = round(sum(values) / len(values) * 1000, 3)
+    return summary
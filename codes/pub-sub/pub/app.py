@@ -1,32 +1,84 @@
-from flask import Flask, request, jsonify, make_response
-import boto3
+from flask import Blueprint, Flask, request, jsonify, make_response
 import os
 import json
+import queue
 import random, string
+from common.claimcheck import claim_check_store_from_url
+from common.logsetup import setup_logging
+from common.metrics import instrument_flask, registry
+from publisher import BatchPublisher
 
 def generate_random(char_length):
    characters = string.ascii_lowercase
    return ''.join(random.choice(characters) for i in range(char_length))
 
+setup_logging()
+
 AWS_REGION='ap-southeast-1'
 TOPIC_ARNS = json.loads(os.getenv("COPILOT_SNS_TOPIC_ARNS"))
-client = boto3.client('sns', region_name=AWS_REGION)
-app = Flask(__name__)
+# Wait for SNS to accept every message before responding, instead of returning
+# as soon as the message is buffered. Can also be requested per call with ?confirm=true.
+PUBLISH_CONFIRM = os.getenv("PUBLISH_CONFIRM", "false").lower() == "true"
+PUBLISH_CONFIRM_TIMEOUT = float(os.getenv("PUBLISH_CONFIRM_TIMEOUT", "5"))
+# Where messages larger than CLAIM_CHECK_THRESHOLD are stored and sent as a reference:
+# "s3://bucket/prefix/", "file:///path/to/dir", or "none" to always send them whole.
+CLAIM_CHECK_STORE = os.getenv("CLAIM_CHECK_STORE", "none")
+
+
+def sns_client():
+    # boto3 takes a while to import, so it is loaded by the first publish, not at start-up.
+    import boto3
+
+    return boto3.client('sns', region_name=AWS_REGION)
+
 
-@app.route('/')
+publisher = BatchPublisher(None, TOPIC_ARNS["ping"],
+                           max_queue=int(os.getenv("PUBLISH_MAX_QUEUE", "1000")),
+                           linger=float(os.getenv("PUBLISH_LINGER_MS", "50")) / 1000,
+                           compress_threshold=int(os.getenv("PUBLISH_COMPRESS_THRESHOLD", "0")),
+                           claim_check=claim_check_store_from_url(CLAIM_CHECK_STORE, region=AWS_REGION),
+                           client_factory=sns_client)
+routes = Blueprint('pub', __name__)
+
+@routes.route('/')
 def hello_world():
     ping_message = "Hello! Message sent: {}".format(generate_random(5))
-    response = client.publish(
-        TopicArn=TOPIC_ARNS["ping"],
-        Message=ping_message
-            )
+    try:
+        # Encoded with MESSAGE_CODEC, the sub service reads the codec from the message attributes.
+        future = publisher.publish({"message": ping_message})
+    except queue.Full:
+        # Back-pressure: the buffer is full, let the client retry later.
+        message = jsonify(error="Too many messages in flight, try again later")
+        return make_response(message, 503)
+    if PUBLISH_CONFIRM or request.args.get("confirm") == "true":
+        try:
+            future.result(timeout=PUBLISH_CONFIRM_TIMEOUT)
+        except Exception:
+            message = jsonify(error="Could not publish the message")
+            return make_response(message, 502)
     message = jsonify(message=ping_message)
     return make_response(message, 200)
 
-@app.route('/ping')
+@routes.route('/ping')
 def pong():
     message = jsonify(message="Pong")
     return make_response(message, 200)
 
+
+def create_app():
+    '''
+    Builds the app without starting a thread or opening a connection, so
+    gunicorn can import it once before forking the workers
+    (GUNICORN_PRELOAD=true). Each worker starts its publisher on the first
+    message.
+    '''
+    app = Flask(__name__)
+    instrument_flask(app, registry)
+    app.register_blueprint(routes)
+    return app
+
+
+app = create_app()
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=9090)
@@ -0,0 +1,195 @@
+import atexit
+import base64
+import gzip
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from common.claimcheck import CLAIM_CHECK_ATTRIBUTE, REFERENCE_FIELD
+from common.codec import CONTENT_ENCODING_ATTRIBUTE, get_codec
+from common.metrics import registry
+
+logger = logging.getLogger()
+
+# SNS caps publish_batch at 10 entries and 256 KB for the whole request, which
+# is also the largest message. Message attributes count towards both.
+SNS_MAX_BATCH = 10
+SNS_MAX_BATCH_BYTES = 256 * 1024
+
+publish_batch_seconds = registry.histogram('sns_publish_batch_seconds', 'Time spent in publish_batch')
+batch_size = registry.histogram('sns_batch_size', 'Messages per publish_batch call',
+                                buckets=(1, 2, 5, 10))
+buffered_seconds = registry.histogram('sns_buffered_seconds',
+                                      'Time between publish() and the end of its publish_batch call')
+messages_total = registry.counter('sns_messages_total', 'Published messages by outcome', ('outcome',))
+messages_buffered = registry.gauge('sns_messages_buffered', 'Messages waiting to be published')
+
+
+def entry_bytes(entry):
+    '''Bytes SNS counts for a publish_batch entry: the message and the name, type and value of its attributes.'''
+    size = len(entry['Message'].encode('utf-8'))
+    for name, attribute in entry.get('MessageAttributes', {}).items():
+        size += len(name.encode('utf-8')) + len(attribute['DataType'].encode('utf-8'))
+        size += len(attribute['StringValue'].encode('utf-8'))
+    return size
+
+
+class BatchPublisher:
+    '''
+    Buffers messages in memory and publishes them with publish_batch from a
+    background thread.
+
+    A batch is sent when it has 10 entries, when it would exceed the SNS
+    request size, or `linger` seconds after its first message. The buffer is
+    bounded: `publish()` waits up to `enqueue_timeout` seconds for room and
+    raises queue.Full after that, so callers can shed load. A message that
+    SNS would not accept, at more than 256 KB with its attributes, raises
+    ValueError right away.
+
+    A message that is not a string is encoded with `codec` (MESSAGE_CODEC by
+    default), and carries `content-type` and `content-encoding` message
+    attributes. A string is sent as it is, except that strings larger than
+    `compress_threshold` bytes are gzipped and base64 encoded (0 disables
+    compression). With a `claim_check` store, messages larger than its
+    threshold are stored there instead, and the message is a reference to
+    them with a `claim-check` attribute.
+
+    `publish()` returns a Future that resolves to the SNS MessageId once the
+    batch containing the message has been accepted by SNS.
+
+    With a `client_factory`, `sns_client` may be None: the flusher thread
+    of every process builds its own client before sending its first batch,
+    so neither building the publisher nor the first `publish()` waits for it.
+    '''
+
+    def __init__(self, sns_client, topic_arn, max_queue=1000, linger=0.05,
+                 enqueue_timeout=1.0, compress_threshold=0, claim_check=None, codec=None, client_factory=None):
+        self.sns_client = sns_client
+        self.client_factory = client_factory
+        self.topic_arn = topic_arn
+        self.linger = linger
+        self.enqueue_timeout = enqueue_timeout
+        self.compress_threshold = compress_threshold
+        self.claim_check = claim_check
+        self.codec = codec or get_codec()
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+
+    def publish(self, message):
+        self._ensure_started()
+        entry = self._entry(message)
+        size = entry_bytes(entry)
+        if size > SNS_MAX_BATCH_BYTES:
+            messages_total.inc(outcome='too_large')
+            raise ValueError('Message is {} bytes with its attributes, SNS accepts at most {}'.format(
+                size, SNS_MAX_BATCH_BYTES))
+        future = Future()
+        future.enqueued_at = time.monotonic()
+        future.entry_bytes = size
+        try:
+            self._queue.put((entry, future), timeout=self.enqueue_timeout)
+        except queue.Full:
+            messages_total.inc(outcome='rejected')
+            raise
+        messages_buffered.inc()
+        return future
+
+    def flush(self):
+        '''Publish everything that is buffered and stop the flusher thread.'''
+        if self._thread is not None and self._pid == os.getpid():
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _ensure_started(self):
+        # The thread does not survive a fork, e.g. gunicorn --preload.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                if self.client_factory is not None:
+                    # A client built before a fork is not used in the child.
+                    self.sns_client = None
+                self._thread = threading.Thread(target=self._flush_loop,
+                                                name='sns-publisher', daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+                atexit.register(self.flush)
+
+    def _entry(self, message):
+        attributes = {}
+        if not isinstance(message, str):
+            message, attributes = self.codec.encode_text(message)
+        elif self.compress_threshold and len(message.encode('utf-8')) > self.compress_threshold:
+            message = base64.b64encode(gzip.compress(message.encode('utf-8'))).decode('ascii')
+            attributes[CONTENT_ENCODING_ATTRIBUTE] = 'gzip+base64'
+        if self.claim_check is not None and len(message.encode('utf-8')) > self.claim_check.threshold:
+            # The message is stored as it would have been sent, so the other attributes still describe it.
+            reference = self.claim_check.put(message.encode('utf-8'))
+            message = json.dumps({REFERENCE_FIELD: reference})
+            attributes[CLAIM_CHECK_ATTRIBUTE] = reference['sha256']
+        entry = {'Id': uuid.uuid4().hex, 'Message': message}
+        if attributes:
+            entry['MessageAttributes'] = {name: {'DataType': 'String', 'StringValue': value}
+                                          for name, value in attributes.items()}
+        return entry
+
+    def _flush_loop(self):
+        batch = []
+        batch_bytes = 0
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+            if item:
+                size = item[1].entry_bytes
+                if batch and batch_bytes + size > SNS_MAX_BATCH_BYTES:
+                    self._publish_batch(batch)
+                    batch, batch_bytes, deadline = [], 0, None
+                batch.append(item)
+                batch_bytes += size
+                if deadline is None:
+                    deadline = time.monotonic() + self.linger
+            if batch and (not item or len(batch) >= SNS_MAX_BATCH):
+                self._publish_batch(batch)
+                batch, batch_bytes, deadline = [], 0, None
+            if item is None:
+                return
+
+    def _publish_batch(self, batch):
+        futures = {entry['Id']: future for entry, future in batch}
+        messages_buffered.dec(len(batch))
+        batch_size.observe(len(batch))
+        try:
+            if self.sns_client is None:
+                self.sns_client = self.client_factory()
+            with publish_batch_seconds.time():
+                response = self.sns_client.publish_batch(
+                    TopicArn=self.topic_arn,
+                    PublishBatchRequestEntries=[entry for entry, _ in batch]
+                )
+        except Exception as e:
+            logger.exception('Could not publish %d message(s) to %s.', len(batch), self.topic_arn)
+            messages_total.inc(len(batch), outcome='failure')
+            for future in futures.values():
+                future.set_exception(e)
+            return
+        now = time.monotonic()
+        for future in futures.values():
+            buffered_seconds.observe(now - future.enqueued_at)
+        messages_total.inc(len(response.get('Successful', [])), outcome='success')
+        messages_total.inc(len(response.get('Failed', [])), outcome='failure')
+        for success in response.get('Successful', []):
+            futures[success['Id']].set_result(success['MessageId'])
+        for failed in response.get('Failed', []):
+            logger.error('Could not publish message %s - %s.', failed['Id'], failed.get('Message'))
+            futures[failed['Id']].set_exception(RuntimeError(failed.get('Message')))
@@ -1,24 +1,64 @@
 import logging
-import boto3
 import os
 from botocore.exceptions import ClientError
 import json
+from common.claimcheck import CLAIM_CHECK_ATTRIBUTE, REFERENCE_FIELD, claim_check_store_from_url
+from common.codec import decode_text
+from common.consumer import BatchConsumer
+from common.idempotency import InProgress, idempotency_store_from_url
+from common.logsetup import SAMPLED, setup_logging
+from common.metrics import registry, serve_metrics
 
 AWS_REGION = 'ap-southeast-1'
 COPILOT_QUEUE_URI = os.getenv("COPILOT_QUEUE_URI")
+# "batch" runs the concurrent BatchConsumer, "single" keeps the one-by-one loop.
+CONSUMER_MODE = os.getenv("CONSUMER_MODE", "batch")
+CONSUMER_CONCURRENCY = int(os.getenv("CONSUMER_CONCURRENCY", "4"))
+CONSUMER_PREFETCH = int(os.getenv("CONSUMER_PREFETCH", "10"))
+# Long poll for up to 20 seconds, the SQS maximum, so an idle queue costs few calls.
+CONSUMER_WAIT_TIME = int(os.getenv("CONSUMER_WAIT_TIME", "20"))
+# Receivers added while receive_message keeps returning full batches.
+CONSUMER_MAX_POLLERS = int(os.getenv("CONSUMER_MAX_POLLERS", "4"))
+# Seconds between records of the queue depth, 0 turns them off.
+QUEUE_MONITOR_INTERVAL = float(os.getenv("QUEUE_MONITOR_INTERVAL", "60"))
+# Received messages stay invisible for this long, and are extended while they are processed.
+CONSUMER_VISIBILITY_TIMEOUT = int(os.getenv("CONSUMER_VISIBILITY_TIMEOUT", "30"))
+# ECS sends SIGKILL 30 seconds after SIGTERM by default.
+CONSUMER_SHUTDOWN_TIMEOUT = float(os.getenv("CONSUMER_SHUTDOWN_TIMEOUT", "25"))
+# Where processed message IDs are remembered: "memory", "sqlite:///path/to/file.db",
+# "dynamodb://table-name", or "none" to process every delivery.
+IDEMPOTENCY_STORE = os.getenv("IDEMPOTENCY_STORE", "memory")
+# Where the publisher stores large messages: "s3://bucket/prefix/", "file:///path/to/dir",
+# or "none" if it always sends them whole.
+CLAIM_CHECK_STORE = os.getenv("CLAIM_CHECK_STORE", "none")
+# Port for Prometheus to scrape /metrics from, empty to only write EMF lines.
+METRICS_PORT = os.getenv("METRICS_PORT", "")
 logger = logging.getLogger()
-logging.basicConfig(level=logging.INFO,
-                    format='%(asctime)s: %(levelname)s: %(message)s')
+setup_logging()
 
-sqs_client = boto3.client("sqs", region_name=AWS_REGION)
+_sqs_client = None
+idempotency = idempotency_store_from_url(IDEMPOTENCY_STORE, region=AWS_REGION)
+claim_check = claim_check_store_from_url(CLAIM_CHECK_STORE, region=AWS_REGION)
+duplicates_total = registry.counter('sqs_duplicate_messages_total',
+                                    'Redelivered messages that were acknowledged without processing')
+
+
+def sqs_client():
+    # Built on first use: boto3 takes a while to import, and nothing before the first receive needs it.
+    global _sqs_client
+    if _sqs_client is None:
+        import boto3
+
+        _sqs_client = boto3.client("sqs", region_name=AWS_REGION)
+    return _sqs_client
 
 
 def receive_queue_message():
     try:
-        response = sqs_client.receive_message(QueueUrl=COPILOT_QUEUE_URI, WaitTimeSeconds=5, MaxNumberOfMessages=1)
+        response = sqs_client().receive_message(QueueUrl=COPILOT_QUEUE_URI, WaitTimeSeconds=CONSUMER_WAIT_TIME,
+                                                MaxNumberOfMessages=1)
     except ClientError:
-        logger.exception('Could not receive the message from the - {}.'.format(
-            COPILOT_QUEUE_URI))
+        logger.exception('Could not receive the message from the - %s.', COPILOT_QUEUE_URI)
         raise
     else:
         return response
@@ -26,27 +66,99 @@ def receive_queue_message():
 
 def delete_queue_message(receipt_handle):
     try:
-        response = sqs_client.delete_message(QueueUrl=COPILOT_QUEUE_URI,
-                                             ReceiptHandle=receipt_handle)
+        response = sqs_client().delete_message(QueueUrl=COPILOT_QUEUE_URI,
+                                               ReceiptHandle=receipt_handle)
     except ClientError:
-        logger.exception('Could not delete the meessage from the - {}.'.format(
-            COPILOT_QUEUE_URI))
+        logger.exception('Could not delete the meessage from the - %s.', COPILOT_QUEUE_URI)
         raise
     else:
         return response
 
 
-if __name__ == '__main__':
+def decode_body(msg):
+    '''
+    The message as the publisher passed it to publish(): a string, or the
+    object it encoded with the codec named in the message attributes.
+    '''
+    # SNS wraps the message in a JSON envelope, unless raw message delivery is on.
+    # The publisher stores large messages and sends a reference marked with a claim-check attribute.
+    try:
+        envelope = json.loads(msg['Body'])
+    except ValueError:
+        return msg['Body']
+    if not isinstance(envelope, dict) or 'Message' not in envelope:
+        return msg['Body']
+    attributes = {name: attribute.get('Value') for name, attribute in envelope.get('MessageAttributes', {}).items()}
+    text = envelope['Message']
+    if CLAIM_CHECK_ATTRIBUTE in attributes:
+        if claim_check is None:
+            raise ValueError('Message {} is a claim check, set CLAIM_CHECK_STORE'.format(envelope.get('MessageId')))
+        text = claim_check.get(json.loads(text)[REFERENCE_FIELD]).decode('utf-8')
+    return decode_text(text, attributes)
+
+
+def message_id(msg):
+    # SNS may deliver the same notification as a new SQS message, so prefer its MessageId.
+    try:
+        envelope = json.loads(msg['Body'])
+    except ValueError:
+        return msg['MessageId']
+    if isinstance(envelope, dict) and 'MessageId' in envelope:
+        return envelope['MessageId']
+    return msg['MessageId']
+
+
+def process_message(msg):
+    logger.info('The message body: %s', decode_body(msg), extra=SAMPLED)
+
+
+def handle_message(msg):
+    if idempotency is None:
+        process_message(msg)
+        return
+    # Raises InProgress while another delivery is being processed, which BatchConsumer leaves on the queue.
+    _, duplicate = idempotency.run(message_id(msg), lambda: process_message(msg))
+    if duplicate:
+        duplicates_total.inc()
+        logger.info('Message %s was already processed, acknowledging it.', message_id(msg), extra=SAMPLED)
+
+
+def run_single():
     while True:
         messages = receive_queue_message()
-        print(messages)
-        
-        if "Messages" in messages: 
+        logger.debug('Received %s', messages)
+
+        if "Messages" in messages:
             for msg in messages['Messages']:
-                msg_body = msg['Body']
-                receipt_handle = msg['ReceiptHandle']
-                logger.info(f'The message body: {msg_body}')
-                logger.info('Deleting message from the queue...')
-                resp_delete = delete_queue_message(receipt_handle)
-            logger.info(
-                'Received and deleted message(s) from {} with message {}.'.format(COPILOT_QUEUE_URI,resp_delete))
+                # Decoded and deduplicated like in the batch mode; a message that is not
+                # acknowledged comes back after the visibility timeout.
+                try:
+                    handle_message(msg)
+                except InProgress:
+                    logger.info('Message %s is already being processed, leaving it on the queue.',
+                                message_id(msg), extra=SAMPLED)
+                    continue
+                except Exception:
+                    logger.exception('Failed to process message %s.', msg.get('MessageId'))
+                    continue
+                logger.debug('Deleting message from the queue...')
+                resp_delete = delete_queue_message(msg['ReceiptHandle'])
+                logger.info('Received and deleted message(s) from %s with message %s.',
+                            COPILOT_QUEUE_URI, resp_delete, extra=SAMPLED)
+
+
+if __name__ == '__main__':
+    if METRICS_PORT:
+        serve_metrics(int(METRICS_PORT), registry)
+    if CONSUMER_MODE == "single":
+        run_single()
+    else:
+        consumer = BatchConsumer(sqs_client(), COPILOT_QUEUE_URI, handle_message,
+                                 concurrency=CONSUMER_CONCURRENCY,
+                                 prefetch=CONSUMER_PREFETCH,
+                                 wait_time=CONSUMER_WAIT_TIME,
+                                 max_pollers=CONSUMER_MAX_POLLERS,
+                                 monitor_interval=QUEUE_MONITOR_INTERVAL,
+                                 visibility_timeout=CONSUMER_VISIBILITY_TIMEOUT,
+                                 shutdown_timeout=CONSUMER_SHUTDOWN_TIMEOUT)
+        consumer.run_forever()
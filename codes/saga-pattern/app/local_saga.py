@@ -0,0 +1,121 @@
+'''
+Runs the saga state machine locally, with the real worker handlers polling
+an in-memory Step Functions, and prints latency and throughput as JSON:
+
+    cd codes/saga-pattern/app
+    python3 local_saga.py --executions 1000 --concurrency 50 --slots 8
+
+--mode parallel reserves inventory and payment at the same time, like
+`cdk synth -c saga_mode=parallel`. --template reads the definition from a
+synthesized CdkStack template (cdk.out/copilot-saga-pattern.template.json)
+instead of the built-in copy. --payload-kb adds that many KB of order
+items to every execution, and --claim-check (e.g. "memory" or
+"file:///tmp/claims") sends them through the state machine as a reference.
+--dispatch sqs sends every step to an in-memory queue with a task token,
+like `cdk synth -c saga_dispatch=sqs`, and the workers consume the queues.
+'''
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# EMF lines on stdout would end up in the JSON results.
+os.environ.setdefault('METRICS_EMF_INTERVAL', '0')
+logging.basicConfig(level=logging.WARNING,
+                    format='%(asctime)s: %(levelname)s: %(message)s')
+# The shared modules of codes/common, which the worker containers copy next to saga_worker.
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from common.claimcheck import claim_check_store_from_url
+from saga_worker import saga
+from saga_worker.definition import (DISPATCH_MODES, INLINE_FIELDS, LOCAL_ARN_PREFIX, SAGA_MODES,
+                                    load_synthesized_definition, local_resource, saga_definition)
+from saga_worker.local import LocalSQS, LocalStateMachine, LocalStepFunctions, summarize
+
+# Importing the workers registers their handlers on the shared `saga` registry.
+import worker_inventory.app
+import worker_inventory_rollback.app
+import worker_payment.app
+import worker_payment_rollback.app
+import worker_logistic.app
+import worker_logistic_rollback.app
+
+
+def order(order_id, payload_kb=0):
+    # About 100 bytes per item, different for every order like real ones.
+    items = [{"sku": "SKU-{}-{}".format(order_id, n), "quantity": 1, "description": "x" * 64}
+             for n in range(payload_kb * 1024 // 100)]
+    return {"order_id": order_id, "items": items} if items else {"order_id": order_id}
+
+
+def run(executions, concurrency, slots, template=None, time_scale=0.01, arns=None, mode='sequential',
+        task_latency=0.0, payload_kb=0, claim_check=None, dispatch='activity', sqs=None):
+    sfn = LocalStepFunctions(poll_timeout=0.1, latency=task_latency)
+    resource = local_resource
+    queues = None
+    if dispatch == 'sqs':
+        # `sqs` may be another stand-in with the same calls, e.g. the one of the benchmarks.
+        sqs = sqs or LocalSQS(poll_timeout=0.1)
+        queues = {activity_name: sqs.create_queue(QueueName='saga-' + activity_name)['QueueUrl']
+                  for activity_name in saga.handlers}
+        resource = queues.__getitem__
+    if template:
+        definition = load_synthesized_definition(template, resource)
+    else:
+        definition = saga_definition(resource, mode, dispatch)
+    if arns is None:
+        arns = {activity_name: LOCAL_ARN_PREFIX + activity_name for activity_name in saga.handlers}
+    previous_claim_check = saga.claim_check
+    if claim_check is not None:
+        saga.claim_check = claim_check_store_from_url(claim_check, inline=INLINE_FIELDS)
+    store = saga.claim_check
+    runtime = saga.runtime(arns=arns, slots=slots, dispatch=dispatch, queues=queues,
+                           client_factory=lambda: sfn, sqs_client_factory=lambda: sqs)
+    runtime.start()
+    machine = LocalStateMachine(definition, sfn, time_scale=time_scale, sqs=sqs)
+
+    def execute(order_id):
+        # Whoever starts the execution checks the order in, like the workers do with their output.
+        payload = order(order_id, payload_kb)
+        return machine.execute(payload if store is None else store.check_in(payload))
+
+    started = time.monotonic()
+    try:
+        with ThreadPoolExecutor(concurrency) as executor:
+            results = list(executor.map(execute, range(executions)))
+    finally:
+        runtime.stop()
+        runtime.join(timeout=5)
+        saga.claim_check = previous_claim_check
+    return summarize(results, time.monotonic() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the saga locally and report step latencies.')
+    parser.add_argument('--executions', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='executions in flight at the same time')
+    parser.add_argument('--slots', type=int, default=4, help='pollers per activity, as WORKER_SLOTS')
+    parser.add_argument('--mode', choices=SAGA_MODES, default='sequential',
+                        help='topology of the built-in definition')
+    parser.add_argument('--dispatch', choices=DISPATCH_MODES, default='activity',
+                        help='how the steps reach the workers, as the saga_dispatch of CdkStack')
+    parser.add_argument('--template', help='synthesized CloudFormation template to read the definition from')
+    parser.add_argument('--task-latency-ms', type=float, default=0,
+                        help='added to every task, for the Step Functions round trip')
+    parser.add_argument('--payload-kb', type=int, default=0, help='KB of order items in every execution')
+    parser.add_argument('--claim-check', help='claim check store for large payloads, e.g. "memory"')
+    parser.add_argument('--time-scale', type=float, default=0.01,
+                        help='multiplier for retry intervals and Wait states')
+    args = parser.parse_args()
+    print(json.dumps(run(args.executions, args.concurrency, args.slots, args.template, args.time_scale,
+                         mode=args.mode, task_latency=args.task_latency_ms / 1000,
+                         payload_kb=args.payload_kb, claim_check=args.claim_check, dispatch=args.dispatch),
+                     indent=2))
+
+
+if __name__ == '__main__':
+    main()
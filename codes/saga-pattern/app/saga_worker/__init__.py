@@ -0,0 +1,6 @@
+from saga_worker.config import ActivityArns, activity_arns
+from saga_worker.heartbeat import Heartbeat
+from saga_worker.runtime import WorkerRuntime
+from saga_worker.worker import SagaWorker, saga
+
+__all__ = ["ActivityArns", "activity_arns", "Heartbeat", "WorkerRuntime", "SagaWorker", "saga"]
@@ -0,0 +1,157 @@
+import logging
+import os
+import json
+import random
+import threading
+import time
+from saga_worker.runtime import AWS_REGION
+
+ACTIVITY_ARNS_PARAMETER = 'copilot-saga-pattern-activity-arns'
+# Seconds before the cached ARNs are refreshed from SSM in the background.
+ACTIVITY_ARNS_TTL = float(os.getenv("ACTIVITY_ARNS_TTL", "300"))
+# Optional file with the last known ARNs. A fresh snapshot skips SSM on start-up,
+# a stale one is used when SSM and the environment have nothing.
+ACTIVITY_ARNS_SNAPSHOT = os.getenv("ACTIVITY_ARNS_SNAPSHOT", "")
+# Optional JSON with the same shape as the SSM parameter, used when SSM fails.
+ACTIVITY_ARNS = os.getenv("ACTIVITY_ARNS", "")
+
+# Queue URLs of the activities, written by CdkStack with `-c saga_dispatch=sqs`.
+ACTIVITY_QUEUES_PARAMETER = 'copilot-saga-pattern-activity-queues'
+# Same as ACTIVITY_ARNS_SNAPSHOT and ACTIVITY_ARNS, for the queue URLs.
+ACTIVITY_QUEUES_SNAPSHOT = os.getenv("ACTIVITY_QUEUES_SNAPSHOT", "")
+ACTIVITY_QUEUES = os.getenv("ACTIVITY_QUEUES", "")
+
+logger = logging.getLogger()
+
+
+class ActivityArns:
+    '''
+    Resolves the activity ARNs once and keeps them in memory.
+
+    The first `get()` loads them from a fresh snapshot, or from SSM with
+    retries and jittered exponential backoff, so that a mass scale-out does
+    not hammer SSM in lock-step. If SSM keeps failing, it falls back to the
+    ACTIVITY_ARNS environment variable and then to a stale snapshot. After
+    that a background thread refreshes the values every `ttl` seconds;
+    requests are always served from memory.
+
+    The queue URLs of the SQS dispatch are resolved the same way, from
+    another parameter with `fallback` JSON of their own.
+
+    `client_factory` builds the SSM client, by default a boto3 one.
+    '''
+
+    def __init__(self, parameter_name=ACTIVITY_ARNS_PARAMETER, region=AWS_REGION,
+                 ttl=ACTIVITY_ARNS_TTL, snapshot_path=ACTIVITY_ARNS_SNAPSHOT,
+                 retries=5, backoff=0.5, client_factory=None, fallback=ACTIVITY_ARNS):
+        self.parameter_name = parameter_name
+        self.region = region
+        self.ttl = ttl
+        self.snapshot_path = snapshot_path
+        self.fallback = fallback
+        self.retries = retries
+        self.backoff = backoff
+        self.client_factory = client_factory or self._boto3_client
+        self._value = None
+        self._lock = threading.Lock()
+        self._refresher = None
+
+    def get(self):
+        if self._value is None:
+            with self._lock:
+                if self._value is None:
+                    self._value = self._initial_load()
+                    self._start_refresher()
+        return self._value
+
+    def __getitem__(self, activity_name):
+        return self.get()[activity_name]
+
+    def _initial_load(self):
+        snapshot = self._read_snapshot(max_age=self.ttl)
+        if snapshot is not None:
+            logger.info('Loaded activity ARNs from snapshot {}.'.format(self.snapshot_path))
+            return snapshot
+        try:
+            return self._load_from_ssm()
+        except Exception:
+            logger.exception('Could not load activity ARNs from SSM parameter {}.'.format(
+                self.parameter_name))
+        if self.fallback:
+            logger.warning('Using the fallback values for {} from the environment.'.format(self.parameter_name))
+            return json.loads(self.fallback)
+        snapshot = self._read_snapshot(max_age=None)
+        if snapshot is not None:
+            logger.warning('Using stale activity ARNs from snapshot {}.'.format(self.snapshot_path))
+            return snapshot
+        raise RuntimeError('No activity ARNs available for {}.'.format(self.parameter_name))
+
+    def _load_from_ssm(self):
+        _ssm = self.client_factory()
+        for attempt in range(self.retries):
+            try:
+                value = json.loads(_ssm.get_parameter(
+                    Name=self.parameter_name)["Parameter"]["Value"])
+            except Exception:
+                if attempt == self.retries - 1:
+                    raise
+                delay = self.backoff * (2 ** attempt)
+                time.sleep(random.uniform(delay / 2, delay))
+            else:
+                self._write_snapshot(value)
+                return value
+
+    def _boto3_client(self):
+        # Imported here, so a worker started from a fresh snapshot does not load boto3 for SSM.
+        import boto3
+
+        return boto3.client('ssm', region_name=self.region)
+
+    def _start_refresher(self):
+        if self.ttl <= 0:
+            return
+        self._refresher = threading.Thread(target=self._refresh_loop,
+                                           name='activity-arns-refresh', daemon=True)
+        self._refresher.start()
+
+    def _refresh_loop(self):
+        while True:
+            # Spread the refreshes of many tasks started at the same time.
+            time.sleep(random.uniform(self.ttl * 0.8, self.ttl * 1.2))
+            try:
+                value = self._load_from_ssm()
+            except Exception:
+                logger.exception('Could not refresh activity ARNs, keeping the cached ones.')
+                continue
+            if value != self._value:
+                logger.info('Activity ARNs changed.')
+            self._value = value
+
+    def _read_snapshot(self, max_age):
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return None
+        if max_age is not None and time.time() - os.path.getmtime(self.snapshot_path) > max_age:
+            return None
+        try:
+            with open(self.snapshot_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            logger.exception('Could not read snapshot {}.'.format(self.snapshot_path))
+            return None
+
+    def _write_snapshot(self, value):
+        if not self.snapshot_path:
+            return
+        tmp_path = '{}.tmp'.format(self.snapshot_path)
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(value, f)
+            os.replace(tmp_path, self.snapshot_path)
+        except OSError:
+            logger.exception('Could not write snapshot {}.'.format(self.snapshot_path))
+
+
+# Shared by every worker in this process.
+activity_arns = ActivityArns()
+activity_queues = ActivityArns(ACTIVITY_QUEUES_PARAMETER, snapshot_path=ACTIVITY_QUEUES_SNAPSHOT,
+                               fallback=ACTIVITY_QUEUES)
@@ -0,0 +1,225 @@
+import json
+import re
+
+# Same values as the defaults of CdkStack.
+ACTIVITY_HEARTBEAT_SECONDS = 30
+ACTIVITY_TIMEOUT_SECONDS = 120
+STATE_MACHINE_TIMEOUT_SECONDS = 300
+LOCAL_ARN_PREFIX = 'activity:'
+# Error a worker fails a task with when it receives the task while shutting down, retried right away.
+WORKER_SHUTDOWN_ERROR = 'Worker.ShuttingDown'
+# "sequential" reserves inventory, then payment. "parallel" reserves both at once.
+SAGA_MODES = ('sequential', 'parallel')
+# "activity" has the workers poll the activities, "sqs" sends every step to a queue with a task token.
+DISPATCH_MODES = ('activity', 'sqs')
+SQS_CALLBACK_RESOURCE = 'arn:aws:states:::sqs:sendMessage.waitForTaskToken'
+# Objects the states read from the payload. With a claim check they are sent next to the
+# reference, as are the *_result booleans.
+INLINE_FIELDS = ('saga', 'reservation')
+
+
+def local_resource(activity_name):
+    return LOCAL_ARN_PREFIX + activity_name
+
+
+def _activity_task(activity_name, resource, next_state):
+    task = {
+        "Type": "Task",
+        "Resource": resource(activity_name),
+        "HeartbeatSeconds": ACTIVITY_HEARTBEAT_SECONDS,
+        "TimeoutSeconds": ACTIVITY_TIMEOUT_SECONDS,
+        "Retry": [{
+            "ErrorEquals": ["States.Timeout"],
+            "IntervalSeconds": 1,
+            "MaxAttempts": 2,
+            "BackoffRate": 2
+        }, {
+            "ErrorEquals": [WORKER_SHUTDOWN_ERROR],
+            "IntervalSeconds": 1,
+            "MaxAttempts": 3,
+            "BackoffRate": 2
+        }]
+    }
+    if next_state is None:
+        task["End"] = True
+    else:
+        task["Next"] = next_state
+    return task
+
+
+def _branch(activity_name, state_name, result_field, resource):
+    # A failed or timed out reservation counts as not reserved, so the other branch is still compensated.
+    task = _activity_task(activity_name, resource, None)
+    task["Catch"] = [{"ErrorEquals": ["States.ALL"], "ResultPath": "$.error", "Next": state_name + " failed"}]
+    return {
+        "StartAt": state_name,
+        "States": {
+            state_name: task,
+            state_name + " failed": {
+                "Type": "Pass",
+                "Result": False,
+                "ResultPath": "$." + result_field,
+                "End": True
+            }
+        }
+    }
+
+
+def _result_check(variable, ok_state, failed_state):
+    return {
+        "Type": "Choice",
+        "Choices": [
+            {"Variable": variable, "BooleanEquals": True, "Next": ok_state},
+            {"Variable": variable, "BooleanEquals": False, "Next": failed_state}
+        ]
+    }
+
+
+def _send_to_queues(machine, queue_url):
+    # Turns every activity task into a message to the queue of the activity, as with `saga_dispatch=sqs`.
+    for state in machine["States"].values():
+        if state["Type"] == "Parallel":
+            for branch in state["Branches"]:
+                _send_to_queues(branch, queue_url)
+        elif state["Type"] == "Task":
+            state["Parameters"] = {
+                "QueueUrl": queue_url(state["Resource"]),
+                "MessageBody": {"taskToken.$": "$$.Task.Token", "input.$": "$"}
+            }
+            state["Resource"] = SQS_CALLBACK_RESOURCE
+    return machine
+
+
+def saga_definition(resource=local_resource, mode='sequential', dispatch='activity'):
+    '''
+    The saga state machine of CdkStack in Amazon States Language, with
+    `resource(activity_name)` as the Resource of every task, in one of
+    SAGA_MODES. Keep it in step with codes/saga-pattern/cdk/app.py, or load
+    the synthesized template with load_synthesized_definition() instead.
+
+    With `dispatch` "sqs", every task sends the input and a task token to
+    the queue `resource(activity_name)` and waits for the token to come back.
+    '''
+    if dispatch == 'sqs':
+        return _send_to_queues(saga_definition(lambda activity_name: activity_name, mode), resource)
+    if dispatch != 'activity':
+        raise ValueError('Unsupported saga dispatch: {}'.format(dispatch))
+    if mode == 'parallel':
+        return _parallel_saga_definition(resource)
+    if mode != 'sequential':
+        raise ValueError('Unsupported saga mode: {}'.format(mode))
+    return {
+        "StartAt": "Start saga",
+        "TimeoutSeconds": STATE_MACHINE_TIMEOUT_SECONDS,
+        "States": {
+            "Start saga": {
+                "Type": "Pass",
+                "Parameters": {"execution_id.$": "$$.Execution.Id"},
+                "ResultPath": "$.saga",
+                "Next": "Inventory Process"
+            },
+            "Inventory Process": _activity_task("inventory-process", resource, "Inventory check ok?"),
+            "Inventory check ok?": _result_check("$.inventory_result", "Payment Process", "Cancel Inventory"),
+            "Payment Process": _activity_task("payment-process", resource, "Payment check ok?"),
+            "Payment check ok?": _result_check("$.payment_result", "Logistic Process", "Cancel Payment"),
+            "Logistic Process": _activity_task("logistic-process", resource, "Logistic check ok?"),
+            "Logistic check ok?": _result_check("$.logistic_result", "Transaction success", "Cancel Logistic"),
+            "Cancel Logistic": _activity_task("logistic-rollback", resource, "Cancel Payment"),
+            "Cancel Payment": _activity_task("payment-rollback", resource, "Cancel Inventory"),
+            "Cancel Inventory": _activity_task("inventory-rollback", resource, "Transaction failed"),
+            "Transaction success": {"Type": "Succeed"},
+            "Transaction failed": {"Type": "Fail"}
+        }
+    }
+
+
+def _parallel_saga_definition(resource):
+    # Inventory and payment are reserved in parallel. Only the reservations
+    # that succeeded are cancelled: "Cancel Payment" checks whether there is
+    # an inventory reservation to cancel as well.
+    both_reserved = [
+        {"Variable": "$.reservation.inventory_result", "BooleanEquals": True},
+        {"Variable": "$.reservation.payment_result", "BooleanEquals": True}
+    ]
+    return {
+        "StartAt": "Start saga",
+        "TimeoutSeconds": STATE_MACHINE_TIMEOUT_SECONDS,
+        "States": {
+            "Start saga": {
+                "Type": "Pass",
+                "Parameters": {"execution_id.$": "$$.Execution.Id"},
+                "ResultPath": "$.saga",
+                "Next": "Reserve Inventory and Payment"
+            },
+            "Reserve Inventory and Payment": {
+                "Type": "Parallel",
+                "Branches": [
+                    _branch("inventory-process", "Inventory Process", "inventory_result", resource),
+                    _branch("payment-process", "Payment Process", "payment_result", resource)
+                ],
+                "ResultSelector": {
+                    "inventory_result.$": "$[0].inventory_result",
+                    "payment_result.$": "$[1].payment_result"
+                },
+                "ResultPath": "$.reservation",
+                "Next": "Reservation ok?"
+            },
+            "Reservation ok?": {
+                "Type": "Choice",
+                "Choices": [
+                    {"And": both_reserved, "Next": "Logistic Process"},
+                    {"Variable": "$.reservation.inventory_result", "BooleanEquals": True,
+                     "Next": "Cancel Inventory"},
+                    {"Variable": "$.reservation.payment_result", "BooleanEquals": True,
+                     "Next": "Cancel Payment"}
+                ],
+                "Default": "Transaction failed"
+            },
+            "Logistic Process": _activity_task("logistic-process", resource, "Logistic check ok?"),
+            "Logistic check ok?": _result_check("$.logistic_result", "Transaction success", "Cancel Logistic"),
+            "Cancel Logistic": _activity_task("logistic-rollback", resource, "Cancel Payment"),
+            "Cancel Payment": _activity_task("payment-rollback", resource, "Inventory reserved?"),
+            "Inventory reserved?": {
+                "Type": "Choice",
+                "Choices": [
+                    {"Variable": "$.reservation.inventory_result", "BooleanEquals": True,
+                     "Next": "Cancel Inventory"}
+                ],
+                "Default": "Transaction failed"
+            },
+            "Cancel Inventory": _activity_task("inventory-rollback", resource, "Transaction failed"),
+            "Transaction success": {"Type": "Succeed"},
+            "Transaction failed": {"Type": "Fail"}
+        }
+    }
+
+
+def _activity_name(logical_id):
+    # "InventoryProcess7F4CA9D5" -> "inventory-process", "InventoryProcessQueue1A2B3C4D" -> the same.
+    name = re.sub(r'(?<!^)(?=[A-Z])', '-', logical_id[:-8]).lower()
+    return name[:-len('-queue')] if name.endswith('-queue') else name
+
+
+def load_synthesized_definition(template_path, resource=local_resource):
+    '''
+    Reads the state machine definition from the CloudFormation template
+    written by `cdk synth` (cdk.out/copilot-saga-pattern.template.json),
+    replacing the activity references with `resource(activity_name)`. In a
+    template synthesized with `saga_dispatch=sqs` those are the queue URLs.
+    '''
+    with open(template_path) as f:
+        resources = json.load(f)["Resources"]
+    activities = {logical_id: _activity_name(logical_id) for logical_id, value in resources.items()
+                  if value["Type"] in ("AWS::StepFunctions::Activity", "AWS::SQS::Queue")}
+    state_machine = next(value for value in resources.values()
+                         if value["Type"] == "AWS::StepFunctions::StateMachine")
+    definition = state_machine["Properties"]["DefinitionString"]
+    if isinstance(definition, dict):
+        parts = []
+        for part in definition["Fn::Join"][1]:
+            if isinstance(part, dict):
+                parts.append(resource(activities[part["Ref"]]))
+            else:
+                parts.append(part)
+        definition = ''.join(parts)
+    return json.loads(definition)
@@ -0,0 +1,74 @@
+import logging
+import os
+import threading
+from botocore.exceptions import ClientError
+
+# Seconds between heartbeats. Keep it well below the `heartbeat` of the task
+# state in CdkStack, 0 disables heartbeats.
+HEARTBEAT_INTERVAL = float(os.getenv("HEARTBEAT_INTERVAL", "10"))
+
+# Error codes of Step Functions for a task token nobody is waiting for any more.
+TASK_GONE_ERRORS = ('TaskTimedOut', 'TaskDoesNotExist', 'InvalidToken')
+
+logger = logging.getLogger()
+
+
+class Heartbeat:
+    '''
+    Sends send_task_heartbeat for one task token on a background thread
+    while the task is being processed:
+
+        with Heartbeat(sfn_client, task["taskToken"]) as heartbeat:
+            output = handler(input_payload)
+        if heartbeat.timed_out:
+            ...
+
+    If Step Functions answers that the task has already timed out, the
+    heartbeat stops and `timed_out` is set, so the caller can skip sending a
+    result nobody is waiting for.
+
+    Functions passed to on_beat() are called with every heartbeat, e.g. to
+    renew a lease that is held for as long as the task is alive.
+    '''
+
+    def __init__(self, sfn_client, task_token, interval=HEARTBEAT_INTERVAL):
+        self.sfn_client = sfn_client
+        self.task_token = task_token
+        self.interval = interval
+        self.timed_out = False
+        self._callbacks = []
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        if self.interval > 0:
+            self._thread = threading.Thread(target=self._run, name='heartbeat', daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        return False
+
+    def on_beat(self, callback):
+        self._callbacks.append(callback)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.sfn_client.send_task_heartbeat(taskToken=self.task_token)
+            except ClientError as e:
+                if e.response['Error']['Code'] in TASK_GONE_ERRORS:
+                    logger.warning('Task timed out while processing, stopping heartbeat.')
+                    self.timed_out = True
+                    return
+                logger.exception('Could not send task heartbeat.')
+            except Exception:
+                logger.exception('Could not send task heartbeat.')
+            for callback in self._callbacks:
+                try:
+                    callback()
+                except Exception:
+                    logger.exception('Heartbeat callback failed.')
@@ -0,0 +1,465 @@
+import json
+import logging
+import queue
+import re
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from botocore.exceptions import ClientError
+from common.stats import percentiles
+from saga_worker.definition import SQS_CALLBACK_RESOURCE
+
+logger = logging.getLogger()
+
+
+class TaskFailed(Exception):
+    def __init__(self, error, cause=None):
+        super().__init__(error if cause is None else '{}: {}'.format(error, cause))
+        self.error = error
+        self.cause = cause
+
+
+class _ExecutionTimedOut(Exception):
+    '''The execution ran past its TimeoutSeconds, which no Catch can handle.'''
+
+
+def _client_error(code, operation):
+    return ClientError({'Error': {'Code': code, 'Message': 'Local Step Functions'}}, operation)
+
+
+class _LocalTask:
+    def __init__(self, token):
+        self.token = token
+        self.future = Future()
+        self.last_heartbeat = time.monotonic()
+
+
+class LocalStepFunctions:
+    '''
+    In-memory stand-in for the activity API of Step Functions. It has the
+    same methods and arguments as the boto3 client that WorkerRuntime and
+    SagaWorker use, so the real workers run against it unchanged:
+
+        sfn = LocalStepFunctions()
+        saga.runtime(arns=..., client_factory=lambda: sfn).start()
+
+    `start_task()` schedules a task for an activity ARN and returns it; its
+    `future` resolves to the output the worker sends back. One instance is
+    shared by every poller and is thread-safe. `latency` seconds are added
+    to every task, for the time Step Functions takes to hand it to a worker.
+    '''
+
+    def __init__(self, poll_timeout=1.0, latency=0.0):
+        # Real get_activity_task holds the connection for 60 seconds, keep it short so workers stop quickly.
+        self.poll_timeout = poll_timeout
+        self.latency = latency
+        self._queues = defaultdict(queue.Queue)
+        self._tasks = {}
+        self._lock = threading.Lock()
+
+    def start_task(self, activity_arn, input_payload):
+        task = self.create_task()
+        with self._lock:
+            tasks = self._queues[activity_arn]
+        tasks.put((task.token, input_payload))
+        return task
+
+    def create_task(self):
+        '''A task whose token is handed out by the caller, like with waitForTaskToken.'''
+        if self.latency:
+            time.sleep(self.latency)
+        task = _LocalTask(uuid.uuid4().hex)
+        with self._lock:
+            self._tasks[task.token] = task
+        return task
+
+    def time_out_task(self, task):
+        with self._lock:
+            self._tasks.pop(task.token, None)
+        if not task.future.done():
+            task.future.set_exception(TaskFailed('States.Timeout'))
+
+    def get_activity_task(self, activityArn, workerName=None):
+        with self._lock:
+            tasks = self._queues[activityArn]
+        try:
+            token, input_payload = tasks.get(timeout=self.poll_timeout)
+        except queue.Empty:
+            return {}
+        return {'taskToken': token, 'input': input_payload}
+
+    def send_task_success(self, taskToken, output):
+        self._finish(taskToken, 'SendTaskSuccess').set_result(output)
+        return {}
+
+    def send_task_failure(self, taskToken, error=None, cause=None):
+        self._finish(taskToken, 'SendTaskFailure').set_exception(TaskFailed(error, cause))
+        return {}
+
+    def send_task_heartbeat(self, taskToken):
+        with self._lock:
+            task = self._tasks.get(taskToken)
+        if task is None:
+            raise _client_error('TaskTimedOut', 'SendTaskHeartbeat')
+        task.last_heartbeat = time.monotonic()
+        return {}
+
+    def _finish(self, token, operation):
+        with self._lock:
+            task = self._tasks.pop(token, None)
+        if task is None:
+            raise _client_error('TaskTimedOut', operation)
+        return task.future
+
+
+class LocalSQS:
+    '''
+    In-memory stand-in for the SQS calls of BatchConsumer and of the
+    sendMessage.waitForTaskToken integration, so the workers can consume
+    their queues locally. Received messages are only redelivered when the
+    consumer releases them; visibility timeouts never expire.
+    '''
+
+    def __init__(self, poll_timeout=1.0):
+        # Cap the long polls, so workers stop quickly.
+        self.poll_timeout = poll_timeout
+        self._queues = defaultdict(queue.Queue)
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def create_queue(self, QueueName, Attributes=None):
+        return {'QueueUrl': 'https://sqs.local/000000000000/{}'.format(QueueName)}
+
+    def send_message(self, QueueUrl, MessageBody, MessageAttributes=None):
+        message = {'MessageId': uuid.uuid4().hex, 'Body': MessageBody,
+                   'Attributes': {'SentTimestamp': str(int(time.time() * 1000))}}
+        self._queue(QueueUrl).put(message)
+        return {'MessageId': message['MessageId']}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, **kwargs):
+        messages = self._queue(QueueUrl)
+        received = []
+        try:
+            received.append(messages.get(timeout=min(WaitTimeSeconds, self.poll_timeout))
+                            if WaitTimeSeconds else messages.get_nowait())
+            while len(received) < MaxNumberOfMessages:
+                received.append(messages.get_nowait())
+        except queue.Empty:
+            pass
+        with self._lock:
+            for message in received:
+                message['ReceiptHandle'] = uuid.uuid4().hex
+                self._in_flight[message['ReceiptHandle']] = (QueueUrl, message)
+        return {'Messages': received} if received else {}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        with self._lock:
+            for entry in Entries:
+                self._in_flight.pop(entry['ReceiptHandle'], None)
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        for entry in Entries:
+            if entry['VisibilityTimeout'] == 0:
+                with self._lock:
+                    _, message = self._in_flight.pop(entry['ReceiptHandle'], (None, None))
+                if message is not None:
+                    self._queue(QueueUrl).put(message)
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames=None):
+        with self._lock:
+            not_visible = sum(1 for url, _ in self._in_flight.values() if url == QueueUrl)
+        return {'Attributes': {'ApproximateNumberOfMessages': str(self._queue(QueueUrl).qsize()),
+                               'ApproximateNumberOfMessagesNotVisible': str(not_visible)}}
+
+    def _queue(self, queue_url):
+        with self._lock:
+            return self._queues[queue_url]
+
+
+_MISSING = object()
+_PATH_TOKEN = re.compile(r'\.([^.\[]+)|\[(\d+)\]')
+
+
+def _get_path(data, path):
+    # Only the "$.a.b" and "$[0].a" subset of JsonPath, which is all CdkStack uses.
+    if path is None:
+        return {}
+    value = data
+    for key, index in _PATH_TOKEN.findall(path[1:]):
+        if index:
+            if not isinstance(value, list) or int(index) >= len(value):
+                return _MISSING
+            value = value[int(index)]
+        else:
+            if not isinstance(value, dict) or key not in value:
+                return _MISSING
+            value = value[key]
+    return value
+
+
+def _set_path(data, path, value):
+    if path is None:
+        return data
+    if path == '$':
+        return value
+    data = dict(data)
+    target = data
+    keys = path[2:].split('.')
+    for key in keys[:-1]:
+        target[key] = dict(target.get(key) or {})
+        target = target[key]
+    target[keys[-1]] = value
+    return data
+
+
+def _parameters(template, data, context):
+    # Keys ending in ".$" take their value from the input, or from the context object with "$$".
+    values = {}
+    for key, value in template.items():
+        if key.endswith('.$'):
+            value = _get_path(context, value[1:]) if value.startswith('$$') else _get_path(data, value)
+            values[key[:-2]] = None if value is _MISSING else value
+        elif isinstance(value, dict):
+            values[key] = _parameters(value, data, context)
+        else:
+            values[key] = value
+    return values
+
+
+def _error_matches(error_equals, error):
+    return (error in error_equals or 'States.ALL' in error_equals
+            or (error == 'States.HeartbeatTimeout' and 'States.Timeout' in error_equals))
+
+
+_COMPARISONS = {
+    'StringEquals': (str, lambda a, b: a == b),
+    'StringLessThan': (str, lambda a, b: a < b),
+    'StringGreaterThan': (str, lambda a, b: a > b),
+    'NumericEquals': ((int, float), lambda a, b: a == b),
+    'NumericLessThan': ((int, float), lambda a, b: a < b),
+    'NumericLessThanEquals': ((int, float), lambda a, b: a <= b),
+    'NumericGreaterThan': ((int, float), lambda a, b: a > b),
+    'NumericGreaterThanEquals': ((int, float), lambda a, b: a >= b),
+    'BooleanEquals': (bool, lambda a, b: a == b),
+}
+
+
+def _choice_matches(rule, data):
+    if 'And' in rule:
+        return all(_choice_matches(r, data) for r in rule['And'])
+    if 'Or' in rule:
+        return any(_choice_matches(r, data) for r in rule['Or'])
+    if 'Not' in rule:
+        return not _choice_matches(rule['Not'], data)
+    value = _get_path(data, rule['Variable'])
+    if 'IsPresent' in rule:
+        return (value is not _MISSING) == rule['IsPresent']
+    if 'IsNull' in rule:
+        return (value is None) == rule['IsNull']
+    for operator, (types, compare) in _COMPARISONS.items():
+        if operator in rule:
+            # Like Step Functions, a value of the wrong type does not match instead of failing.
+            if value is _MISSING or not isinstance(value, types) or \
+                    (types is not bool and isinstance(value, bool)):
+                return False
+            return compare(value, rule[operator])
+    raise ValueError('Unsupported choice rule: {}'.format(rule))
+
+
+class LocalStateMachine:
+    '''
+    Runs executions of an Amazon States Language definition against
+    LocalStepFunctions, for exercising the saga workers without AWS.
+
+    Supports the states CdkStack produces: Task on activities, or on
+    sqs:sendMessage.waitForTaskToken with `sqs` as the queues (with
+    TimeoutSeconds, HeartbeatSeconds, Retry and Catch), Parallel (with
+    Catch, every branch on its own thread), Choice, Pass, Wait, Succeed and
+    Fail, plus InputPath/Parameters/ResultSelector/ResultPath/OutputPath
+    in their "$.a.b" and "$[0].a" forms and $$.Execution in the context
+    object, and $$.Task.Token. `time_scale` shrinks Wait and retry intervals.
+
+    `execute()` returns a dict with the status, output or error, and the
+    seconds spent in every state, so callers can report step latencies.
+    '''
+
+    def __init__(self, definition, sfn, time_scale=1.0, sqs=None):
+        self.definition = definition
+        self.sfn = sfn
+        self.time_scale = time_scale
+        self.sqs = sqs
+
+    def execute(self, input_payload):
+        started = time.monotonic()
+        timeout = self.definition.get('TimeoutSeconds')
+        deadline = started + timeout if timeout else None
+        context = {'Execution': {'Id': 'arn:local:execution:{}'.format(uuid.uuid4().hex),
+                                 'Input': input_payload}}
+        steps = []
+        try:
+            result = {'status': 'SUCCEEDED',
+                      'output': self._run_states(self.definition, input_payload, context, deadline, steps)}
+        except _ExecutionTimedOut:
+            result = {'status': 'TIMED_OUT', 'error': 'States.Timeout'}
+        except TaskFailed as e:
+            result = {'status': 'FAILED', 'error': e.error, 'cause': e.cause}
+        result['seconds'] = time.monotonic() - started
+        result['steps'] = steps
+        return result
+
+    def _run_states(self, machine, data, context, deadline, steps):
+        # Runs the states of the whole definition, or of one Parallel branch, and returns the output.
+        states = machine['States']
+        state_name = machine['StartAt']
+        while True:
+            if deadline is not None and time.monotonic() > deadline:
+                raise _ExecutionTimedOut()
+            state = states[state_name]
+            step_started = time.monotonic()
+            try:
+                data, next_state = self._run_state(state, data, context, deadline, steps)
+            finally:
+                steps.append((state_name, time.monotonic() - step_started))
+            if state['Type'] == 'Fail':
+                raise TaskFailed(state.get('Error'), state.get('Cause'))
+            if next_state is None:
+                return data
+            state_name = next_state
+
+    def _run_state(self, state, data, context, deadline, steps):
+        state_type = state['Type']
+        if state_type in ('Succeed', 'Fail'):
+            return data, None
+        if state_type == 'Choice':
+            for rule in state.get('Choices', []):
+                if _choice_matches(rule, data):
+                    return data, rule['Next']
+            if 'Default' in state:
+                return data, state['Default']
+            raise TaskFailed('States.NoChoiceMatched')
+        effective = _get_path(data, state.get('InputPath', '$'))
+        # A task evaluates its Parameters on every attempt, as they may take a new task token.
+        if 'Parameters' in state and state_type != 'Task':
+            effective = _parameters(state['Parameters'], effective, context)
+        if state_type == 'Pass':
+            output = state.get('Result', effective)
+        elif state_type == 'Wait':
+            time.sleep(state.get('Seconds', 0) * self.time_scale)
+            output = effective
+        elif state_type in ('Task', 'Parallel'):
+            try:
+                if state_type == 'Task':
+                    output = self._run_task(state, effective, context)
+                else:
+                    output = self._run_parallel(state, effective, context, deadline, steps)
+            except TaskFailed as e:
+                for catcher in state.get('Catch', []):
+                    if _error_matches(catcher['ErrorEquals'], e.error):
+                        error_output = {'Error': e.error, 'Cause': e.cause}
+                        return _set_path(data, catcher.get('ResultPath', '$'), error_output), catcher['Next']
+                raise
+            if 'ResultSelector' in state:
+                output = _parameters(state['ResultSelector'], output, context)
+        else:
+            raise ValueError('Unsupported state type: {}'.format(state_type))
+        data = _set_path(data, state.get('ResultPath', '$'), output)
+        data = _get_path(data, state.get('OutputPath', '$'))
+        return data, None if state.get('End') else state['Next']
+
+    def _run_parallel(self, state, input_payload, context, deadline, steps):
+        # The output is the list of branch outputs. A failed branch fails the
+        # state, but unlike Step Functions the other branches run to the end.
+        outputs = [None] * len(state['Branches'])
+        errors = []
+
+        def run_branch(index, branch):
+            try:
+                outputs[index] = self._run_states(branch, input_payload, context, deadline, steps)
+            except (TaskFailed, _ExecutionTimedOut) as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run_branch, args=(index, branch), daemon=True)
+                   for index, branch in enumerate(state['Branches'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return outputs
+
+    def _run_task(self, state, input_payload, context):
+        attempts = defaultdict(int)
+        while True:
+            try:
+                if state['Resource'] == SQS_CALLBACK_RESOURCE:
+                    return self._run_callback(state, input_payload, context)
+                if 'Parameters' in state:
+                    return self._run_activity(state, _parameters(state['Parameters'], input_payload, context))
+                return self._run_activity(state, input_payload)
+            except TaskFailed as e:
+                retrier = next((r for r in state.get('Retry', [])
+                                if _error_matches(r['ErrorEquals'], e.error)), None)
+                if retrier is None:
+                    raise
+                key = id(retrier)
+                if attempts[key] >= retrier.get('MaxAttempts', 3):
+                    raise
+                interval = retrier.get('IntervalSeconds', 1) * retrier.get('BackoffRate', 2.0) ** attempts[key]
+                attempts[key] += 1
+                logger.info('Retrying {} after {}.'.format(state['Resource'], e.error))
+                time.sleep(interval * self.time_scale)
+
+    def _run_activity(self, state, input_payload):
+        return self._wait(state, self.sfn.start_task(state['Resource'], json.dumps(input_payload)))
+
+    def _run_callback(self, state, input_payload, context):
+        task = self.sfn.create_task()
+        parameters = _parameters(state['Parameters'], input_payload, dict(context, Task={'Token': task.token}))
+        self.sqs.send_message(QueueUrl=parameters['QueueUrl'], MessageBody=json.dumps(parameters['MessageBody']))
+        return self._wait(state, task)
+
+    def _wait(self, state, task):
+        timeout = state.get('TimeoutSeconds')
+        heartbeat = state.get('HeartbeatSeconds')
+        started = time.monotonic()
+        while True:
+            waits = [1.0]
+            if timeout:
+                waits.append(started + timeout - time.monotonic())
+            if heartbeat:
+                waits.append(task.last_heartbeat + heartbeat - time.monotonic())
+            try:
+                return json.loads(task.future.result(timeout=max(0, min(waits))))
+            except FutureTimeoutError:
+                pass
+            now = time.monotonic()
+            if timeout and now - started >= timeout:
+                self.sfn.time_out_task(task)
+                raise TaskFailed('States.Timeout')
+            if heartbeat and now - task.last_heartbeat >= heartbeat:
+                self.sfn.time_out_task(task)
+                raise TaskFailed('States.HeartbeatTimeout')
+
+
+def summarize(results, elapsed):
+    '''Aggregates LocalStateMachine.execute() results into one report.'''
+    statuses = defaultdict(int)
+    steps = defaultdict(list)
+    for result in results:
+        statuses[result['status']] += 1
+        for state_name, seconds in result['steps']:
+            steps[state_name].append(seconds)
+    return {
+        'executions': len(results),
+        'statuses': dict(statuses),
+        'seconds': round(elapsed, 3),
+        'executions_per_second': round(len(results) / elapsed, 2) if elapsed else None,
+        'latency_ms': percentiles([result['seconds'] for result in results]),
+        'steps': {state_name: dict(count=len(values), **percentiles(values))
+                  for state_name, values in steps.items()},
+    }
@@ -0,0 +1,184 @@
+import logging
+import os
+import signal
+import threading
+import time
+from common.codec import json_loads
+from common.consumer import BatchConsumer
+from common.metrics import registry
+from saga_worker.definition import WORKER_SHUTDOWN_ERROR
+
+AWS_REGION = 'ap-southeast-1'
+# Number of concurrent get_activity_task pollers per activity.
+WORKER_SLOTS = int(os.getenv("WORKER_SLOTS", "4"))
+# ECS sends SIGKILL 30 seconds after SIGTERM by default. Shorter than the
+# 60 second get_activity_task, see WorkerRuntime for what that leaves open.
+WORKER_SHUTDOWN_TIMEOUT = float(os.getenv("WORKER_SHUTDOWN_TIMEOUT", "25"))
+
+logger = logging.getLogger()
+
+# get_activity_task keeps the connection open for up to 60 seconds.
+_SFN_READ_TIMEOUT = 70
+
+poll_seconds = registry.histogram('saga_poll_seconds', 'Time spent in get_activity_task', ('worker',))
+polls_total = registry.counter('saga_polls_total', 'get_activity_task calls by result', ('worker', 'result'))
+tasks_in_flight = registry.gauge('saga_tasks_in_flight', 'Tasks being processed', ('worker',))
+
+
+class WorkerRuntime:
+    '''
+    Runs concurrent pollers for one or more activities in a single process.
+    Every poller has its own boto3 session and client, and passes each task
+    it receives to `handler(sfn_client, task)`, where `task` is the
+    get_activity_task response. `activity_arn` may be a callable, which is
+    called before every poll.
+
+    Steps that the state machine sends to an SQS queue with a task token
+    are added with `add_queue()` instead. A BatchConsumer receives them in
+    batches of up to 10 and passes every message body, which has the same
+    "taskToken" and "input" fields, to the same kind of handler. A message
+    is deleted once the handler has returned, whether the step succeeded or
+    failed, since the result has gone to Step Functions with the token.
+
+    On SIGTERM/SIGINT the pollers stop taking new tasks, finish the task in
+    hand and exit. The queue consumers return the messages they have not
+    started on to their queue.
+
+    A get_activity_task that is already waiting cannot be cancelled. A task
+    it returns after the signal is failed right away with
+    WORKER_SHUTDOWN_ERROR, which the state machine retries on another
+    worker. A poll still open when the process exits after
+    WORKER_SHUTDOWN_TIMEOUT can still be handed a task. Nobody processes
+    that task, and Step Functions retries it once it misses its heartbeat.
+
+    `client_factory` builds the Step Functions client of each poller and
+    queue, and `sqs_client_factory` the SQS client of each queue. They
+    default to boto3 clients; the local engine passes in-memory ones.
+    '''
+
+    def __init__(self, region=AWS_REGION, client_factory=None, sqs_client_factory=None):
+        self.region = region
+        self.client_factory = client_factory or self._boto3_client
+        self.sqs_client_factory = sqs_client_factory or self._boto3_sqs_client
+        self._activities = []
+        self._queues = []
+        self._threads = []
+        self._consumers = []
+        self._stopping = threading.Event()
+
+    def add_activity(self, activity_arn, worker_name, handler, slots=WORKER_SLOTS):
+        self._activities.append((activity_arn, worker_name, handler, slots))
+
+    def add_queue(self, queue_url, worker_name, handler, slots=WORKER_SLOTS):
+        self._queues.append((queue_url, worker_name, handler, slots))
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+        self.start()
+        self._stopping.wait()
+        self.join()
+        logger.info('Worker stopped.')
+
+    def start(self):
+        for activity_arn, worker_name, handler, slots in self._activities:
+            for slot in range(slots):
+                self._threads.append(threading.Thread(target=self._poll_loop,
+                                                      args=(activity_arn, '{}-{}'.format(worker_name, slot), handler),
+                                                      name='{}-{}'.format(worker_name, slot), daemon=True))
+            logger.info('Starting {} poller(s) for {}.'.format(slots, worker_name))
+        for thread in self._threads:
+            thread.start()
+        for queue_url, worker_name, handler, slots in self._queues:
+            # boto3 clients are thread-safe, so the threads of a consumer share them.
+            consumer = BatchConsumer(self.sqs_client_factory(), queue_url,
+                                     self._message_handler(worker_name, handler, self.client_factory()),
+                                     concurrency=slots,
+                                     # Heartbeats only start with the handler, so do not hold many tasks back.
+                                     prefetch=slots,
+                                     shutdown_timeout=WORKER_SHUTDOWN_TIMEOUT)
+            consumer.start()
+            self._consumers.append(consumer)
+            logger.info('Consuming {} with {} worker(s) for {}.'.format(queue_url, slots, worker_name))
+
+    def join(self, timeout=WORKER_SHUTDOWN_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        for consumer in self._consumers:
+            consumer.stop(max(0, deadline - time.monotonic()))
+        self._consumers = []
+
+    def stop(self):
+        self._stopping.set()
+
+    def _on_signal(self, signum, frame):
+        logger.info('Received signal {}, shutting down.'.format(signum))
+        self.stop()
+
+    def _boto3_client(self):
+        # boto3 takes a while to import, so it is loaded when the pollers start, not with this module.
+        import boto3
+        from botocore.config import Config
+
+        # boto3 sessions are not thread-safe, so every poller builds its own.
+        return boto3.session.Session().client('stepfunctions', region_name=self.region,
+                                              config=Config(read_timeout=_SFN_READ_TIMEOUT))
+
+    def _boto3_sqs_client(self):
+        import boto3
+
+        return boto3.session.Session().client('sqs', region_name=self.region)
+
+    def _message_handler(self, worker_name, handler, sfn_client):
+        def handle(msg):
+            # {"taskToken": "...", "input": {...}}, the MessageBody of the task state in CdkStack.
+            task = json_loads(msg['Body'])
+            tasks_in_flight.inc(worker=worker_name)
+            try:
+                handler(sfn_client, task)
+            finally:
+                tasks_in_flight.dec(worker=worker_name)
+        return handle
+
+    def _poll_loop(self, activity_arn, worker_name, handler):
+        sfn_client = self.client_factory()
+        # Without the slot number, so all pollers of an activity share their series.
+        worker = worker_name.rsplit('-', 1)[0]
+        while not self._stopping.is_set():
+            arn = activity_arn() if callable(activity_arn) else activity_arn
+            started = time.monotonic()
+            try:
+                response = sfn_client.get_activity_task(
+                    activityArn=arn,
+                    workerName=worker_name
+                )
+            except Exception:
+                logger.exception('Could not get activity task for %s.', arn)
+                polls_total.inc(worker=worker, result='error')
+                self._stopping.wait(1)
+                continue
+            poll_seconds.observe(time.monotonic() - started, worker=worker)
+            if not response.get("taskToken"):
+                polls_total.inc(worker=worker, result='empty')
+                continue
+            if self._stopping.is_set():
+                polls_total.inc(worker=worker, result='returned')
+                self._return_task(sfn_client, response, worker_name)
+                continue
+            polls_total.inc(worker=worker, result='task')
+            tasks_in_flight.inc(worker=worker)
+            try:
+                handler(sfn_client, response)
+            except Exception:
+                logger.exception('Unhandled error in %s.', worker_name)
+            finally:
+                tasks_in_flight.dec(worker=worker)
+
+    def _return_task(self, sfn_client, task, worker_name):
+        # Failing it now is quicker than letting the task miss its heartbeat after the process has exited.
+        try:
+            sfn_client.send_task_failure(taskToken=task["taskToken"], error=WORKER_SHUTDOWN_ERROR,
+                                         cause='{} is shutting down.'.format(worker_name))
+        except Exception:
+            logger.exception('Could not hand back a task received by %s while shutting down.', worker_name)
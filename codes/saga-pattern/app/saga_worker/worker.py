@@ -0,0 +1,215 @@
+import logging
+import os
+from collections.abc import Mapping
+from botocore.exceptions import ClientError
+from common.claimcheck import claim_check_store_from_url
+from common.codec import MESSAGE_CODEC, get_codec, json_dumps, json_loads
+from common.logsetup import SAMPLED
+from common.metrics import registry, serve_metrics
+from saga_worker.config import activity_arns, activity_queues
+from saga_worker.definition import DISPATCH_MODES, INLINE_FIELDS
+from saga_worker.heartbeat import TASK_GONE_ERRORS, Heartbeat
+from common.idempotency import idempotency_store_from_url
+from saga_worker.runtime import AWS_REGION, WorkerRuntime, WORKER_SLOTS
+
+# Comma separated activity names to run, e.g. "inventory-process,payment-process".
+# Empty means every activity registered in this process.
+SAGA_ACTIVITIES = os.getenv("SAGA_ACTIVITIES", "")
+# How the state machine hands out the steps, the `saga_dispatch` of CdkStack:
+# "activity" to poll get_activity_task, "sqs" to consume the queue of every activity.
+SAGA_DISPATCH = os.getenv("SAGA_DISPATCH", "activity")
+# Where completed steps are remembered: "memory", "sqlite:///path/to/file.db",
+# "dynamodb://table-name", or "none" to process every delivery.
+IDEMPOTENCY_STORE = os.getenv("IDEMPOTENCY_STORE", "memory")
+# Where large payloads are stored and sent as a reference: "s3://bucket/prefix/",
+# "file:///path/to/dir", or "none" to always send them whole.
+CLAIM_CHECK_STORE = os.getenv("CLAIM_CHECK_STORE", "none")
+# Port for Prometheus to scrape /metrics from, empty to only write EMF lines.
+METRICS_PORT = os.getenv("METRICS_PORT", "")
+
+logger = logging.getLogger()
+
+process_seconds = registry.histogram('saga_process_seconds', 'Time spent in the step handler', ('activity',))
+completion_seconds = registry.histogram('saga_completion_seconds',
+                                        'Time spent in send_task_success or send_task_failure',
+                                        ('activity', 'call'))
+tasks_total = registry.counter('saga_tasks_total', 'Tasks by outcome', ('activity', 'outcome'))
+
+
+def activity_cause(activity_name):
+    # "inventory-process" -> "Inventory-Process", the same id as the Activity in CdkStack.
+    return '-'.join(part.capitalize() for part in activity_name.split('-'))
+
+
+def idempotency_key(activity_name, input_payload):
+    # The "Start saga" state of CdkStack adds the execution id, the same for every delivery of a step.
+    # Also a ClaimCheckPayload, whose "saga" field is read without fetching the payload.
+    saga_state = input_payload.get("saga") if isinstance(input_payload, Mapping) else None
+    if not isinstance(saga_state, dict) or not saga_state.get("execution_id"):
+        return None
+    return "{}:{}".format(saga_state["execution_id"], activity_name)
+
+
+def _task_gone(error):
+    return isinstance(error, ClientError) and error.response['Error']['Code'] in TASK_GONE_ERRORS
+
+
+class SagaWorker:
+    '''
+    Registry of saga step handlers, keyed by activity name.
+
+    A handler receives the task input as a dict and returns the output dict:
+
+        @saga.process("inventory")
+        def inventory_process(input_payload):
+            input_payload["inventory_result"] = True
+            return input_payload
+
+    Anything the handler raises is logged with its traceback and reported
+    with send_task_failure.
+
+    Step Functions may deliver a step more than once, e.g. when a task is
+    retried after a timeout. With an `idempotency` store, a step that has
+    already been processed for the execution is answered with its first
+    output and the handler is not called again.
+
+    With a `claim_check` store, a large payload travels through Step
+    Functions as a reference. The handler receives a dict-like
+    ClaimCheckPayload that fetches the stored fields the first time it
+    reads one of them, and an output larger than the threshold is stored
+    and sent as a reference again.
+
+    Step Functions only takes JSON, so inputs and outputs are JSON, parsed
+    and written with orjson when it is installed. MESSAGE_CODEC applies to
+    the payloads in the claim check store.
+
+    The same handlers serve both dispatch modes of CdkStack: activities,
+    and SQS messages with a task token.
+    '''
+
+    def __init__(self, idempotency=None, claim_check=None):
+        self.handlers = {}
+        self.worker_names = {}
+        self.idempotency = idempotency
+        self.claim_check = claim_check
+
+    def process(self, step):
+        return self._register("{}-process".format(step), "worker-{}".format(step))
+
+    def rollback(self, step):
+        return self._register("{}-rollback".format(step), "worker-{}-rollback".format(step))
+
+    def _register(self, activity_name, worker_name):
+        def decorator(handler):
+            self.handlers[activity_name] = handler
+            self.worker_names[activity_name] = worker_name
+            return handler
+        return decorator
+
+    def handle_task(self, activity_name, sfn_client, task):
+        heartbeat = Heartbeat(sfn_client, task["taskToken"])
+        try:
+            # A JSON string from get_activity_task, already parsed in an SQS message body.
+            input_payload = task["input"]
+            if isinstance(input_payload, (str, bytes)):
+                input_payload = json_loads(input_payload)
+            if self.claim_check is not None:
+                input_payload = self.claim_check.check_out(input_payload)
+            logger.info("Received input - %s", input_payload, extra=SAMPLED)
+            with heartbeat, process_seconds.time(activity=activity_name):
+                output = self._process(activity_name, input_payload, heartbeat)
+            if heartbeat.timed_out:
+                # Step Functions has already given up on this task and rescheduled it.
+                logger.warning("Dropping result of %s, the task timed out.", activity_name)
+                tasks_total.inc(activity=activity_name, outcome='timed_out')
+                return
+            # Send the response back to SFN
+            with completion_seconds.time(activity=activity_name, call='success'):
+                sfn_client.send_task_success(
+                    taskToken=task["taskToken"],
+                    output=json_dumps(output)
+                )
+            tasks_total.inc(activity=activity_name, outcome='success')
+        except Exception as e:
+            if heartbeat.timed_out or _task_gone(e):
+                # e.g. a second delivery of an SQS message whose task has been completed already.
+                logger.warning("Task of %s is no longer waiting for a result.", activity_name)
+                tasks_total.inc(activity=activity_name, outcome='timed_out')
+                return
+            logger.exception("Problem on processing %s.", activity_name)
+            tasks_total.inc(activity=activity_name, outcome='failure')
+            with completion_seconds.time(activity=activity_name, call='failure'):
+                sfn_client.send_task_failure(
+                    taskToken=task["taskToken"], error="Problem on processing",
+                    cause=activity_cause(activity_name))
+
+    def _process(self, activity_name, input_payload, heartbeat):
+        handler = self.handlers[activity_name]
+
+        def step():
+            output = handler(input_payload)
+            # Checked in before it is remembered, so the idempotency store keeps the reference.
+            return output if self.claim_check is None else self.claim_check.check_in(output)
+
+        key = idempotency_key(activity_name, input_payload)
+        if self.idempotency is None or key is None:
+            return step()
+        # The claim on the step lasts as long as the task is alive, however long the handler takes.
+        heartbeat.on_beat(lambda: self.idempotency.renew(key))
+        # Wait for a delivery that is still in progress, its output is the answer for this one too.
+        output, duplicate = self.idempotency.run(key, step, wait=True)
+        if duplicate:
+            tasks_total.inc(activity=activity_name, outcome='duplicate')
+            logger.info("%s was already processed, sending its output again.", key, extra=SAMPLED)
+        return output
+
+    def run(self, activity_names=None):
+        if METRICS_PORT:
+            serve_metrics(int(METRICS_PORT), registry)
+        self.runtime(activity_names).run()
+
+    def runtime(self, activity_names=None, arns=activity_arns, slots=WORKER_SLOTS, dispatch=SAGA_DISPATCH,
+                queues=activity_queues, **kwargs):
+        '''
+        Builds a WorkerRuntime that polls `activity_names`, by default
+        SAGA_ACTIVITIES or every registered activity. `arns` maps activity
+        names to ARNs, `slots` is the number of pollers per activity and
+        other arguments are passed to WorkerRuntime.
+
+        With `dispatch` "sqs" the runtime consumes the queues of the
+        activities instead, and `queues` maps activity names to queue URLs.
+        '''
+        if dispatch not in DISPATCH_MODES:
+            raise ValueError('Unsupported saga dispatch: {}'.format(dispatch))
+        if activity_names is None:
+            activity_names = [name for name in SAGA_ACTIVITIES.split(",") if name] or list(self.handlers)
+        # Resolve once up front so a missing activity fails at start-up.
+        for activity_name in activity_names:
+            (queues if dispatch == 'sqs' else arns)[activity_name]
+
+        runtime = WorkerRuntime(**kwargs)
+        for activity_name in activity_names:
+            if dispatch == 'sqs':
+                runtime.add_queue(queues[activity_name], self.worker_names[activity_name],
+                                  self._task_handler(activity_name), slots=slots)
+            else:
+                runtime.add_activity(self._activity_arn(arns, activity_name), self.worker_names[activity_name],
+                                     self._task_handler(activity_name), slots=slots)
+        return runtime
+
+    def _activity_arn(self, arns, activity_name):
+        # Looked up on every poll, so refreshed ARNs are picked up without a restart.
+        def resolve():
+            return arns[activity_name]
+        return resolve
+
+    def _task_handler(self, activity_name):
+        def handler(sfn_client, task):
+            self.handle_task(activity_name, sfn_client, task)
+        return handler
+
+
+# Default registry shared by all worker modules imported in this process.
+saga = SagaWorker(idempotency=idempotency_store_from_url(IDEMPOTENCY_STORE, region=AWS_REGION),
+                  claim_check=claim_check_store_from_url(CLAIM_CHECK_STORE, region=AWS_REGION,
+                                                         inline=INLINE_FIELDS, codec=get_codec(MESSAGE_CODEC)))
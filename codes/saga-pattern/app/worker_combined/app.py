@@ -0,0 +1,20 @@
+import logging
+from saga_worker import saga
+from common.logsetup import setup_logging
+
+# Importing the workers registers their handlers on the shared `saga` registry.
+import worker_inventory.app
+import worker_inventory_rollback.app
+import worker_payment.app
+import worker_payment_rollback.app
+import worker_logistic.app
+import worker_logistic_rollback.app
+
+logger = logging.getLogger()
+setup_logging()
+
+
+if __name__ == '__main__':
+    # Runs every saga activity in one task. Set SAGA_ACTIVITIES to run a subset,
+    # e.g. "inventory-process,payment-process,logistic-process".
+    saga.run()
@@ -5,6 +5,9 @@ from aws_cdk import aws_stepfunctions as _sfn
 from aws_cdk import aws_stepfunctions_tasks as _sfn_tasks
 from aws_cdk import aws_iam as _iam
 from aws_cdk import aws_ssm as _ssm
+from aws_cdk import aws_dynamodb as _dynamodb
+from aws_cdk import aws_s3 as _s3
+from aws_cdk import aws_sqs as _sqs
 import aws_cdk as core
 import json
 
@@ -13,31 +16,173 @@ class CdkStack(Stack):
     def __init__(self, scope: Construct, id: str, stack_prefix: str,
                  **kwargs) -> None:
         super().__init__(scope, id, **kwargs)
-        inventory_process = _sfn.Activity(self, "Inventory-Process")
-        inventory_rollback = _sfn.Activity(self, "Inventory-Rollback")
-        payment_process = _sfn.Activity(self, "Payment-Process")
-        payment_rollback = _sfn.Activity(self, "Payment-Rollback")
-        logistic_process = _sfn.Activity(self, "Logistic-Process")
-        logistic_rollback = _sfn.Activity(self, "Logistic-Rollback")
-
-        activity_inventory_process = _sfn_tasks.StepFunctionsInvokeActivity(self, "Inventory Process",
-                                                                            activity=inventory_process
-                                                                            )
-        activity_inventory_rollback = _sfn_tasks.StepFunctionsInvokeActivity(self, "Cancel Inventory",
-                                                                             activity=inventory_rollback
-                                                                             )
-        activity_payment_process = _sfn_tasks.StepFunctionsInvokeActivity(self, "Payment Process",
-                                                                          activity=payment_process
-                                                                          )
-        activity_payment_rollback = _sfn_tasks.StepFunctionsInvokeActivity(self, "Cancel Payment",
-                                                                           activity=payment_rollback
-                                                                           )
-        activity_logistic_process = _sfn_tasks.StepFunctionsInvokeActivity(self, "Logistic Process",
-                                                                           activity=logistic_process
-                                                                           )
-        activity_logistic_rollback = _sfn_tasks.StepFunctionsInvokeActivity(self, "Cancel Logistic",
-                                                                            activity=logistic_rollback
-                                                                            )
+        # Workers send a heartbeat every HEARTBEAT_INTERVAL seconds (10 by default).
+        # A task that misses heartbeats for this long is failed and retried.
+        self.activity_heartbeat = core.Duration.seconds(
+            self.node.try_get_context("activity_heartbeat_seconds") or 30)
+        activity_timeout_seconds = self.node.try_get_context("activity_timeout_seconds") or 120
+        self.activity_timeout = core.Duration.seconds(activity_timeout_seconds)
+        # "sequential" reserves inventory, then payment. "parallel" reserves both at once,
+        # e.g. `cdk synth -c saga_mode=parallel`.
+        saga_mode = self.node.try_get_context("saga_mode") or "sequential"
+        if saga_mode not in ("sequential", "parallel"):
+            raise ValueError("Unsupported saga_mode: {}".format(saga_mode))
+        # "activity" has the workers poll an Activity per step with get_activity_task. "sqs" sends every
+        # step to a queue with a task token, which the workers receive in batches and send back with the
+        # result, e.g. `cdk synth -c saga_dispatch=sqs`. Set SAGA_DISPATCH of the workers to the same value.
+        # Express state machines are not an option: they support neither activities nor waitForTaskToken.
+        self.saga_dispatch = self.node.try_get_context("saga_dispatch") or "activity"
+        if self.saga_dispatch not in ("activity", "sqs"):
+            raise ValueError("Unsupported saga_dispatch: {}".format(self.saga_dispatch))
+
+        if self.saga_dispatch == "sqs":
+            # Messages the workers keep failing on, e.g. with a body they cannot read, end up here.
+            self.dead_letter_queue = _sqs.Queue(self, "Saga-Dead-Letter",
+                                                retention_period=core.Duration.days(14))
+            # A message that is still waiting when its task times out is useless, the retry sends a new one.
+            self.step_retention = core.Duration.seconds(max(60, activity_timeout_seconds))
+
+        inventory_process = self._step("Inventory-Process")
+        inventory_rollback = self._step("Inventory-Rollback")
+        payment_process = self._step("Payment-Process")
+        payment_rollback = self._step("Payment-Rollback")
+        logistic_process = self._step("Logistic-Process")
+        logistic_rollback = self._step("Logistic-Rollback")
+        steps = {
+            "inventory-process": inventory_process,
+            "inventory-rollback": inventory_rollback,
+            "payment-process": payment_process,
+            "payment-rollback": payment_rollback,
+            "logistic-process": logistic_process,
+            "logistic-rollback": logistic_rollback,
+        }
+
+        # Every step gets the execution id, the workers use it as their idempotency key.
+        state_start = _sfn.Pass(self, "Start saga",
+                                parameters={"execution_id": _sfn.JsonPath.string_at("$$.Execution.Id")},
+                                result_path="$.saga")
+
+        if saga_mode == "parallel":
+            definition = state_start.next(self._parallel_saga(
+                inventory_process, inventory_rollback, payment_process, payment_rollback,
+                logistic_process, logistic_rollback))
+        else:
+            definition = state_start.next(self._sequential_saga(
+                inventory_process, inventory_rollback, payment_process, payment_rollback,
+                logistic_process, logistic_rollback))
+        state_machine = _sfn.StateMachine(
+            self,
+            "copilot-saga-pattern",
+            definition=definition,
+            timeout=core.Duration.minutes(5))
+
+        # Use this dict into SSM for easy access by Workers.
+        if self.saga_dispatch == "sqs":
+            activity_queues = {activity_name: queue.queue_url for activity_name, queue in steps.items()}
+            ssm_activity_arns = _ssm.StringParameter(self, "{}-activity-queues".format(stack_prefix),
+                                                     description='List of activity queue URLs for Workers',
+                                                     parameter_name="{}-activity-queues".format(
+                stack_prefix),
+                string_value=json.dumps(activity_queues)
+            )
+        else:
+            activity_arns = {activity_name: activity.activity_arn for activity_name, activity in steps.items()}
+            ssm_activity_arns = _ssm.StringParameter(self, "{}-activity-arns".format(stack_prefix),
+                                                     description='List of activity ARNs for Workers',
+                                                     parameter_name="{}-activity-arns".format(
+                stack_prefix),
+                string_value=json.dumps(activity_arns)
+            )
+
+        # Steps the workers have completed, set IDEMPOTENCY_STORE=dynamodb://<table name> to use it.
+        idempotency_table = _dynamodb.Table(self, "{}-idempotency".format(stack_prefix),
+                                            table_name="{}-idempotency".format(stack_prefix),
+                                            partition_key=_dynamodb.Attribute(
+                                                name="key", type=_dynamodb.AttributeType.STRING),
+                                            billing_mode=_dynamodb.BillingMode.PAY_PER_REQUEST,
+                                            time_to_live_attribute="expires_at",
+                                            removal_policy=core.RemovalPolicy.DESTROY)
+
+        # Large payloads the workers send as a reference, set CLAIM_CHECK_STORE=s3://<bucket name>/ to use it.
+        # Objects are named by their content hash and never change, so they only need to outlive the saga.
+        claim_check_bucket = _s3.Bucket(self, "{}-claim-check".format(stack_prefix),
+                                        encryption=_s3.BucketEncryption.S3_MANAGED,
+                                        block_public_access=_s3.BlockPublicAccess.BLOCK_ALL,
+                                        lifecycle_rules=[_s3.LifecycleRule(expiration=core.Duration.days(1))],
+                                        removal_policy=core.RemovalPolicy.DESTROY,
+                                        auto_delete_objects=True)
+
+        # The activities each worker runs.
+        worker_steps = {
+            "worker_inventory": ["inventory-process"],
+            "worker_inventory_rollback": ["inventory-rollback"],
+            "worker_payment": ["payment-process"],
+            "worker_payment_rollback": ["payment-rollback"],
+            "worker_logistic": ["logistic-process"],
+            "worker_logistic_rollback": ["logistic-rollback"],
+            # One task that runs several activities needs all of them.
+            "worker_combined": list(steps),
+        }
+
+        # This part is a bit complicated.
+        task_roles = self.node.try_get_context("list_ecs_task_roles")
+        for key in task_roles:
+            iam_for_worker = _iam.Role.from_role_arn(self, "{}-worker-taskrole-{}".format(
+                stack_prefix, key), role_arn="arn:aws:iam::{}:role/{}".format(core.Aws.ACCOUNT_ID, task_roles[key]))
+
+            if self.saga_dispatch == "sqs":
+                for activity_name in worker_steps[key]:
+                    steps[activity_name].grant_consume_messages(iam_for_worker)
+                # SendTaskSuccess, SendTaskFailure and SendTaskHeartbeat with the task tokens of the messages.
+                state_machine.grant_task_response(iam_for_worker)
+            else:
+                sfn_policy_statement = _iam.PolicyStatement(
+                    effect=_iam.Effect.ALLOW)
+                sfn_policy_statement.add_actions("states:GetActivityTask")
+                sfn_policy_statement.add_actions("states:SendTaskSuccess")
+                sfn_policy_statement.add_actions("states:SendTaskFailure")
+                sfn_policy_statement.add_actions("states:DescribeActivity")
+                sfn_policy_statement.add_actions("states:SendTaskHeartbeat")
+                for activity_name in worker_steps[key]:
+                    sfn_policy_statement.add_resources(steps[activity_name].activity_arn)
+                iam_for_worker.add_to_principal_policy(sfn_policy_statement)
+            ssm_activity_arns.grant_read(iam_for_worker)
+            idempotency_table.grant_read_write_data(iam_for_worker)
+            claim_check_bucket.grant_read_write(iam_for_worker)
+
+        # e.g. copilot-saga-pattern-activity-inventory-process, or -queue-inventory-process with SQS dispatch.
+        for activity_name, step in steps.items():
+            if self.saga_dispatch == "sqs":
+                output_name, value = "{}-queue-{}".format(stack_prefix, activity_name), step.queue_url
+            else:
+                output_name, value = "{}-activity-{}".format(stack_prefix, activity_name), step.activity_arn
+            core.CfnOutput(self, output_name, value=value, export_name=output_name)
+        # The names keep their "activity-arns" for both modes, as other stacks may import them.
+        core.CfnOutput(self,
+                       "{}-ssm-activity-arns".format(stack_prefix),
+                       value=ssm_activity_arns.parameter_arn,
+                       export_name="{}-ssm-activity-arns".format(stack_prefix))
+        core.CfnOutput(self,
+                       "{}-idempotency-table".format(stack_prefix),
+                       value=idempotency_table.table_name,
+                       export_name="{}-idempotency-table".format(stack_prefix))
+        core.CfnOutput(self,
+                       "{}-claim-check-bucket".format(stack_prefix),
+                       value=claim_check_bucket.bucket_name,
+                       export_name="{}-claim-check-bucket".format(stack_prefix))
+        core.CfnOutput(self,
+                       "{}-ssm-activity-name".format(stack_prefix),
+                       value=ssm_activity_arns.parameter_name,
+                       export_name="{}-ssm-activity-name".format(stack_prefix))
+
+    def _sequential_saga(self, inventory_process, inventory_rollback, payment_process, payment_rollback,
+                         logistic_process, logistic_rollback):
+        activity_inventory_process = self._invoke_activity("Inventory Process", inventory_process)
+        activity_inventory_rollback = self._invoke_activity("Cancel Inventory", inventory_rollback)
+        activity_payment_process = self._invoke_activity("Payment Process", payment_process)
+        activity_payment_rollback = self._invoke_activity("Cancel Payment", payment_rollback)
+        activity_logistic_process = self._invoke_activity("Logistic Process", logistic_process)
+        activity_logistic_rollback = self._invoke_activity("Cancel Logistic", logistic_rollback)
 
         state_succeed = _sfn.Succeed(self, "Transaction success")
         state_failed = _sfn.Fail(self, "Transaction failed")
@@ -68,97 +213,105 @@ class CdkStack(Stack):
         activity_logistic_process.next(c_logistic_check)
         activity_logistic_rollback.next(activity_payment_rollback)
 
-        definition = activity_inventory_process.next(c_inventory_check)
-        _sfn.StateMachine(
-            self,
-            "copilot-saga-pattern",
-            definition=definition,
-            timeout=core.Duration.minutes(5))
+        activity_inventory_process.next(c_inventory_check)
+        return activity_inventory_process
 
-        # Use this dict into SSM for easy access by Workers.
-        activity_arns = {
-            "inventory-process": inventory_process.activity_arn,
-            "inventory-rollback": inventory_rollback.activity_arn,
-            "payment-process": payment_process.activity_arn,
-            "payment-rollback": payment_rollback.activity_arn,
-            "logistic-process": logistic_process.activity_arn,
-            "logistic-rollback": logistic_rollback.activity_arn,
-        }
+    def _parallel_saga(self, inventory_process, inventory_rollback, payment_process, payment_rollback,
+                       logistic_process, logistic_rollback):
+        # Inventory and payment do not depend on each other, so both are reserved at once.
+        # Only the reservations that succeeded are cancelled.
+        reserve = _sfn.Parallel(self, "Reserve Inventory and Payment",
+                                result_selector={
+                                    "inventory_result": _sfn.JsonPath.string_at("$[0].inventory_result"),
+                                    "payment_result": _sfn.JsonPath.string_at("$[1].payment_result")},
+                                result_path="$.reservation")
+        reserve.branch(self._reservation("Inventory Process", inventory_process, "inventory_result"))
+        reserve.branch(self._reservation("Payment Process", payment_process, "payment_result"))
 
-        ssm_activity_arns = _ssm.StringParameter(self, "{}-activity-arns".format(stack_prefix),
-                                                 description='List of activity ARNs for Workers',
-                                                 parameter_name="{}-activity-arns".format(
-            stack_prefix),
-            string_value=json.dumps(activity_arns)
-        )
+        activity_inventory_rollback = self._invoke_activity("Cancel Inventory", inventory_rollback)
+        activity_payment_rollback = self._invoke_activity("Cancel Payment", payment_rollback)
+        activity_logistic_process = self._invoke_activity("Logistic Process", logistic_process)
+        activity_logistic_rollback = self._invoke_activity("Cancel Logistic", logistic_rollback)
 
-        # This part is a bit complicated.
-        task_roles = self.node.try_get_context("list_ecs_task_roles")
-        for key in task_roles:
-            iam_for_worker = _iam.Role.from_role_arn(self, "{}-worker-taskrole-{}".format(
-                stack_prefix, key), role_arn="arn:aws:iam::{}:role/{}".format(core.Aws.ACCOUNT_ID, task_roles[key]))
+        state_succeed = _sfn.Succeed(self, "Transaction success")
+        state_failed = _sfn.Fail(self, "Transaction failed")
 
-            sfn_policy_statement = _iam.PolicyStatement(
-                effect=_iam.Effect.ALLOW)
-            sfn_policy_statement.add_actions("states:GetActivityTask")
-            sfn_policy_statement.add_actions("states:SendTaskSuccess")
-            sfn_policy_statement.add_actions("states:SendTaskFailure")
-            sfn_policy_statement.add_actions("states:DescribeActivity")
-            sfn_policy_statement.add_actions("states:SendTaskHeartbeat")
-
-            if key == "worker_inventory":
-                sfn_policy_statement.add_resources(
-                    inventory_process.activity_arn)
-            elif key == "worker_inventory_rollback":
-                sfn_policy_statement.add_resources(
-                    inventory_rollback.activity_arn)
-            elif key == "worker_payment":
-                sfn_policy_statement.add_resources(
-                    payment_process.activity_arn)
-            elif key == "worker_payment_rollback":
-                sfn_policy_statement.add_resources(
-                    payment_rollback.activity_arn)
-            elif key == "worker_logistic":
-                sfn_policy_statement.add_resources(
-                    logistic_process.activity_arn)
-            elif key == "worker_logistic_rollback":
-                sfn_policy_statement.add_resources(
-                    logistic_rollback.activity_arn)
-            iam_for_worker.add_to_principal_policy(sfn_policy_statement)
-            ssm_activity_arns.grant_read(iam_for_worker)
+        activity_inventory_rollback.next(state_failed)
 
-        core.CfnOutput(self,
-                       "{}-activity-inventory-process".format(stack_prefix),
-                       value=inventory_process.activity_arn,
-                       export_name="{}-activity-inventory-process".format(stack_prefix))
-        core.CfnOutput(self,
-                       "{}-activity-inventory-rollback".format(stack_prefix),
-                       value=inventory_rollback.activity_arn,
-                       export_name="{}-activity-inventory-rollback".format(stack_prefix))
-        core.CfnOutput(self,
-                       "{}-activity-payment-process".format(stack_prefix),
-                       value=payment_process.activity_arn,
-                       export_name="{}-activity-payment-process".format(stack_prefix))
-        core.CfnOutput(self,
-                       "{}-activity-payment-rollback".format(stack_prefix),
-                       value=payment_rollback.activity_arn,
-                       export_name="{}-activity-payment-rollback".format(stack_prefix))
-        core.CfnOutput(self,
-                       "{}-activity-logistic-process".format(stack_prefix),
-                       value=logistic_process.activity_arn,
-                       export_name="{}-activity-logistic-process".format(stack_prefix))
-        core.CfnOutput(self,
-                       "{}-activity-logistic-rollback".format(stack_prefix),
-                       value=logistic_rollback.activity_arn,
-                       export_name="{}-activity-logistic-rollback".format(stack_prefix))
-        core.CfnOutput(self,
-                       "{}-ssm-activity-arns".format(stack_prefix),
-                       value=ssm_activity_arns.parameter_arn,
-                       export_name="{}-ssm-activity-arns".format(stack_prefix))
-        core.CfnOutput(self,
-                       "{}-ssm-activity-name".format(stack_prefix),
-                       value=ssm_activity_arns.parameter_name,
-                       export_name="{}-ssm-activity-name".format(stack_prefix))
+        # Cancel Payment also runs after a failed logistic step, when there is inventory to cancel too.
+        c_inventory_reserved = _sfn.Choice(self, "Inventory reserved?")
+        c_inventory_reserved.when(_sfn.Condition.boolean_equals(
+            "$.reservation.inventory_result", True), activity_inventory_rollback)
+        c_inventory_reserved.otherwise(state_failed)
+        activity_payment_rollback.next(c_inventory_reserved)
+
+        c_logistic_check = _sfn.Choice(self, "Logistic check ok?")
+        c_logistic_check.when(_sfn.Condition.boolean_equals(
+            "$.logistic_result", True), state_succeed)
+        c_logistic_check.when(_sfn.Condition.boolean_equals(
+            "$.logistic_result", False), activity_logistic_rollback)
+
+        activity_logistic_process.next(c_logistic_check)
+        activity_logistic_rollback.next(activity_payment_rollback)
+
+        c_reservation_check = _sfn.Choice(self, "Reservation ok?")
+        c_reservation_check.when(_sfn.Condition.and_(
+            _sfn.Condition.boolean_equals("$.reservation.inventory_result", True),
+            _sfn.Condition.boolean_equals("$.reservation.payment_result", True)), activity_logistic_process)
+        c_reservation_check.when(_sfn.Condition.boolean_equals(
+            "$.reservation.inventory_result", True), activity_inventory_rollback)
+        c_reservation_check.when(_sfn.Condition.boolean_equals(
+            "$.reservation.payment_result", True), activity_payment_rollback)
+        c_reservation_check.otherwise(state_failed)
+
+        return reserve.next(c_reservation_check)
+
+    def _reservation(self, id, activity, result_field):
+        task = self._invoke_activity(id, activity)
+        # A failed reservation counts as not made, so the other branch is still compensated.
+        state_not_reserved = _sfn.Pass(self, "{} failed".format(id),
+                                       result=_sfn.Result.from_boolean(False),
+                                       result_path="$.{}".format(result_field))
+        task.add_catch(state_not_reserved, errors=["States.ALL"], result_path="$.error")
+        return task
+
+    def _step(self, id):
+        # The Activity, or with SQS dispatch the queue, that hands a step to the workers.
+        if self.saga_dispatch == "sqs":
+            return _sqs.Queue(self, "{}-Queue".format(id),
+                              retention_period=self.step_retention,
+                              dead_letter_queue=_sqs.DeadLetterQueue(max_receive_count=5,
+                                                                     queue=self.dead_letter_queue))
+        return _sfn.Activity(self, id)
+
+    def _invoke_activity(self, id, activity):
+        if self.saga_dispatch == "sqs":
+            # The worker receives the input with a task token, and completes the task with
+            # send_task_success or send_task_failure, exactly like an activity worker.
+            task = _sfn_tasks.SqsSendMessage(self, id,
+                                             queue=activity,
+                                             message_body=_sfn.TaskInput.from_object({
+                                                 "taskToken": _sfn.JsonPath.task_token,
+                                                 "input": _sfn.JsonPath.entire_payload}),
+                                             integration_pattern=_sfn.IntegrationPattern.WAIT_FOR_TASK_TOKEN,
+                                             heartbeat=self.activity_heartbeat,
+                                             timeout=self.activity_timeout
+                                             )
+        else:
+            task = _sfn_tasks.StepFunctionsInvokeActivity(self, id,
+                                                          activity=activity,
+                                                          heartbeat=self.activity_heartbeat,
+                                                          timeout=self.activity_timeout
+                                                          )
+        # A dead or stalled worker surfaces as a timeout, give the task to another worker.
+        task.add_retry(errors=["States.Timeout"],
+                       interval=core.Duration.seconds(1),
+                       max_attempts=2)
+        # A worker that is shutting down hands back the tasks it still receives, see saga_worker/runtime.py.
+        task.add_retry(errors=["Worker.ShuttingDown"],
+                       interval=core.Duration.seconds(1),
+                       max_attempts=3)
+        return task
 
 
 stack_prefix = 'copilot-saga-pattern'
@@ -1,29 +1,64 @@
-from flask import Flask
+from flask import Blueprint, Flask, current_app
 import os
-import urllib.request
-import json
+from common.codec import flask_response
+from common.metrics import instrument_flask, registry
+from downstream import DownstreamClient, DnsResolver, SrvResolver, StubResolver
 
-app = Flask(__name__)
+routes = Blueprint('app1', __name__)
 APP2_URL = "http://{}".format(os.getenv("APP2_URL"))
+# Comma separated host:port list that replaces DNS, e.g. for local runs.
+APP2_ENDPOINTS = os.getenv("APP2_ENDPOINTS")
 
 
-@app.route('/ping', methods=['GET'])
+def app2_resolver():
+    if APP2_ENDPOINTS:
+        return StubResolver((host, int(port)) for host, port in
+                            (endpoint.rsplit(":", 1) for endpoint in APP2_ENDPOINTS.split(",")))
+    if os.getenv("APP2_RESOLVER", "dns") == "srv":
+        return SrvResolver()
+    return DnsResolver()
+
+
+app2_client = DownstreamClient(APP2_URL,
+                               resolver=app2_resolver(),
+                               strategy=os.getenv("APP2_LB_STRATEGY", "round_robin"),
+                               pool_size=int(os.getenv("APP2_POOL_SIZE", "10")),
+                               timeout=float(os.getenv("APP2_TIMEOUT", "2")),
+                               dns_ttl=float(os.getenv("APP2_DNS_TTL", "10")),
+                               cache_ttl=float(os.getenv("APP2_CACHE_TTL", "0")),
+                               # What app1 asks app2 to answer in, e.g. "msgpack+zstd". app2 falls back to JSON.
+                               codec=os.getenv("APP2_CODEC", "json"))
+app2_seconds = registry.histogram('app2_request_seconds', 'Time for the call to app2, including retries')
+
+
+@routes.route('/ping', methods=['GET'])
 def healthcheck():
     return "ok"
 
 
-@app.route('/', methods=['GET'])
+@routes.route('/', methods=['GET'])
 def inc():
     data = {}
-    app2_response = json.loads(urllib.request.urlopen(APP2_URL).read())
+    with app2_seconds.time():
+        app2_response = app2_client.get_json('/')
     data['app2_response'] = app2_response['response']
-    response = app.response_class(
-        response=json.dumps(data),
-        status=200,
-        mimetype='application/json'
-    )
-    return response
+    return flask_response(current_app, data)
+
+
+def create_app():
+    '''
+    Builds the app without starting a thread or opening a connection, so
+    gunicorn can import it once before forking the workers
+    (GUNICORN_PRELOAD=true). Each worker resolves app2 and opens its
+    connections on the first call.
+    '''
+    app = Flask(__name__)
+    instrument_flask(app, registry)
+    app.register_blueprint(routes)
+    return app
+
 
+app = create_app()
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=9090)
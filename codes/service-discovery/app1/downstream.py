@@ -0,0 +1,281 @@
+import http.client
+import logging
+import queue
+import random
+import socket
+import threading
+import time
+from urllib.parse import urlsplit
+from common.codec import accept_headers, decode
+
+logger = logging.getLogger()
+
+
+class NoEndpoints(Exception):
+    '''A downstream service has no endpoint to send the request to.'''
+
+
+class DnsResolver:
+    '''Resolves every A/AAAA record of a name with the system resolver.'''
+
+    def resolve(self, host, port):
+        return sorted({(info[4][0], port) for info in socket.getaddrinfo(
+            host, port, type=socket.SOCK_STREAM)})
+
+
+class SrvResolver:
+    '''
+    Resolves the SRV records of a name, which carry the port of every task.
+    Needs dnspython, which is not in requirements.txt by default.
+    '''
+
+    def resolve(self, host, port):
+        import dns.resolver
+        answers = dns.resolver.resolve(host, 'SRV')
+        return sorted({(str(answer.target).rstrip('.'), answer.port) for answer in answers})
+
+
+class StubResolver:
+    '''Returns a fixed list of (address, port) endpoints, for local runs and tests.'''
+
+    def __init__(self, endpoints):
+        self.endpoints = list(endpoints)
+
+    def resolve(self, host, port):
+        return list(self.endpoints)
+
+
+class DnsCache:
+    '''
+    Caches resolver results for `ttl` seconds. Copilot registers services
+    in Cloud Map with a 10 second TTL, so caching for longer would keep
+    sending traffic to tasks that are gone. If a refresh fails or finds no
+    endpoint, e.g. while every task is being replaced, the last known
+    endpoints are kept.
+    '''
+
+    def __init__(self, resolver, ttl=10):
+        self.resolver = resolver
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port):
+        now = time.monotonic()
+        entry = self._entries.get((host, port))
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        try:
+            endpoints = self.resolver.resolve(host, port)
+            if not endpoints:
+                raise NoEndpoints('{} resolved to no endpoints'.format(host))
+        except Exception:
+            if entry is None:
+                raise
+            logger.exception('Could not resolve {}, using the last known endpoints.'.format(host))
+            endpoints = entry[1]
+        with self._lock:
+            self._entries[(host, port)] = (now + self.ttl, endpoints)
+        return endpoints
+
+
+class LoadBalancer:
+    '''
+    Picks an endpoint per request with one of these strategies:
+
+    - `round_robin`: every endpoint in turn,
+    - `least_outstanding`: the endpoint with the fewest requests in flight,
+    - `power_of_two`: the less busy of two random endpoints.
+
+    An endpoint that fails `eject_after` times in a row is left out for
+    `eject_seconds`. If every endpoint is ejected, all of them are used.
+    '''
+
+    STRATEGIES = ('round_robin', 'least_outstanding', 'power_of_two')
+
+    def __init__(self, strategy='round_robin', eject_after=3, eject_seconds=30):
+        if strategy not in self.STRATEGIES:
+            raise ValueError('Unknown load balancing strategy: {}'.format(strategy))
+        self.strategy = strategy
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self._outstanding = {}
+        self._failures = {}
+        self._ejected_until = {}
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def choose(self, endpoints, exclude=()):
+        if not endpoints:
+            raise NoEndpoints('No endpoints to choose from')
+        now = time.monotonic()
+        with self._lock:
+            candidates = [endpoint for endpoint in endpoints
+                          if endpoint not in exclude and self._ejected_until.get(endpoint, 0) <= now]
+            if not candidates:
+                candidates = [endpoint for endpoint in endpoints if endpoint not in exclude] or list(endpoints)
+            if self.strategy == 'round_robin':
+                endpoint = candidates[self._counter % len(candidates)]
+                self._counter += 1
+            elif self.strategy == 'least_outstanding':
+                # Rotate the start so ties do not always go to the first endpoint.
+                start = self._counter % len(candidates)
+                self._counter += 1
+                rotated = candidates[start:] + candidates[:start]
+                endpoint = min(rotated, key=lambda e: self._outstanding.get(e, 0))
+            else:
+                pair = random.sample(candidates, min(2, len(candidates)))
+                endpoint = min(pair, key=lambda e: self._outstanding.get(e, 0))
+            self._outstanding[endpoint] = self._outstanding.get(endpoint, 0) + 1
+        return endpoint
+
+    def release(self, endpoint, ok):
+        with self._lock:
+            self._outstanding[endpoint] -= 1
+            if ok:
+                self._failures.pop(endpoint, None)
+                return
+            self._failures[endpoint] = self._failures.get(endpoint, 0) + 1
+            if self._failures[endpoint] >= self.eject_after:
+                logger.warning('Ejecting {}:{} for {} seconds.'.format(
+                    endpoint[0], endpoint[1], self.eject_seconds))
+                self._ejected_until[endpoint] = time.monotonic() + self.eject_seconds
+                self._failures.pop(endpoint)
+
+
+class DownstreamClient:
+    '''
+    HTTP client for calls to another service, with:
+
+    - client-side load balancing across every resolved endpoint (see
+      LoadBalancer), re-resolved when the DNS cache expires,
+    - a pool of keep-alive connections per endpoint, so requests skip the
+      TCP handshake,
+    - connect/read timeouts,
+    - an optional cache for GET responses (`cache_ttl` seconds, 0 disables),
+    - `get_json()` asks for the response in `codec`, e.g. "msgpack+zstd",
+      and decodes whatever codec the server answers with.
+
+    Idempotent requests that fail to connect are retried once on another
+    endpoint.
+    '''
+
+    def __init__(self, base_url, pool_size=10, timeout=2.0, dns_ttl=10, cache_ttl=0,
+                 resolver=None, strategy='round_robin', codec='json'):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.base_path = parts.path.rstrip('/')
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self.accept = accept_headers(codec)
+        self.dns = DnsCache(resolver or DnsResolver(), dns_ttl)
+        self.balancer = LoadBalancer(strategy)
+        self._pools = {}
+        self._pools_lock = threading.Lock()
+        self._cache = {}
+
+    def get_json(self, path='/'):
+        # Named for JSON, the default; any codec the server picked from self.accept is decoded.
+        body, content_type, content_encoding = self._get(path, self.accept)
+        return decode(body, content_type, content_encoding)
+
+    def get(self, path='/'):
+        return self._get(path, None)[0]
+
+    def request(self, method, path, body=None, headers=None):
+        return self._request(method, path, body, headers)[0]
+
+    def _get(self, path, headers):
+        key = (path, headers is not None)
+        if self.cache_ttl > 0:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                return cached[1]
+        response = self._request('GET', path, None, headers)
+        if self.cache_ttl > 0:
+            if len(self._cache) >= 1024:
+                self._cache.clear()
+            self._cache[key] = (time.monotonic() + self.cache_ttl, response)
+        return response
+
+    def _request(self, method, path, body, headers):
+        endpoints = self.dns.resolve(self.host, self.port)
+        self._drop_stale_pools(endpoints)
+        attempts = 2 if method in ('GET', 'HEAD') and len(endpoints) > 1 else 1
+        tried = []
+        for attempt in range(attempts):
+            endpoint = self.balancer.choose(endpoints, exclude=tried)
+            tried.append(endpoint)
+            ok = False
+            try:
+                status, data, response_headers = self._send(endpoint, method, path, body, headers)
+                ok = status < 500
+            except OSError:
+                if attempt == attempts - 1:
+                    raise
+                continue
+            finally:
+                self.balancer.release(endpoint, ok)
+            if status >= 400:
+                raise http.client.HTTPException('{} {} returned {}'.format(method, path, status))
+            return data, response_headers.get('Content-Type'), response_headers.get('Content-Encoding')
+
+    def _send(self, endpoint, method, path, body, headers):
+        request_headers = {'Host': '{}:{}'.format(self.host, self.port)}
+        request_headers.update(headers or {})
+        connection, reused = self._acquire(endpoint)
+        try:
+            try:
+                connection.request(method, self.base_path + path, body=body, headers=request_headers)
+                response = connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                if not reused:
+                    raise
+                # The server closed an idle keep-alive connection, retry on a new one.
+                connection.close()
+                connection = self._connect(endpoint)
+                connection.request(method, self.base_path + path, body=body, headers=request_headers)
+                response = connection.getresponse()
+            data = response.read()
+        except Exception:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(endpoint, connection)
+        return response.status, data, response.headers
+
+    def _drop_stale_pools(self, endpoints):
+        stale = set(self._pools) - set(endpoints)
+        if not stale:
+            return
+        with self._pools_lock:
+            for endpoint in stale:
+                pool = self._pools.pop(endpoint, None)
+                while pool is not None and not pool.empty():
+                    pool.get_nowait().close()
+
+    def _pool(self, endpoint):
+        pool = self._pools.get(endpoint)
+        if pool is None:
+            with self._pools_lock:
+                pool = self._pools.setdefault(endpoint, queue.LifoQueue(self.pool_size))
+        return pool
+
+    def _acquire(self, endpoint):
+        try:
+            return self._pool(endpoint).get_nowait(), True
+        except queue.Empty:
+            return self._connect(endpoint), False
+
+    def _connect(self, endpoint):
+        return http.client.HTTPConnection(endpoint[0], endpoint[1], timeout=self.timeout)
+
+    def _release(self, endpoint, connection):
+        try:
+            self._pool(endpoint).put_nowait(connection)
+        except queue.Full:
+            connection.close()
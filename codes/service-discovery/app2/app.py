@@ -1,24 +1,35 @@
-from flask import Flask
-import json
+from flask import Blueprint, Flask, current_app
+from common.codec import flask_response
+from common.metrics import instrument_flask, registry
 
-app = Flask(__name__)
+routes = Blueprint('app2', __name__)
 
 
-@app.route('/ping', methods=['GET'])
+@routes.route('/ping', methods=['GET'])
 def healthcheck():
     return "ok"
 
 
-@app.route('/', methods=['GET'])
+@routes.route('/', methods=['GET'])
 def inc():
     data = {"response": "Hello from APP2"}
-    response = app.response_class(
-        response=json.dumps(data),
-        status=200,
-        mimetype='application/json'
-    )
-    return response
+    # JSON unless the request asks for another codec with Accept and Accept-Encoding.
+    return flask_response(current_app, data)
 
 
+def create_app():
+    '''
+    Builds the app without starting a thread or opening a connection, so
+    gunicorn can import it once before forking the workers
+    (GUNICORN_PRELOAD=true).
+    '''
+    app = Flask(__name__)
+    instrument_flask(app, registry)
+    app.register_blueprint(routes)
+    return app
+
+
+app = create_app()
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=9090)
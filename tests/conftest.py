@@ -0,0 +1,12 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The tests import the modules the way the containers lay them out: codes/common
+# as the `common` package, next to the code of the service.
+for path in (('codes', 'service-discovery', 'app1'), ('codes', 'saga-pattern', 'app'), ('codes',)):
+    sys.path.insert(0, os.path.join(ROOT, *path))
+
+# EMF lines on stdout would only clutter the test output.
+os.environ.setdefault('METRICS_EMF_INTERVAL', '0')
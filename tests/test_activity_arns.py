@@ -0,0 +1,91 @@
+import json
+import os
+import time
+import pytest
+from saga_worker.config import ActivityArns
+
+ARNS = {'inventory': 'arn:aws:states:ap-southeast-1:000000000000:activity:inventory'}
+NEW_ARNS = {'inventory': 'arn:aws:states:ap-southeast-1:000000000000:activity:inventory-v2'}
+
+
+class FakeSsm:
+    def __init__(self, value=ARNS, failures=0):
+        self.value = value
+        self.failures = failures
+        self.calls = 0
+
+    def get_parameter(self, Name):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise RuntimeError('throttled')
+        return {'Parameter': {'Value': json.dumps(self.value)}}
+
+
+def unreachable():
+    raise AssertionError('SSM must not be called')
+
+
+def write_snapshot(path, value, age=0):
+    with open(path, 'w') as f:
+        json.dump(value, f)
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+
+
+def test_loads_from_ssm_with_retries_and_writes_snapshot(tmp_path):
+    snapshot = str(tmp_path / 'arns.json')
+    ssm = FakeSsm(failures=2)
+    arns = ActivityArns(ttl=0, snapshot_path=snapshot, retries=3, backoff=0, client_factory=lambda: ssm)
+    assert arns['inventory'] == ARNS['inventory']
+    assert ssm.calls == 3
+    with open(snapshot) as f:
+        assert json.load(f) == ARNS
+
+
+def test_fresh_snapshot_skips_ssm(tmp_path):
+    snapshot = str(tmp_path / 'arns.json')
+    write_snapshot(snapshot, ARNS, age=10)
+    assert ActivityArns(ttl=300, snapshot_path=snapshot, client_factory=unreachable).get() == ARNS
+
+
+def test_stale_snapshot_is_refreshed_from_ssm(tmp_path):
+    snapshot = str(tmp_path / 'arns.json')
+    write_snapshot(snapshot, ARNS, age=600)
+    arns = ActivityArns(ttl=300, snapshot_path=snapshot, client_factory=lambda: FakeSsm(NEW_ARNS))
+    arns._start_refresher = lambda: None
+    assert arns.get() == NEW_ARNS
+
+
+def test_environment_fallback_when_ssm_fails(tmp_path):
+    snapshot = str(tmp_path / 'arns.json')
+    write_snapshot(snapshot, NEW_ARNS, age=600)
+    arns = ActivityArns(ttl=0, snapshot_path=snapshot, retries=2, backoff=0,
+                        client_factory=lambda: FakeSsm(failures=2), fallback=json.dumps(ARNS))
+    # The environment comes before a stale snapshot.
+    assert arns.get() == ARNS
+
+
+def test_stale_snapshot_when_ssm_fails(tmp_path):
+    snapshot = str(tmp_path / 'arns.json')
+    write_snapshot(snapshot, ARNS, age=600)
+    arns = ActivityArns(ttl=0, snapshot_path=snapshot, retries=1, client_factory=lambda: FakeSsm(failures=1),
+                        fallback='')
+    assert arns.get() == ARNS
+
+
+def test_nothing_available():
+    arns = ActivityArns(ttl=0, snapshot_path='', retries=1, client_factory=lambda: FakeSsm(failures=1),
+                        fallback='')
+    with pytest.raises(RuntimeError):
+        arns.get()
+
+
+def test_refreshed_after_ttl():
+    ssm = FakeSsm()
+    arns = ActivityArns(ttl=0.05, snapshot_path='', client_factory=lambda: ssm)
+    assert arns.get() == ARNS
+    ssm.value = NEW_ARNS
+    deadline = time.monotonic() + 5
+    while arns.get() != NEW_ARNS:
+        assert time.monotonic() < deadline, 'not refreshed'
+        time.sleep(0.01)
@@ -0,0 +1,88 @@
+import pytest
+from common.claimcheck import (REFERENCE_FIELD, ClaimCheckPayload, ClaimCheckStore, FileBackend, MemoryBackend,
+                               claim_check_store_from_url)
+from common.codec import get_codec
+
+
+def large_payload():
+    return {'saga': {'execution_id': 'e-1'}, 'items': ['x' * 100] * 50, 'inventory_result': True,
+            'amount': 12.5, 'note': None}
+
+
+def test_small_payload_is_sent_as_it_is():
+    store = ClaimCheckStore(MemoryBackend(), threshold=1024)
+    payload = {'saga': {'execution_id': 'e-1'}, 'ok': True}
+    assert store.check_in(payload) is payload
+    assert store.check_out(payload) is payload
+
+
+def test_large_payload_round_trip():
+    store = ClaimCheckStore(MemoryBackend(), threshold=1024)
+    message = store.check_in(large_payload())
+    assert set(message) == {REFERENCE_FIELD, 'inventory_result', 'amount', 'note'}
+    payload = store.check_out(message)
+    assert isinstance(payload, ClaimCheckPayload)
+    assert dict(payload) == large_payload()
+
+
+def test_inline_fields_are_read_without_fetching():
+    store = ClaimCheckStore(MemoryBackend(), threshold=1024, inline=('saga',))
+    message = store.check_in(large_payload())
+    assert message['saga'] == {'execution_id': 'e-1'}
+    payload = store.check_out(message)
+    assert payload['saga'] == {'execution_id': 'e-1'}
+    assert payload['inventory_result'] is True
+    assert not payload.loaded
+    assert payload['items'] == ['x' * 100] * 50
+    assert payload.loaded
+
+
+def test_untouched_payload_is_not_stored_again():
+    backend = MemoryBackend()
+    store = ClaimCheckStore(backend, threshold=1024)
+    payload = store.check_out(store.check_in(large_payload()))
+    payload['payment_result'] = True
+    message = store.check_in(payload)
+    assert not payload.loaded
+    assert message['payment_result'] is True
+    assert len(backend._objects) == 1
+    assert store.check_out(message)['items'] == ['x' * 100] * 50
+
+
+def test_another_process_fetches_from_the_backend(tmp_path):
+    url = 'file://' + str(tmp_path / 'claims')
+    message = claim_check_store_from_url(url, threshold=1024).check_in(large_payload())
+    assert dict(claim_check_store_from_url(url).check_out(message)) == large_payload()
+
+
+def test_tampered_object_is_rejected(tmp_path):
+    backend = FileBackend(str(tmp_path))
+    message = ClaimCheckStore(backend, threshold=1024).check_in(large_payload())
+    backend.put(message[REFERENCE_FIELD]['sha256'], b'{}')
+    with pytest.raises(ValueError):
+        dict(ClaimCheckStore(backend).check_out(message))
+
+
+def test_cache_is_bounded():
+    store = ClaimCheckStore(MemoryBackend(), cache_bytes=10)
+    store.put(b'123456')
+    store.put(b'abcdef')
+    assert store._cached_bytes == 6
+    assert list(store._cache) == [store.put(b'abcdef')['sha256']]
+
+
+def test_payload_stored_with_codec():
+    pytest.importorskip('msgpack')
+    store = ClaimCheckStore(MemoryBackend(), threshold=1024, codec=get_codec('msgpack'))
+    message = store.check_in(large_payload())
+    assert message[REFERENCE_FIELD]['content_type'] == get_codec('msgpack').content_type
+    assert dict(store.check_out(message)) == large_payload()
+
+
+def test_store_from_url():
+    assert claim_check_store_from_url('') is None
+    assert claim_check_store_from_url('none') is None
+    assert isinstance(claim_check_store_from_url('memory').backend, MemoryBackend)
+    assert claim_check_store_from_url('s3://bucket/prefix/').backend.prefix == 'prefix/'
+    with pytest.raises(ValueError):
+        claim_check_store_from_url('ftp://host')
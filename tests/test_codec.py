@@ -0,0 +1,106 @@
+import base64
+import gzip
+import pytest
+from common import codec
+from common.codec import (CONTENT_ENCODING_ATTRIBUTE, CONTENT_TYPE_ATTRIBUTE, Codec, accept_headers, decode,
+                          decode_text, negotiate)
+
+PAYLOAD = {'order_id': 'o-1', 'items': ['x' * 100] * 20, 'total': 12.5, 'paid': True}
+
+
+@pytest.fixture
+def without_libraries(monkeypatch):
+    # As in an image built without the optional packages.
+    monkeypatch.setattr(codec, 'msgpack', None)
+    monkeypatch.setattr(codec, 'zstandard', None)
+
+
+@pytest.mark.parametrize('name', ['json', 'json+gzip', 'msgpack', 'msgpack+gzip', 'msgpack+zstd', 'json+zstd'])
+def test_round_trip(name):
+    if 'msgpack' in name:
+        pytest.importorskip('msgpack')
+    if 'zstd' in name:
+        pytest.importorskip('zstandard')
+    encoder = Codec(name, compress_threshold=100)
+    data, encoding = encoder.encode(PAYLOAD)
+    assert encoding == (name.partition('+')[2] or None)
+    assert decode(data, encoder.content_type, encoding) == PAYLOAD
+    text, attributes = encoder.encode_text(PAYLOAD)
+    assert decode_text(text, attributes) == PAYLOAD
+
+
+def test_small_payload_is_not_compressed():
+    data, encoding = Codec('json+gzip', compress_threshold=1024).encode({'ok': True})
+    assert encoding is None
+    assert decode(data, 'application/json; v=1') == {'ok': True}
+
+
+def test_json_text_is_not_base64_encoded():
+    text, attributes = Codec('json').encode_text({'ok': True})
+    assert text == '{"ok":true}'
+    assert attributes == {CONTENT_TYPE_ATTRIBUTE: 'application/json; v=1'}
+
+
+def test_decode_without_content_type_is_json():
+    assert decode(b'{"ok":true}') == {'ok': True}
+
+
+def test_decode_text_without_content_type_is_text():
+    assert decode_text('plain', {}) == 'plain'
+    # As BatchPublisher sends a string above its compress_threshold.
+    text = base64.b64encode(gzip.compress(b'plain')).decode('ascii')
+    assert decode_text(text, {CONTENT_ENCODING_ATTRIBUTE: 'gzip+base64'}) == 'plain'
+
+
+def test_decode_rejects_unknown_content_type_and_newer_version():
+    with pytest.raises(ValueError):
+        decode(b'<ok/>', 'application/xml')
+    with pytest.raises(ValueError):
+        decode(b'{}', 'application/json; v=2')
+
+
+def test_negotiate_defaults_to_json():
+    assert negotiate().name == 'json'
+    assert negotiate('*/*').name == 'json'
+    assert negotiate('text/html', 'br').name == 'json'
+
+
+def test_negotiate_gzip():
+    assert negotiate('application/json', 'gzip, deflate').name == 'json+gzip'
+    assert negotiate('application/json', 'gzip;q=0').name == 'json'
+
+
+def test_negotiate_follows_accept_order():
+    pytest.importorskip('msgpack')
+    assert negotiate('application/msgpack, application/json;q=0.5').name == 'msgpack'
+    assert negotiate('application/json, application/msgpack;q=0.5').name == 'json'
+    assert negotiate('application/json;q=0.5, application/msgpack').name == 'msgpack'
+
+
+def test_negotiate_zstd():
+    pytest.importorskip('zstandard')
+    assert negotiate('application/json', 'gzip, zstd').name == 'json+zstd'
+
+
+def test_negotiate_falls_back_without_libraries(without_libraries):
+    assert negotiate('application/msgpack, application/json;q=0.5', 'zstd, gzip').name == 'json+gzip'
+    assert negotiate('application/msgpack', 'zstd').name == 'json'
+
+
+def test_codec_needs_its_library(without_libraries):
+    with pytest.raises(ValueError, match='msgpack package'):
+        Codec('msgpack')
+    with pytest.raises(ValueError, match='zstandard package'):
+        Codec('json+zstd')
+    with pytest.raises(ValueError, match='zstandard package'):
+        decode(b'', 'application/json', 'zstd')
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError, match='Unsupported codec'):
+        Codec('json+brotli')
+
+
+def test_accept_headers():
+    assert accept_headers('json') == {'Accept': 'application/json'}
+    assert accept_headers('json+gzip') == {'Accept': 'application/json', 'Accept-Encoding': 'gzip'}
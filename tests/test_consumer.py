@@ -0,0 +1,179 @@
+import threading
+import time
+import pytest
+from common.consumer import BatchConsumer, VisibilityLeases, messages_total
+from common.idempotency import InProgress
+from saga_worker.local import LocalSQS
+
+QUEUE_URL = 'https://sqs.local/000000000000/test'
+
+
+class RecordingSqs:
+    '''Records the change_message_visibility_batch calls, and fails the receipt handles in `failing`.'''
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.calls = []
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        self.calls.append(Entries)
+        return {'Successful': [{'Id': e['Id']} for e in Entries if e['ReceiptHandle'] not in self.failing],
+                'Failed': [{'Id': e['Id'], 'Code': 'ReceiptHandleIsInvalid'} for e in Entries
+                           if e['ReceiptHandle'] in self.failing]}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('common.consumer.time.monotonic', lambda: now[0])
+    return now
+
+
+def message(n):
+    return {'MessageId': str(n), 'ReceiptHandle': 'r{}'.format(n), 'Body': str(n)}
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def test_lease_is_extended_when_due(clock):
+    sqs = RecordingSqs()
+    leases = VisibilityLeases(sqs, QUEUE_URL, visibility_timeout=30)
+    leases.add(message(1))
+    clock[0] += 10
+    leases.extend_due()
+    assert sqs.calls == []
+    clock[0] += 10
+    leases.extend_due()
+    assert sqs.calls == [[{'Id': '0', 'ReceiptHandle': 'r1', 'VisibilityTimeout': 30}]]
+    # The extension counts from now, so it is not due again right away.
+    clock[0] += 10
+    leases.extend_due()
+    assert len(sqs.calls) == 1
+
+
+def test_lease_stops_at_max_lease(clock):
+    sqs = RecordingSqs()
+    leases = VisibilityLeases(sqs, QUEUE_URL, visibility_timeout=30, max_lease=60)
+    leases.add(message(1))
+    clock[0] += 61
+    leases.extend_due()
+    assert sqs.calls == []
+
+
+def test_lease_that_fails_to_extend_is_dropped(clock):
+    leases = VisibilityLeases(RecordingSqs(failing={'r1'}), QUEUE_URL, visibility_timeout=30)
+    leases.add(message(1))
+    leases.add(message(2))
+    clock[0] += 20
+    leases.extend_due()
+    assert leases.held() == [message(2)]
+
+
+def test_release_in_batches_of_ten():
+    sqs = RecordingSqs()
+    leases = VisibilityLeases(sqs, QUEUE_URL)
+    messages = [message(n) for n in range(25)]
+    for msg in messages:
+        leases.add(msg)
+    leases.release(messages)
+    assert [len(entries) for entries in sqs.calls] == [10, 10, 5]
+    assert {entry['VisibilityTimeout'] for entries in sqs.calls for entry in entries} == {0}
+    assert leases.held() == []
+
+
+def consumer_for(sqs, handler, **kwargs):
+    return BatchConsumer(sqs, QUEUE_URL, handler, wait_time=1, monitor_interval=0, **kwargs)
+
+
+def test_consumer_processes_and_deletes():
+    sqs = LocalSQS(poll_timeout=0.1)
+    for n in range(25):
+        sqs.send_message(QueueUrl=QUEUE_URL, MessageBody=str(n))
+    received = []
+    consumer = consumer_for(sqs, lambda msg: received.append(msg['Body']), ack_interval=0.05)
+    consumer.start()
+    wait_until(lambda: len(received) == 25 and not sqs._in_flight)
+    consumer.stop(5)
+    assert sorted(received, key=int) == [str(n) for n in range(25)]
+    assert consumer.leases.held() == []
+
+
+def test_failed_message_is_not_deleted():
+    sqs = LocalSQS(poll_timeout=0.1)
+    sqs.send_message(QueueUrl=QUEUE_URL, MessageBody='bad')
+    calls = []
+
+    def fail(msg):
+        calls.append(msg)
+        raise RuntimeError('boom')
+
+    consumer = consumer_for(sqs, fail)
+    consumer.start()
+    wait_until(lambda: calls and not consumer.leases.held())
+    consumer.stop(5)
+    # It comes back after its visibility timeout, which LocalSQS never lets expire.
+    assert len(sqs._in_flight) == 1
+
+
+def processed(outcome):
+    return messages_total._values.get((('outcome', outcome),), 0)
+
+
+def test_message_in_progress_is_left_on_the_queue(caplog):
+    sqs = LocalSQS(poll_timeout=0.1)
+    sqs.send_message(QueueUrl=QUEUE_URL, MessageBody='copy')
+    calls = []
+
+    def in_progress(msg):
+        calls.append(msg)
+        raise InProgress('k')
+
+    failures = processed('failure')
+    consumer = consumer_for(sqs, in_progress)
+    consumer.start()
+    wait_until(lambda: calls and not consumer.leases.held())
+    consumer.stop(5)
+    assert len(sqs._in_flight) == 1
+    assert processed('in_progress') >= 1
+    assert processed('failure') == failures
+    assert not [record for record in caplog.records if record.exc_info]
+
+
+def test_stop_flushes_pending_acks():
+    sqs = LocalSQS(poll_timeout=0.1)
+    sqs.send_message(QueueUrl=QUEUE_URL, MessageBody='1')
+    done = threading.Event()
+    consumer = consumer_for(sqs, lambda msg: done.set(), ack_interval=60)
+    consumer.start()
+    assert done.wait(5)
+    consumer.stop(5)
+    assert not sqs._in_flight
+
+
+def test_stop_returns_unstarted_and_unfinished_messages():
+    sqs = LocalSQS(poll_timeout=0.1)
+    for n in range(4):
+        sqs.send_message(QueueUrl=QUEUE_URL, MessageBody=str(n))
+    started = threading.Event()
+    finish = threading.Event()
+
+    def slow(msg):
+        started.set()
+        finish.wait(5)
+
+    consumer = consumer_for(sqs, slow, concurrency=1, prefetch=3)
+    consumer.start()
+    try:
+        assert started.wait(5)
+        wait_until(lambda: consumer._messages.qsize() == 3)
+        consumer.stop(0.2)
+    finally:
+        finish.set()
+    assert sqs._queue(QUEUE_URL).qsize() == 4
+    assert not sqs._in_flight
+    assert consumer.leases.held() == []
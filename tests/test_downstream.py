@@ -0,0 +1,103 @@
+import pytest
+from downstream import DnsCache, DownstreamClient, LoadBalancer, NoEndpoints, StubResolver
+
+A, B, C = ('10.0.0.1', 9090), ('10.0.0.2', 9090), ('10.0.0.3', 9090)
+
+
+def test_round_robin_takes_every_endpoint_in_turn():
+    balancer = LoadBalancer('round_robin')
+    chosen = []
+    for _ in range(6):
+        endpoint = balancer.choose([A, B, C])
+        balancer.release(endpoint, True)
+        chosen.append(endpoint)
+    assert chosen == [A, B, C, A, B, C]
+
+
+def test_least_outstanding_avoids_busy_endpoints():
+    balancer = LoadBalancer('least_outstanding')
+    busy = [balancer.choose([A, B]) for _ in range(2)]
+    assert sorted(busy) == [A, B]
+    balancer.release(A, True)
+    assert balancer.choose([A, B]) == A
+
+
+def test_power_of_two_picks_the_idle_endpoint_of_two():
+    balancer = LoadBalancer('power_of_two')
+    balancer.choose([A])
+    assert balancer.choose([A, B]) == B
+
+
+def test_failing_endpoint_is_ejected_and_readmitted(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('downstream.time.monotonic', lambda: now[0])
+    balancer = LoadBalancer('round_robin', eject_after=2, eject_seconds=30)
+    for _ in range(2):
+        balancer.choose([A])
+        balancer.release(A, False)
+    assert {balancer.choose([A, B]) for _ in range(4)} == {B}
+    now[0] += 31
+    assert {balancer.choose([A, B]) for _ in range(4)} == {A, B}
+
+
+def test_every_endpoint_ejected_uses_them_all():
+    balancer = LoadBalancer('round_robin', eject_after=1)
+    for endpoint in (A, B):
+        balancer.choose([endpoint])
+        balancer.release(endpoint, False)
+    assert {balancer.choose([A, B]) for _ in range(4)} == {A, B}
+
+
+@pytest.mark.parametrize('strategy', LoadBalancer.STRATEGIES)
+def test_choose_without_endpoints_raises(strategy):
+    with pytest.raises(NoEndpoints):
+        LoadBalancer(strategy).choose([])
+
+
+def test_dns_cache_treats_an_empty_answer_as_a_failure():
+    resolver = StubResolver([])
+    with pytest.raises(NoEndpoints):
+        DnsCache(resolver).resolve('app2', 9090)
+
+
+def test_dns_cache_keeps_the_last_endpoints_on_an_empty_answer():
+    resolver = StubResolver([A, B])
+    cache = DnsCache(resolver, ttl=0)
+    assert cache.resolve('app2', 9090) == [A, B]
+    resolver.endpoints = []
+    assert cache.resolve('app2', 9090) == [A, B]
+
+
+class FlakyClient(DownstreamClient):
+    '''Fails to connect to `down`, answers from every other endpoint.'''
+
+    def __init__(self, endpoints, down, **kwargs):
+        super().__init__('http://app2:9090', resolver=StubResolver(endpoints), **kwargs)
+        self.down = down
+        self.sent = []
+
+    def _send(self, endpoint, method, path, body, headers):
+        self.sent.append((method, endpoint))
+        if endpoint in self.down:
+            raise ConnectionRefusedError('{} is down'.format(endpoint))
+        return 200, b'ok', {}
+
+
+def test_get_is_retried_on_another_endpoint():
+    client = FlakyClient([A, B], down={A})
+    assert client.get('/') == b'ok'
+    assert client.sent == [('GET', A), ('GET', B)]
+
+
+def test_post_is_not_retried():
+    client = FlakyClient([A, B], down={A})
+    with pytest.raises(OSError):
+        client.request('POST', '/', body=b'{}')
+    assert client.sent == [('POST', A)]
+
+
+def test_get_is_tried_at_most_twice():
+    client = FlakyClient([A, B, C], down={A, B, C})
+    with pytest.raises(OSError):
+        client.get('/')
+    assert len(client.sent) == 2
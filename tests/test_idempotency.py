@@ -0,0 +1,107 @@
+import pytest
+from common.idempotency import DONE, PENDING, IdempotencyStore, InProgress, SQLiteBackend, idempotency_store_from_url
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def backend(request, tmp_path):
+    # A factory, so a test can build a second store on the same backend, like a second task.
+    if request.param == 'memory':
+        return lambda: None
+    path = str(tmp_path / 'idempotency.db')
+    return lambda: SQLiteBackend(path)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('common.idempotency.time.time', lambda: now[0])
+    return now
+
+
+def test_run_calls_func_once(backend):
+    store = IdempotencyStore(backend())
+    calls = []
+    assert store.run('k', lambda: calls.append(1) or 'first') == ('first', False)
+    assert store.run('k', lambda: calls.append(1) or 'second') == ('first', True)
+    assert calls == [1]
+
+
+def test_claim_and_complete(backend):
+    store = IdempotencyStore(backend())
+    assert store.claim('k').acquired
+    assert store.claim('k') == (False, PENDING, None)
+    store._complete('k', {'ok': True})
+    assert store.claim('k') == (False, DONE, {'ok': True})
+
+
+def test_completed_key_is_seen_by_another_store(tmp_path):
+    path = str(tmp_path / 'idempotency.db')
+    IdempotencyStore(SQLiteBackend(path)).run('k', lambda: 42)
+    assert IdempotencyStore(SQLiteBackend(path)).run('k', lambda: 0) == (42, True)
+
+
+def test_key_in_progress_raises(tmp_path):
+    path = str(tmp_path / 'idempotency.db')
+    assert IdempotencyStore(SQLiteBackend(path)).claim('k').acquired
+    with pytest.raises(InProgress):
+        IdempotencyStore(SQLiteBackend(path)).run('k', lambda: 0)
+
+
+def test_failed_func_releases_the_key(backend):
+    store = IdempotencyStore(backend())
+
+    def fail():
+        raise RuntimeError('boom')
+
+    with pytest.raises(RuntimeError):
+        store.run('k', fail)
+    assert store.run('k', lambda: 'retried') == ('retried', False)
+
+
+def test_lease_runs_out(backend, clock):
+    owner = IdempotencyStore(backend(), lease=60)
+    # Without a backend only the same process sees the claim.
+    other = owner if owner.backend is None else IdempotencyStore(backend(), lease=60)
+    assert owner.claim('k').acquired
+    clock[0] += 59
+    assert not other.claim('k').acquired
+    clock[0] += 2
+    assert other.claim('k').acquired
+
+
+def test_renew_extends_the_lease(backend, clock):
+    owner = IdempotencyStore(backend(), lease=60)
+    # Without a backend only the same process sees the claim.
+    other = owner if owner.backend is None else IdempotencyStore(backend(), lease=60)
+    assert owner.claim('k').acquired
+    for _ in range(3):
+        clock[0] += 50
+        owner.renew('k')
+    assert not other.claim('k').acquired
+    clock[0] += 61
+    assert other.claim('k').acquired
+
+
+def test_records_expire_after_ttl(tmp_path, clock):
+    path = str(tmp_path / 'idempotency.db')
+    IdempotencyStore(SQLiteBackend(path), ttl=100).run('k', lambda: 1)
+    clock[0] += 101
+    assert IdempotencyStore(SQLiteBackend(path), ttl=100).run('k', lambda: 2) == (2, False)
+
+
+def test_memory_store_evicts_the_oldest_keys():
+    store = IdempotencyStore(max_entries=2)
+    for key in ('a', 'b', 'c'):
+        store.run(key, lambda: key)
+    assert store.run('a', lambda: 'again') == ('again', False)
+    assert store.run('c', lambda: 'again') == ('c', True)
+
+
+def test_store_from_url(tmp_path):
+    assert idempotency_store_from_url('') is None
+    assert idempotency_store_from_url('none') is None
+    assert idempotency_store_from_url('memory').backend is None
+    store = idempotency_store_from_url('sqlite://' + str(tmp_path / 'x.db'))
+    assert isinstance(store.backend, SQLiteBackend)
+    with pytest.raises(ValueError):
+        idempotency_store_from_url('redis://localhost')
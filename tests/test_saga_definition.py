@@ -0,0 +1,93 @@
+import json
+import threading
+import time
+from concurrent.futures import Future
+import pytest
+from saga_worker.definition import LOCAL_ARN_PREFIX, saga_definition
+from saga_worker.local import LocalStateMachine, TaskFailed
+
+ROLLBACKS = ('logistic-rollback', 'payment-rollback', 'inventory-rollback')
+
+
+class ScriptedTask:
+    def __init__(self, output=None, error=None):
+        self.future = Future()
+        if error is None:
+            self.future.set_result(json.dumps(output))
+        else:
+            self.future.set_exception(TaskFailed(error))
+        self.last_heartbeat = time.monotonic()
+
+
+class ScriptedStepFunctions:
+    '''
+    Answers every task of LocalStateMachine at once, in place of the workers.
+    `results` maps a process activity to its result, or to the error its
+    task fails with; activities that are not in it succeed.
+    '''
+
+    def __init__(self, results):
+        self.results = results
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def start_task(self, activity_arn, input_payload):
+        activity_name = activity_arn[len(LOCAL_ARN_PREFIX):]
+        with self._lock:
+            self.calls.append(activity_name)
+        result = self.results.get(activity_name, True)
+        if isinstance(result, str):
+            return ScriptedTask(error=result)
+        payload = json.loads(input_payload)
+        if activity_name.endswith('-process'):
+            # Like the workers, e.g. "inventory_result" for inventory-process.
+            payload[activity_name[:-len('-process')] + '_result'] = result
+        return ScriptedTask(payload)
+
+    def time_out_task(self, task):
+        pass
+
+
+def execute(results, mode='parallel'):
+    sfn = ScriptedStepFunctions(results)
+    result = LocalStateMachine(saga_definition(mode=mode), sfn, time_scale=0).execute({'order_id': 'o-1'})
+    return result['status'], [name for name in sfn.calls if name in ROLLBACKS], sfn.calls
+
+
+def test_all_reserved():
+    status, rollbacks, calls = execute({})
+    assert status == 'SUCCEEDED'
+    assert rollbacks == []
+    assert sorted(calls) == ['inventory-process', 'logistic-process', 'payment-process']
+
+
+def test_nothing_reserved_is_not_cancelled():
+    status, rollbacks, _ = execute({'inventory-process': False, 'payment-process': False})
+    assert status == 'FAILED'
+    assert rollbacks == []
+
+
+@pytest.mark.parametrize('results, expected', [
+    ({'inventory-process': False}, ['payment-rollback']),
+    ({'payment-process': False}, ['inventory-rollback']),
+    # A reservation whose task fails counts as not reserved.
+    ({'inventory-process': 'Inventory.Error'}, ['payment-rollback']),
+    ({'payment-process': 'Payment.Error'}, ['inventory-rollback']),
+])
+def test_only_the_successful_reservation_is_cancelled(results, expected):
+    status, rollbacks, calls = execute(results)
+    assert status == 'FAILED'
+    assert rollbacks == expected
+    assert 'logistic-process' not in calls
+
+
+def test_failed_logistic_cancels_everything():
+    status, rollbacks, _ = execute({'logistic-process': False})
+    assert status == 'FAILED'
+    assert rollbacks == ['logistic-rollback', 'payment-rollback', 'inventory-rollback']
+
+
+def test_sequential_failed_payment_cancels_in_reverse_order():
+    status, rollbacks, calls = execute({'payment-process': False}, mode='sequential')
+    assert status == 'FAILED'
+    assert calls == ['inventory-process', 'payment-process', 'payment-rollback', 'inventory-rollback']
@@ -1,34 +1,65 @@
-from flask import Flask, request, make_response, jsonify
+from flask import Blueprint, Flask, request, make_response, jsonify, Response, stream_with_context
 import markdown
 import os
-import boto3
+import json
+import queue
 import uuid
 from datetime import datetime
+from render_cache import RenderCache, shared_cache_from_url
+from persistence import WriteBehindStore
+from bulk import BulkRenderer
+from common.metrics import instrument_flask, registry
 
-app = Flask(__name__)
+routes = Blueprint('api', __name__)
 DYNAMODB_TABLE = os.getenv("<CHANGE_THIS_VAR>")
+MARKDOWN_EXTENSIONS = []
+# Write every item before responding, instead of queueing it. Can also be
+# requested per call with ?durable=true.
+PERSISTENCE_DURABLE = os.getenv("PERSISTENCE_DURABLE", "false").lower() == "true"
 
-def save_data(markdown, html):
-    dynamodb = boto3.resource('dynamodb')
-    table = dynamodb.Table(DYNAMODB_TABLE)
+
+def render_markdown(text):
+    return markdown.markdown(text, extensions=MARKDOWN_EXTENSIONS)
+
+
+# Most documents are submitted again and again, only render each one once.
+render_cache = RenderCache(render_markdown, extensions=MARKDOWN_EXTENSIONS,
+                           max_bytes=int(os.getenv("RENDER_CACHE_MAX_MB", "32")) * 1024 * 1024,
+                           shared=shared_cache_from_url(os.getenv("RENDER_CACHE_SHARED_URL")))
+
+store = WriteBehindStore(DYNAMODB_TABLE,
+                         max_queue=int(os.getenv("PERSISTENCE_MAX_QUEUE", "10000")),
+                         linger=float(os.getenv("PERSISTENCE_LINGER_MS", "500")) / 1000)
+
+bulk_renderer = BulkRenderer(render_cache, extensions=MARKDOWN_EXTENSIONS,
+                             workers=int(os.getenv("BULK_WORKERS", "0")) or None,
+                             max_document_bytes=int(os.getenv("BULK_MAX_DOCUMENT_KB", "1024")) * 1024,
+                             on_rendered=lambda text, html: save_rendered(text, html))
+
+def save_data(markdown, html, durable=False):
     id = str(uuid.uuid4())
-    table.update_item(
-        Key={'ID': id},
-        UpdateExpression="set message_markdown=:markdown, message_html=:html, request_date=:sts",
-        ExpressionAttributeValues={
-            ':markdown': markdown,
-            ':html': html,
-            ':sts': datetime.now().strftime("%m-%d-%Y %H:%M:%S")
-        })
-
-@app.route('/ping', methods=['GET'])
+    store.save({
+        'ID': id,
+        'message_markdown': markdown,
+        'message_html': html,
+        'request_date': datetime.now().strftime("%m-%d-%Y %H:%M:%S")
+    }, durable=durable)
+
+def save_rendered(markdown, html):
+    # Reported in the result of the document by the bulk renderer, the rest of the stream goes on.
+    try:
+        save_data(markdown, html)
+    except queue.Full:
+        raise RuntimeError("Too many pending writes, try again later")
+
+@routes.route('/ping', methods=['GET'])
 def ping():
     try:
         return jsonify({"value": "ok"}), 200
     except:
         return jsonify({"error": "error"}), 500
 
-@app.route('/api/markdown', methods=['GET', 'POST'])
+@routes.route('/api/markdown', methods=['GET', 'POST'])
 def to_markdown():
     if request.method == "GET":
         data = {}
@@ -39,11 +70,66 @@ def to_markdown():
         html = None
         if "text" in payload:
             input_markdown = payload['text']
-            html = markdown.markdown(input_markdown)
-            save_data(input_markdown, html)
+            html = render_cache.get(input_markdown)
+            durable = PERSISTENCE_DURABLE or request.args.get("durable") == "true"
+            try:
+                save_data(input_markdown, html, durable=durable)
+            except queue.Full:
+                # Back-pressure: DynamoDB is not keeping up, let the client retry later.
+                return jsonify({"error": "Too many pending writes, try again later"}), 503
             data["html"] = html
     return jsonify(data), 200
 
 
+@routes.route('/api/markdown/bulk', methods=['POST'])
+def to_markdown_bulk():
+    # Accepts NDJSON (one document per line) or a JSON array, and streams one
+    # NDJSON result per document. ?order=unordered returns results as they complete.
+    ordered = request.args.get("order", "ordered") != "unordered"
+    if request.mimetype == "application/x-ndjson":
+        documents = parse_ndjson(request.stream)
+    else:
+        documents = request.get_json()
+        if not isinstance(documents, list):
+            return jsonify({"error": "Expected a JSON array of documents"}), 400
+
+    def generate():
+        for result in bulk_renderer.render_stream(documents, ordered=ordered):
+            yield json.dumps(result) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+def parse_ndjson(stream):
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            # Reported as an invalid document, the rest of the upload still runs.
+            yield None
+
+
+@routes.route('/api/markdown/cache', methods=['GET'])
+def render_cache_stats():
+    return jsonify(render_cache.stats()), 200
+
+
+def create_app():
+    '''
+    Builds the app without starting a thread or opening a connection, so
+    gunicorn can import it once before forking the workers
+    (GUNICORN_PRELOAD=true). The DynamoDB writer and the bulk rendering
+    pool start in each worker when they are first used.
+    '''
+    app = Flask(__name__)
+    instrument_flask(app, registry)
+    app.register_blueprint(routes)
+    return app
+
+
+app = create_app()
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=9090)
@@ -0,0 +1,138 @@
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, FIRST_COMPLETED, wait
+import markdown
+
+
+def container_cpus():
+    '''Number of CPUs the container may use, from the cgroup CPU quota.'''
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            return max(1, int(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+    try:
+        # cgroup v1
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+            period = int(f.read())
+        if quota > 0:
+            return max(1, int(quota / period))
+    except (OSError, ValueError):
+        pass
+    return os.cpu_count() or 1
+
+
+def render_document(text, extensions):
+    # Runs in the pool processes, keep it importable without the Flask app.
+    return markdown.markdown(text, extensions=extensions)
+
+
+def _resolved(result=None, error=None):
+    future = Future()
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+    return future
+
+
+class BulkRenderer:
+    '''
+    Renders many markdown documents on a pool of processes, one per
+    container CPU, so large batches are not limited to one core by the GIL.
+
+    `render_stream()` takes an iterable of documents, either strings or
+    {"id": ..., "text": ...} dicts, and yields one result per document as
+    soon as it is ready: in input order when `ordered` is set, otherwise in
+    completion order. At most `max_in_flight` documents are submitted at a
+    time, so a large upload is not held in memory all at once. Documents
+    larger than `max_document_bytes` are rejected with an error result.
+    If `on_rendered` raises for a document, e.g. because the write queue is
+    full, its result has both the html and an error, and the stream goes on.
+    '''
+
+    def __init__(self, render_cache, extensions=(), workers=None,
+                 max_document_bytes=1024 * 1024, max_in_flight=None, on_rendered=None):
+        self.render_cache = render_cache
+        self.extensions = list(extensions)
+        self.workers = workers or container_cpus()
+        self.max_document_bytes = max_document_bytes
+        self.max_in_flight = max_in_flight or self.workers * 4
+        self.on_rendered = on_rendered
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def render_stream(self, documents, ordered=True):
+        pending = OrderedDict()
+        for index, document in enumerate(documents):
+            pending[index] = (document, self._submit(document))
+            while len(pending) >= self.max_in_flight:
+                yield from self._drain(pending, ordered)
+        while pending:
+            yield from self._drain(pending, ordered)
+
+    def _pool(self):
+        # The pool belongs to the gunicorn worker that created it.
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    # spawn, not fork: the gunicorn worker runs threads that a fork would copy mid-flight.
+                    self._executor = ProcessPoolExecutor(self.workers,
+                                                         mp_context=multiprocessing.get_context('spawn'))
+                    self._pid = os.getpid()
+        return self._executor
+
+    def _submit(self, document):
+        if isinstance(document, str):
+            document = {'text': document}
+        if not isinstance(document, dict) or not isinstance(document.get('text'), str):
+            return _resolved(error=ValueError('Document must be a string or an object with "text"'))
+        text = document['text']
+        if len(text.encode('utf-8')) > self.max_document_bytes:
+            return _resolved(error=ValueError('Document is larger than {} bytes'.format(
+                self.max_document_bytes)))
+        html = self.render_cache.lookup(text)
+        if html is not None:
+            future = _resolved(result=html)
+            future.from_cache = True
+            return future
+        return self._pool().submit(render_document, text, self.extensions)
+
+    def _drain(self, pending, ordered):
+        if ordered:
+            index, (document, future) = pending.popitem(last=False)
+            yield self._result(index, document, future)
+            return
+        done, _ = wait([future for _, future in pending.values()], return_when=FIRST_COMPLETED)
+        for index in [index for index, (_, future) in pending.items() if future in done]:
+            document, future = pending.pop(index)
+            yield self._result(index, document, future)
+
+    def _result(self, index, document, future):
+        result = {'index': index}
+        if isinstance(document, dict) and 'id' in document:
+            result['id'] = document['id']
+        try:
+            html = future.result()
+        except Exception as e:
+            result['error'] = str(e)
+            return result
+        text = document if isinstance(document, str) else document['text']
+        if not getattr(future, 'from_cache', False):
+            self.render_cache.store(text, html)
+        result['html'] = html
+        if self.on_rendered is not None:
+            try:
+                self.on_rendered(text, html)
+            except Exception as e:
+                # Raised inside the response generator, it would cut the stream short for every later document.
+                result['error'] = 'Not saved: {}'.format(str(e) or e.__class__.__name__)
+        return result
@@ -0,0 +1,131 @@
+import atexit
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from common.metrics import registry
+
+logger = logging.getLogger()
+
+# DynamoDB caps batch_write_item at 25 items.
+DYNAMODB_MAX_BATCH = 25
+
+write_seconds = registry.histogram('dynamodb_write_seconds', 'Time spent in one DynamoDB write call', ('call',))
+items_total = registry.counter('dynamodb_items_total', 'Items by outcome', ('outcome',))
+items_queued = registry.gauge('dynamodb_items_queued', 'Items waiting to be written')
+
+
+class WriteBehindStore:
+    '''
+    Saves items to a DynamoDB table without making the request wait.
+
+    `save()` puts the item on a bounded in-memory queue, and a background
+    thread writes the queue with batch_write_item when it has 25 items or
+    `linger` seconds after the first one. Unprocessed items are retried with
+    backoff. The queue is flushed when the process exits. `save(item,
+    durable=True)` writes the item before returning, for callers that need
+    to know it is stored.
+
+    The boto3 client is built once per process and reused. `client_factory`
+    replaces it, e.g. with a local stand-in for benchmarks.
+    '''
+
+    def __init__(self, table_name, max_queue=10000, linger=0.5, enqueue_timeout=1.0,
+                 max_retries=5, max_pool_connections=10, client_factory=None):
+        self.table_name = table_name
+        self.linger = linger
+        self.enqueue_timeout = enqueue_timeout
+        self.max_retries = max_retries
+        self.max_pool_connections = max_pool_connections
+        self.client_factory = client_factory or self._boto3_client
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._client = None
+        self._thread = None
+
+    def save(self, item, durable=False):
+        self._ensure_started()
+        if durable:
+            with write_seconds.time(call='put_item'):
+                self._client.put_item(TableName=self.table_name, Item=item)
+            items_total.inc(outcome='written')
+        else:
+            try:
+                self._queue.put(item, timeout=self.enqueue_timeout)
+            except queue.Full:
+                items_total.inc(outcome='rejected')
+                raise
+            items_queued.inc()
+
+    def flush(self):
+        '''Write everything that is queued and stop the writer thread.'''
+        if self._thread is not None and self._pid == os.getpid():
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _ensure_started(self):
+        # Neither the client nor the thread survive a fork, build them in each worker.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._client = self.client_factory()
+                self._thread = threading.Thread(target=self._write_loop,
+                                                name='dynamodb-writer', daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+                atexit.register(self.flush)
+
+    def _boto3_client(self):
+        # boto3 takes a while to import, and is only needed once the first item is written.
+        import boto3
+        from botocore.config import Config
+
+        # The resource's client accepts plain Python values instead of typed attributes.
+        return boto3.resource('dynamodb', config=Config(
+            max_pool_connections=self.max_pool_connections)).meta.client
+
+    def _write_loop(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+            if item:
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.linger
+            if batch and (not item or len(batch) >= DYNAMODB_MAX_BATCH):
+                self._write_batch(batch)
+                batch, deadline = [], None
+            if item is None:
+                return
+
+    def _write_batch(self, batch):
+        requests = [{'PutRequest': {'Item': item}} for item in batch]
+        items_queued.dec(len(batch))
+        for attempt in range(self.max_retries):
+            try:
+                with write_seconds.time(call='batch_write_item'):
+                    response = self._client.batch_write_item(RequestItems={self.table_name: requests})
+            except Exception:
+                logger.exception('Could not write {} item(s) to {}.'.format(
+                    len(requests), self.table_name))
+            else:
+                unprocessed = response.get('UnprocessedItems', {}).get(self.table_name, [])
+                items_total.inc(len(requests) - len(unprocessed), outcome='written')
+                requests = unprocessed
+                if not requests:
+                    return
+            # Throttled or failed, back off before retrying what is left.
+            time.sleep(random.uniform(0, 0.05 * (2 ** attempt)))
+        items_total.inc(len(requests), outcome='dropped')
+        logger.error('Dropping {} item(s) for {} after {} attempts.'.format(
+            len(requests), self.table_name, self.max_retries))
@@ -0,0 +1,162 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger()
+
+
+def cache_key(text, extensions):
+    # Content-addressed: the same text with the same extensions always renders the same HTML.
+    digest = hashlib.sha256()
+    digest.update(','.join(sorted(extensions)).encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(text.encode('utf-8'))
+    return digest.hexdigest()
+
+
+class FileSharedCache:
+    '''
+    Shared tier backed by a directory. Every gunicorn worker in a task sees
+    the same entries; it also stands in for Redis when running locally.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.directory, key), encoding='utf-8') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def set(self, key, value):
+        path = os.path.join(self.directory, key)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(value)
+        os.replace(tmp_path, path)
+
+
+class RedisSharedCache:
+    '''Shared tier backed by Redis, e.g. Amazon ElastiCache. Needs the redis package.'''
+
+    def __init__(self, url, ttl=86400):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.client.get(key)
+        return value.decode('utf-8') if value is not None else None
+
+    def set(self, key, value):
+        self.client.set(key, value.encode('utf-8'), ex=self.ttl)
+
+
+def shared_cache_from_url(url):
+    if not url:
+        return None
+    if url.startswith('redis://') or url.startswith('rediss://'):
+        return RedisSharedCache(url)
+    if url.startswith('file://'):
+        return FileSharedCache(url[len('file://'):])
+    raise ValueError('Unsupported shared cache: {}'.format(url))
+
+
+class RenderCache:
+    '''
+    In-process LRU of rendered HTML, bounded by the total size of the cached
+    HTML in bytes, in front of an optional shared tier.
+    '''
+
+    def __init__(self, render, extensions=(), max_bytes=32 * 1024 * 1024, shared=None):
+        self.render = render
+        self.extensions = list(extensions)
+        self.max_bytes = max_bytes
+        self.shared = shared
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, text):
+        html = self.lookup(text)
+        if html is None:
+            html = self.render(text)
+            self.store(text, html)
+        return html
+
+    def lookup(self, text):
+        '''Returns the cached HTML for `text`, or None without rendering it.'''
+        key = cache_key(text, self.extensions)
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return html
+        html = self._get_shared(key)
+        with self._lock:
+            if html is not None:
+                self.shared_hits += 1
+            else:
+                self.misses += 1
+        if html is not None:
+            self._put(key, html)
+        return html
+
+    def store(self, text, html):
+        '''Caches HTML that was rendered outside of `get()`, e.g. in a process pool.'''
+        key = cache_key(text, self.extensions)
+        self._set_shared(key, html)
+        self._put(key, html)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._size,
+            }
+
+    def _put(self, key, html):
+        size = len(html.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = html
+            self._size += size
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted.encode('utf-8'))
+                self.evictions += 1
+
+    def _get_shared(self, key):
+        if self.shared is None:
+            return None
+        try:
+            return self.shared.get(key)
+        except Exception:
+            # The shared tier is an optimisation, rendering still works without it.
+            logger.exception('Could not read from the shared render cache.')
+            return None
+
+    def _set_shared(self, key, html):
+        if self.shared is None:
+            return
+        try:
+            self.shared.set(key, html)
+        except Exception:
+            logger.exception('Could not write to the shared render cache.')
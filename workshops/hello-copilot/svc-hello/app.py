@@ -1,36 +1,43 @@
-from flask import Flask, request, render_template
-import platform
-import psutil
-import boto3
-import socket
+from flask import Blueprint, Flask, request, render_template, jsonify
 import os
-import logging
+from common.host_metrics import HostMetrics
+from common.metrics import instrument_flask, registry
 
 # from flask import jsonify
 # import json
 # from urllib import request, parse
 
-app = Flask(__name__, template_folder="./")
+routes = Blueprint('hello', __name__)
+host_metrics = HostMetrics(interval=float(os.getenv("HOST_METRICS_INTERVAL", "5")))
+# The page only changes when a new sample is taken, so keep the last rendering.
+_rendered = None
 
-@app.route('/ping', methods=['GET'])
+@routes.route('/ping', methods=['GET'])
 def ping():
     try:
         return jsonify({"value": "ok"}), 200
     except:
         return jsonify({"error": "error"}), 500
 
-@app.route('/web', methods=['GET'])
+@routes.route('/web', methods=['GET'])
 def hello():
-    data = {}
-    data['hostname'] = socket.gethostname()
-    data['machine'] = platform.machine()
-    data['system'] = platform.system()
-    data['cpu_usage']=psutil.cpu_percent(interval=0)
-    data['virtual_memory'] = psutil.virtual_memory().percent
+    global _rendered
+    data, etag = host_metrics.snapshot()
+    rendered = _rendered
+    if rendered is None or rendered[0] != etag:
+        rendered = (etag, render_template("index.html", data=data))
+        _rendered = rendered
+    return rendered[1]
 
-    return render_template("index.html", data=data)
+@routes.route('/web/host', methods=['GET'])
+def host():
+    data, etag = host_metrics.snapshot()
+    response = jsonify(data)
+    response.set_etag(etag)
+    response.cache_control.max_age = int(host_metrics.interval)
+    return response.make_conditional(request)
 
-# @app.route('/web/markdown', methods=['GET'])
+# @routes.route('/web/markdown', methods=['GET'])
 # def get_markdown():
     # payload = {"text":"Calling from the web"}
     # req =  request.Request(os.getenv("LOCAL_SVCAPI_URL"), data=json.dumps(payload).encode('utf-8'), headers={'Content-Type': 'application/json'})
@@ -40,5 +47,20 @@ def hello():
 
 
 
+def create_app():
+    '''
+    Builds the app without starting a thread or opening a connection, so
+    gunicorn can import it once before forking the workers
+    (GUNICORN_PRELOAD=true). The host metrics sampler starts in each worker
+    on the first request.
+    '''
+    app = Flask(__name__, template_folder="./")
+    instrument_flask(app, registry)
+    app.register_blueprint(routes)
+    return app
+
+
+app = create_app()
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=9090, debug=True)
+    app.run(host='0.0.0.0', port=9090, debug=os.getenv("FLASK_DEBUG") == "1")